@@ -0,0 +1,290 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides asyncio (trollius) facade over NovaMimic.
+
+All methods of NovaMimic block on database, key-value storage or
+libvirt driver. AsyncNovaMimic runs them on bounded thread pools,
+one pool per kind of work (database, downloads of images, libvirt
+calls), so one event loop can drive hundreds of concurrent requests
+while number of threads stays fixed.
+
+Boot is run by its phases (see NovaMimic.instance_boot): short
+transactions which reserve and finish boot run on database pool,
+image is downloaded or checked on download pool and only creation
+of domain runs on libvirt pool. Phase which is running in thread
+can not be stopped, so boot which is cancelled waits for it in
+background and undoes everything that was done.
+
+Besides thread pools every stage of boot has its own limit of
+requests that are processed at once (semaphores of event loop), so
+e.g. burst of boots from new images does not occupy all slots for
+domain creation while images are being downloaded.
+
+Concurrent boots from the same image share one download
+(see NovaMimic._image_processing).
+
+Usage:
+
+    nova = AsyncNovaMimic()
+    instance_id = yield From(nova.instance_boot(name, image_id, flavor_id))
+'''
+
+import sys
+import logging
+from functools import partial
+
+import trollius as asyncio
+from trollius import From, Return
+from concurrent.futures import ThreadPoolExecutor
+
+from src.nova_mimic import NovaMimic
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncNovaMimic(object):
+    def __init__(self, nova_mimic=None, loop=None,
+                 db_workers=8, download_workers=4, libvirt_workers=8,
+                 download_limit=None, boot_limit=None):
+        '''
+        *_workers are sizes of thread pools, *_limit are numbers of
+        downloads and domain creations that are in progress at once
+        (size of corresponding thread pool by default).
+        '''
+        self.nova_mimic = nova_mimic or NovaMimic()
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.executors = {
+            'db': ThreadPoolExecutor(db_workers),
+            'download': ThreadPoolExecutor(download_workers),
+            'libvirt': ThreadPoolExecutor(libvirt_workers)
+        }
+
+        self.limits = {
+            'download': asyncio.Semaphore(
+                download_limit or download_workers,
+                loop=self.loop
+            ),
+            'boot': asyncio.Semaphore(
+                boot_limit or libvirt_workers,
+                loop=self.loop
+            )
+        }
+
+        #key - image id, value - future of download which is in progress
+        self.downloads = {}
+
+    def _run(self, stage, function, *args, **kwargs):
+        '''
+        Runs blocking function on thread pool of given stage.
+        Returns: awaitable future
+        '''
+        return self.loop.run_in_executor(
+            self.executors[stage],
+            partial(function, *args, **kwargs)
+        )
+
+    @asyncio.coroutine
+    def _download(self, image_id):
+        try:
+            with (yield From(self.limits['download'])):
+                yield From(
+                    self._run(
+                        'download',
+                        self.nova_mimic._image_processing,
+                        image_id
+                    )
+                )
+        finally:
+            del self.downloads[image_id]
+
+    def image_download(self, image_id):
+        '''
+        Makes sure that image is present in local image storage.
+        Concurrent callers for the same image wait for one download.
+
+        Returns: awaitable future
+        '''
+        future = self.downloads.get(image_id)
+        if future is None:
+            future = asyncio.ensure_future(
+                self._download(image_id),
+                loop=self.loop
+            )
+            self.downloads[image_id] = future
+
+        #one cancelled caller should not cancel download for others
+        return asyncio.shield(future, loop=self.loop)
+
+    def _phase(self, phases, name, stage, function, *args):
+        '''
+        Runs phase of boot on thread pool of stage and saves its future
+        to phases by name. Running phase can not be stopped, so caller
+        which is cancelled meanwhile gets CancelledError, but phase
+        itself goes on and is undone by _abort_boot.
+
+        Returns: awaitable future
+        '''
+        future = self._run(stage, function, *args)
+        phases[name] = future
+
+        return asyncio.shield(future, loop=self.loop)
+
+    @asyncio.coroutine
+    def instance_boot(self, instance_name, image_id, flavor_id):
+        '''
+        Downloads image (if it is needed) and boots instance. If boot
+        fails or is cancelled its reservation, image reference and
+        domain (if any) are released.
+
+        Returns: uuid of domain
+        '''
+        nova_mimic = self.nova_mimic
+
+        #key - name of phase, value - future of phase
+        phases = {}
+        try:
+            boot = yield From(
+                self._phase(
+                    phases, 'begin', 'db',
+                    nova_mimic._begin_boot,
+                    instance_name,
+                    image_id,
+                    flavor_id
+                )
+            )
+
+            #image is referenced by boot, it is downloaded if it is
+            #missing and checked otherwise
+            with (yield From(self.limits['download'])):
+                yield From(
+                    self._phase(
+                        phases, 'download', 'download',
+                        nova_mimic._image_processing,
+                        boot.image.id,
+                        boot.image_key,
+                        1
+                    )
+                )
+
+            with (yield From(self.limits['boot'])):
+                domain = yield From(
+                    self._phase(
+                        phases, 'create', 'libvirt',
+                        nova_mimic._create_domain,
+                        boot
+                    )
+                )
+                state = (
+                    yield From(
+                        self._phase(
+                            phases, 'state', 'libvirt', domain.state, 0
+                        )
+                    )
+                )[0]
+
+            yield From(
+                self._phase(
+                    phases, 'finish', 'db',
+                    nova_mimic._finish_boot,
+                    boot,
+                    domain,
+                    state
+                )
+            )
+        except Exception:
+            #exception is saved, since it is lost by yield in python 2
+            error = sys.exc_info()
+            #undo goes on even if caller is cancelled again
+            yield From(
+                asyncio.shield(self._abort_boot(phases), loop=self.loop)
+            )
+            raise error[0], error[1], error[2]
+
+        raise Return(boot.id)
+
+    @asyncio.coroutine
+    def _abort_boot(self, phases):
+        '''
+        Undoes boot which failed or was cancelled. Phases which are
+        still running are waited for, then reservation is released and
+        domain (if it was created) is destroyed, instance which was
+        booted after all is destroyed as a whole.
+        '''
+        nova_mimic = self.nova_mimic
+
+        begin = phases.get('begin')
+        if begin is None:
+            return
+
+        yield From(asyncio.wait(phases.values(), loop=self.loop))
+        if begin.exception() is not None:
+            #nothing was reserved
+            return
+        boot = begin.result()
+
+        create = phases.get('create')
+        domain = None
+        if create is not None and create.exception() is None:
+            domain = create.result()
+
+        finish = phases.get('finish')
+        try:
+            if finish is not None and finish.exception() is None:
+                yield From(self._run('libvirt', nova_mimic._destroy, boot.id))
+            else:
+                yield From(
+                    self._run(
+                        'libvirt' if domain is not None else 'db',
+                        nova_mimic._cancel_boot,
+                        boot.id,
+                        boot.mac_address_id,
+                        boot.image_key,
+                        domain
+                    )
+                )
+        except Exception:
+            LOG.exception("Failed to undo boot of instance %s", boot.id)
+
+    def _wrap(self, futures):
+        '''
+        Converts future (list of futures) of lifecycle operation
+        of NovaMimic into awaitable future of event loop.
+        '''
+        if isinstance(futures, list):
+            return asyncio.gather(
+                *[asyncio.wrap_future(f, loop=self.loop) for f in futures],
+                loop=self.loop,
+                return_exceptions=True
+            )
+
+        return asyncio.wrap_future(futures, loop=self.loop)
+
+    def instance_reboot(self, instance_ids, *args, **kwargs):
+        return self._wrap(
+            self.nova_mimic.instance_reboot(instance_ids, *args, **kwargs)
+        )
+
+    def instance_shutdown(self, instance_ids, *args, **kwargs):
+        return self._wrap(
+            self.nova_mimic.instance_shutdown(instance_ids, *args, **kwargs)
+        )
+
+    def instance_destroy(self, instance_ids):
+        return self._wrap(self.nova_mimic.instance_destroy(instance_ids))
+
+    def image_list(self, *args, **kwargs):
+        return self._run('db', self.nova_mimic.image_list, *args, **kwargs)
+
+    def flavor_list(self, *args, **kwargs):
+        return self._run('db', self.nova_mimic.flavor_list, *args, **kwargs)
+
+    def close(self):
+        '''
+        Waits for running calls and closes NovaMimic.
+        '''
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
+
+        self.nova_mimic.close()
@@ -0,0 +1,503 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Benchmarks of boot pipeline of NovaMimic which run without external
+services: libvirt test driver (test:///default) instead of qemu,
+sqlite database instead of MySQL and directory instead of GridFS.
+
+Measured stages:
+    - rendering of domain xml (_xml_processing)
+    - download of image which is absent in image storage (cold) and
+      lookup of image which is already there (warm)
+    - reservation of mac addresses, one and many per transaction
+    - instance_boot as a whole at several levels of concurrency,
+      instances are placed on several hosts of the same test driver
+    - placement of instances by every strategy of scheduler over
+      hundreds of hosts (src.scheduler alone, without libvirt)
+
+Results (throughput and latency percentiles, and histograms of stages
+collected by tracer of NovaMimic) are written to json file,
+which can be given as baseline to next run to see relative changes:
+
+    cd .. && python -m src.benchmarks.boot_pipeline -o before.json
+    cd .. && python -m src.benchmarks.boot_pipeline -o after.json \
+        --baseline before.json
+'''
+
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import random
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+import src.nova_mimic
+import src.utils.engine_factory
+from src.database_toolkit import Base, Flavor, Image, contexted_session
+from src.utils.engine_factory import get_engine, dispose_engines
+from src.benchmarks.file_gridfs import FileGridFS
+from src.scheduler import Scheduler, STRATEGIES
+
+PATH_TO_BENCHMARKS_DIR = os.path.abspath(os.path.dirname(__file__))
+
+CONFIG = '''[xml_config]
+path_to_xml_pattern_conf=%(pattern)s
+check_interval=1.0
+
+[image_storage]
+path_to_image_storage=%(workdir)s/image_storage
+cache_size_limit=0
+cache_policy=lru
+
+[instance_storage]
+use_overlays=false
+path_to_instance_storage=%(workdir)s/instance_storage
+
+[boot]
+max_boot_workers=8
+
+[mac_allocator]
+ranges=52:54:00:10:00:00-52:54:00:1f:ff:ff
+
+[database]
+connection_string=sqlite:///%(workdir)s/benchmark.db
+connect_timeout=30
+
+[libvirt]
+uri=test:///default
+pool_size=%(libvirt_pool_size)s
+keepalive_interval=0
+
+[scheduler]
+hosts=%(hosts)s
+strategy=spread
+#test driver has few resources, boots are never rejected
+memory_ratio=1000.0
+cpu_ratio=1000.0
+reserved_memory=0
+
+[metadata_cache]
+ttl=300
+
+[state_tracker]
+enabled=false
+
+[lifecycle]
+max_workers=16
+poll_interval=0.1
+
+[tracing]
+enabled=true
+exporters=
+'''
+
+
+def percentile(values, fraction):
+    '''
+    Returns: value below which given fraction of sorted values lies
+    '''
+    if not values:
+        return None
+
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def summarize(latencies, elapsed):
+    '''
+    Returns: dict of throughput and latency statistics (milliseconds)
+    '''
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    return {
+        'count': count,
+        'seconds': elapsed,
+        'ops_per_second': count / elapsed if elapsed else None,
+        'mean_ms': 1000.0 * sum(latencies) / count if count else None,
+        'p50_ms': 1000.0 * percentile(latencies, 0.5) if count else None,
+        'p90_ms': 1000.0 * percentile(latencies, 0.9) if count else None,
+        'p99_ms': 1000.0 * percentile(latencies, 0.99) if count else None,
+        'max_ms': 1000.0 * latencies[-1] if count else None
+    }
+
+
+def measure(function, calls):
+    '''
+    Calls function for every item of calls sequentially.
+    Returns: summary of latencies
+    '''
+    latencies = []
+    started = time.time()
+    for args in calls:
+        call_started = time.time()
+        function(*args)
+        latencies.append(time.time() - call_started)
+
+    return summarize(latencies, time.time() - started)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=PATH_TO_BENCHMARKS_DIR,
+            stderr=open(os.devnull, 'w')
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Environment(object):
+    '''
+    Temporary directory with config, sqlite database and
+    stand-in of GridFS which NovaMimic is created over.
+    '''
+    def __init__(self, options):
+        self.options = options
+        self.workdir = tempfile.mkdtemp(prefix='vms_manager_benchmark.')
+        self.path_to_config = os.path.join(self.workdir, 'config.ini')
+        self.saved_paths = None
+
+        self.nova_mimic = None
+        self.grfs = FileGridFS(os.path.join(self.workdir, 'gridfs'))
+        self.image_ids = []
+
+    def setup(self):
+        for name in ('image_storage', 'instance_storage'):
+            os.mkdir(os.path.join(self.workdir, name))
+
+        with open(self.path_to_config, 'w') as f:
+            f.write(
+                CONFIG % {
+                    'workdir': self.workdir,
+                    'pattern': os.path.join(
+                        PATH_TO_BENCHMARKS_DIR,
+                        'domain_pattern.xml'
+                    ),
+                    'libvirt_pool_size': max(self.options.concurrency),
+                    'hosts': ','.join(
+                        'host-%s=test:///default' % i
+                        for i in range(self.options.hosts)
+                    )
+                }
+            )
+
+        self.saved_paths = (
+            src.nova_mimic.PATH_TO_GLOBAL_CONFIG,
+            src.utils.engine_factory.PATH_TO_GLOBAL_CONFIG
+        )
+        src.nova_mimic.PATH_TO_GLOBAL_CONFIG = self.path_to_config
+        src.utils.engine_factory.PATH_TO_GLOBAL_CONFIG = self.path_to_config
+        dispose_engines()
+
+        Base.metadata.create_all(get_engine())
+
+        #every image is downloaded once by cold benchmark,
+        #the last one is used by boots
+        #images usually have long runs of zeros
+        zeros = int(self.options.image_size * self.options.zero_fraction)
+        data = os.urandom(self.options.image_size - zeros) + '\0' * zeros
+        with contexted_session() as s:
+            s.add(Flavor(id=1, name='benchmark', vcpu=1, memory=524288))
+            for i in range(self.options.cold_images + 1):
+                image_id = str(self.grfs.put(data))
+                s.add(
+                    Image(
+                        id=image_id,
+                        name='benchmark-%s' % i,
+                        fmt='raw',
+                        size=len(data)
+                    )
+                )
+                self.image_ids.append(image_id)
+
+        self.nova_mimic = src.nova_mimic.NovaMimic()
+        self.nova_mimic.grfs = self.grfs
+
+    def teardown(self):
+        if self.nova_mimic is not None:
+            self.nova_mimic.close()
+
+        dispose_engines()
+        if self.saved_paths is not None:
+            src.nova_mimic.PATH_TO_GLOBAL_CONFIG, \
+                src.utils.engine_factory.PATH_TO_GLOBAL_CONFIG = self.saved_paths
+
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def bench_xml_processing(nova_mimic, options):
+    return measure(
+        nova_mimic._xml_processing,
+        [
+            (
+                'instance-%s' % i,
+                '522700a8a063d875c192d818',
+                524288,
+                1,
+                '52:54:00:00:00:01'
+            )
+            for i in range(options.iterations)
+        ]
+    )
+
+
+def bench_image_processing_cold(nova_mimic, image_ids):
+    return measure(
+        nova_mimic._image_processing,
+        [(image_id,) for image_id in image_ids]
+    )
+
+
+def bench_image_processing_warm(nova_mimic, image_id, options):
+    nova_mimic._image_processing(image_id)
+
+    return measure(
+        nova_mimic._image_processing,
+        [(image_id,)] * options.iterations
+    )
+
+
+def _reserve(nova_mimic, count):
+    with contexted_session() as s:
+        nova_mimic.mac_allocator.reserve(s, count)
+
+
+def bench_mac_allocation(nova_mimic, count, options):
+    summary = measure(
+        _reserve,
+        [(nova_mimic, count)] * (options.iterations // count or 1)
+    )
+    summary['addresses_per_second'] = \
+        summary['ops_per_second'] * count if summary['ops_per_second'] else None
+
+    return summary
+
+
+def bench_instance_boot(nova_mimic, image_id, concurrency, options):
+    '''
+    Boots options.boots instances by concurrency threads,
+    booted instances are destroyed afterwards.
+    '''
+    latencies = []
+    instance_ids = []
+
+    def boot(i):
+        started = time.time()
+        instance_ids.append(
+            nova_mimic.instance_boot(
+                'benchmark-%s-%s' % (concurrency, i),
+                image_id,
+                1
+            )
+        )
+        latencies.append(time.time() - started)
+
+    #image is downloaded before measurement
+    nova_mimic._image_processing(image_id)
+
+    started = time.time()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [
+            executor.submit(boot, i) for i in range(options.boots)
+        ]:
+            future.result()
+    summary = summarize(latencies, time.time() - started)
+    summary['concurrency'] = concurrency
+
+    for future in nova_mimic.instance_destroy(instance_ids):
+        future.result()
+
+    return summary
+
+
+def bench_placement(strategy, options):
+    '''
+    Places options.iterations instances on options.placement_hosts
+    hosts (flavors and images are random), placed instances
+    are released afterwards.
+    '''
+    scheduler = Scheduler(strategy)
+    for i in range(options.placement_hosts):
+        scheduler.add_host('host-%s' % i, 256 * 1024 * 1024, 64)
+
+    generator = random.Random(0)
+    calls = [
+        (
+            'instance-%s' % i,
+            generator.choice([1, 2, 4, 8]) * 1024 * 1024,
+            generator.choice([1, 2, 4]),
+            'image-%s' % generator.randint(0, 20)
+        )
+        for i in range(options.iterations)
+    ]
+
+    summary = measure(scheduler.claim, calls)
+    summary['hosts'] = options.placement_hosts
+
+    for call in calls:
+        scheduler.release(call[0])
+
+    return summary
+
+
+def run(options):
+    environment = Environment(options)
+    results = {}
+    stages = {}
+    image_cache = {}
+    scheduler = {}
+
+    try:
+        environment.setup()
+        nova_mimic = environment.nova_mimic
+        cold_images = environment.image_ids[:-1]
+        boot_image = environment.image_ids[-1]
+
+        results['xml_processing'] = bench_xml_processing(nova_mimic, options)
+        results['image_processing_cold'] = \
+            bench_image_processing_cold(nova_mimic, cold_images)
+        results['image_processing_warm'] = \
+            bench_image_processing_warm(nova_mimic, cold_images[0], options)
+        results['mac_allocation_single'] = \
+            bench_mac_allocation(nova_mimic, 1, options)
+        results['mac_allocation_batch'] = \
+            bench_mac_allocation(nova_mimic, options.mac_batch, options)
+
+        for concurrency in options.concurrency:
+            results['instance_boot_c%s' % concurrency] = \
+                bench_instance_boot(nova_mimic, boot_image, concurrency, options)
+
+        for strategy in sorted(STRATEGIES):
+            results['placement_%s' % strategy] = \
+                bench_placement(strategy, options)
+
+        #durations of stages of all boots (see src.tracing)
+        stages = nova_mimic.tracer.statistics()
+        image_cache = nova_mimic.image_cache.statistics()
+        scheduler = nova_mimic.scheduler.statistics()
+    finally:
+        environment.teardown()
+
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': vars(options)
+        },
+        'results': results,
+        'stages': stages,
+        'image_cache': image_cache,
+        'scheduler': scheduler
+    }
+
+
+def compare(report, baseline):
+    '''
+    Returns: lines with relative change of throughput and p99 latency
+    '''
+    lines = []
+    for name, result in sorted(report['results'].items()):
+        old = baseline['results'].get(name)
+        if old is None:
+            lines.append('%-28s new' % name)
+            continue
+
+        changes = []
+        for key in ('ops_per_second', 'p99_ms'):
+            if result.get(key) and old.get(key):
+                changes.append(
+                    '%s %+.1f%%' % (key, 100.0 * (result[key] / old[key] - 1))
+                )
+        lines.append('%-28s %s' % (name, ', '.join(changes)))
+
+    return lines
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '-o', '--output', default='benchmark.json',
+        help='path to json file with results'
+    )
+    parser.add_argument(
+        '--baseline',
+        help='json file of previous run to compare results with'
+    )
+    parser.add_argument(
+        '--iterations', type=int, default=1000,
+        help='number of calls of fast stages'
+    )
+    parser.add_argument(
+        '--boots', type=int, default=50,
+        help='number of instances booted per level of concurrency'
+    )
+    parser.add_argument(
+        '--concurrency', type=lambda value: map(int, value.split(',')),
+        default=[1, 4, 16],
+        help='comma separated levels of concurrency of boots'
+    )
+    parser.add_argument(
+        '--cold-images', type=int, default=5,
+        help='number of images downloaded by cold benchmark'
+    )
+    parser.add_argument(
+        '--image-size', type=int, default=16 * 1024 * 1024,
+        help='size of images in bytes'
+    )
+    parser.add_argument(
+        '--zero-fraction', type=float, default=0.5,
+        help='part of image which consists of zeros'
+    )
+    parser.add_argument(
+        '--hosts', type=int, default=2,
+        help='number of hosts instances are booted on'
+    )
+    parser.add_argument(
+        '--placement-hosts', type=int, default=500,
+        help='number of hosts of placement benchmark'
+    )
+    parser.add_argument(
+        '--mac-batch', type=int, default=100,
+        help='number of mac addresses reserved per transaction'
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    report = run(options)
+
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    for name, result in sorted(report['results'].items()):
+        print '%-28s %8.1f ops/s  p50 %8.3f ms  p99 %8.3f ms' % (
+            name,
+            result['ops_per_second'] or 0,
+            result['p50_ms'] or 0,
+            result['p99_ms'] or 0
+        )
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        print
+        print 'compared with %s:' % (baseline['meta'].get('revision'),)
+        for line in compare(report, baseline):
+            print line
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides filesystem-backed stand-in for GridFS.
+
+Files are kept in directory, one file per id, and are read through
+objects with the same interface that NovaMimic uses of GridOut
+(length attribute and read method), so downloads of images can be
+measured without MongoDB.
+'''
+
+import os
+import os.path
+
+from bson.objectid import ObjectId
+from gridfs.errors import NoFile
+
+
+class FileGridOut(object):
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.length = os.fstat(self.file.fileno()).st_size
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        if not data:
+            self.file.close()
+        return data
+
+
+class FileGridFS(object):
+    def __init__(self, path_to_storage):
+        self.path_to_storage = path_to_storage
+        if not os.path.isdir(path_to_storage):
+            os.makedirs(path_to_storage)
+
+    def _path(self, file_id):
+        return os.path.join(self.path_to_storage, str(file_id))
+
+    def put(self, data):
+        '''
+        Returns: ObjectId of stored file
+        '''
+        file_id = ObjectId()
+        with open(self._path(file_id), 'wb') as f:
+            f.write(data)
+
+        return file_id
+
+    def get(self, file_id):
+        path = self._path(file_id)
+        if not os.path.exists(path):
+            raise NoFile("no file in gridfs with _id %s" % file_id)
+
+        return FileGridOut(path)
@@ -1,7 +1,7 @@
 #!/usr/bin python
 # -*- coding: utf-8 -*-
 
-import libvirt
+from src.libvirt_pool import LibvirtConnectionPool
 
 
 class LVWrapper():
@@ -9,11 +9,11 @@ class LVWrapper():
     def __init__(self):
         # pool of domains that are managing
         self.domains_pool = {}
-        self.libvirt_connection = libvirt.open("qemu:///system")
+        self.libvirt_pool = LibvirtConnectionPool("qemu:///system")
 
     def get_domain_list(self):
         # display list of domains
-        print self.libvirt_connection.listDefinedDomains()
+        print self.libvirt_pool.call('listDefinedDomains')
 
     def register_domain(self):
         pass
@@ -21,7 +21,7 @@ class LVWrapper():
     def boot_domain(self, domain_name):
         # boot domain with given name
         # returns id of booted domain
-        domain = self.libvirt_connection.lookupByName(domain_name)
+        domain = self.libvirt_pool.call('lookupByName', domain_name)
         domain.create()
 
         self.domains_pool[domain_name] = domain
@@ -46,5 +46,5 @@ class LVWrapper():
         return return_code
 
     def clean_up(self):
-        # closes connection to libvirt driver
-        self.libvirt_connection.close()
+        # closes connections to libvirt driver
+        self.libvirt_pool.close()
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides bookkeeping of local image storage directory.
+
+Every image that is downloaded from key-value storage is registered
+in ImageCache object with its size. When total size of images
+exceeds configured limit least recently used (or least frequently used)
+images are removed from disk. Images which are referenced by running
+instances are never removed.
+
+Cache also counts hits, misses and evictions so that efficiency of
+chosen limit and policy can be checked.
+
+Images are kept as sparse files, so budget is spent by bytes which are
+allocated on disk, logical sizes of images are reported separately.
+
+Checksum file of image (see src.image_integrity) is removed with it.
+'''
+
+import os
+import os.path
+import time
+import threading
+from collections import OrderedDict, Counter
+
+from src.image_integrity import checksum_path
+
+
+class ImageCacheError(Exception):
+    pass
+
+
+def file_sizes(path):
+    '''
+    Returns: (logical size, number of bytes allocated on disk)
+    '''
+    stat = os.stat(path)
+    return stat.st_size, stat.st_blocks * 512
+
+
+class CacheEntry(object):
+    def __init__(self, size, last_used=None, logical_size=None):
+        #bytes allocated on disk
+        self.size = size
+        self.logical_size = size if logical_size is None else logical_size
+        self.hits = 0
+        self.last_used = last_used or time.time()
+
+
+class ImageCache(object):
+    POLICIES = ('lru', 'lfu')
+
+    def __init__(self, path_to_image_storage, size_limit=0, policy='lru'):
+        '''
+        size_limit is budget of image storage in bytes, 0 means
+        that cache is not limited.
+        '''
+        if policy not in self.POLICIES:
+            raise ImageCacheError("Unknown eviction policy: %s" % policy)
+
+        self.path_to_image_storage = path_to_image_storage
+        self.size_limit = size_limit
+        self.policy = policy
+
+        #key - image id, value - CacheEntry. Order of keys is order
+        #of usage: least recently used image is first
+        self.entries = OrderedDict()
+        #key - image id, value - number of running instances
+        #which use image
+        self.references = Counter()
+        self.used_bytes = 0
+        self.logical_bytes = 0
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'evicted_bytes': 0
+        }
+
+        self.lock = threading.RLock()
+
+        self._scan()
+
+    def _scan(self):
+        '''
+        Registers images that are already present in
+        image storage directory. Hidden files (temporary files
+        of unfinished downloads) are skipped.
+        '''
+        if not os.path.isdir(self.path_to_image_storage):
+            return
+
+        found = []
+        for name in os.listdir(self.path_to_image_storage):
+            if name.startswith('.'):
+                continue
+
+            path = os.path.join(self.path_to_image_storage, name)
+            if not os.path.isfile(path):
+                continue
+
+            stat = os.stat(path)
+            found.append(
+                (stat.st_atime, name, stat.st_blocks * 512, stat.st_size)
+            )
+
+        #oldest access time goes first
+        for atime, name, size, logical_size in sorted(found):
+            self._add_entry(name, size, atime, logical_size)
+
+    def _add_entry(self, image_id, size, last_used=None, logical_size=None):
+        if image_id in self.entries:
+            self._remove_entry(image_id)
+
+        entry = CacheEntry(size, last_used, logical_size)
+        self.entries[image_id] = entry
+        self.used_bytes += entry.size
+        self.logical_bytes += entry.logical_size
+
+    def _remove_entry(self, image_id):
+        entry = self.entries.pop(image_id)
+        self.used_bytes -= entry.size
+        self.logical_bytes -= entry.logical_size
+        return entry
+
+    def _path(self, image_id):
+        return os.path.join(self.path_to_image_storage, image_id)
+
+    def _remove_files(self, image_id):
+        path = self._path(image_id)
+        for path in (path, checksum_path(path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def lookup(self, image_id, record_stats=True):
+        '''
+        Returns True if image is present in local image storage
+        and marks it as recently used. Image file that was placed
+        into storage directory by hand (or downloaded by another
+        process) is registered on first lookup.
+
+        record_stats=False is used for repeated lookup of the same
+        request, so it is not counted twice.
+        '''
+        with self.lock:
+            path = self._path(image_id)
+            entry = self.entries.get(image_id)
+
+            if entry is None and os.path.isfile(path):
+                logical_size, size = file_sizes(path)
+                self._add_entry(image_id, size, logical_size=logical_size)
+                entry = self.entries[image_id]
+            elif entry is not None and not os.path.isfile(path):
+                #file was removed behind our back
+                self._remove_entry(image_id)
+                entry = None
+
+            if entry is None:
+                if record_stats:
+                    self.stats['misses'] += 1
+                return False
+
+            if record_stats:
+                self.stats['hits'] += 1
+            entry.hits += 1
+            entry.last_used = time.time()
+            #move entry to the end of usage order
+            self.entries[image_id] = self.entries.pop(image_id)
+
+            return True
+
+    def contains(self, image_id):
+        '''
+        Returns True if image is registered and present on disk.
+        Unlike lookup does not count hit or change usage order.
+        '''
+        with self.lock:
+            return image_id in self.entries and \
+                os.path.isfile(self._path(image_id))
+
+    def images(self):
+        '''
+        Returns: list of ids of registered images in order of usage
+        '''
+        with self.lock:
+            return list(self.entries)
+
+    def discard(self, image_id, references=0):
+        '''
+        Removes image (e.g. corrupted one) from local image storage
+        unless it is referenced by running instances. references is
+        number of references held by caller itself, they do not keep
+        image.
+
+        Returns: True if image was removed
+        '''
+        with self.lock:
+            if self.references[image_id] > references:
+                return False
+
+            if image_id in self.entries:
+                self._remove_entry(image_id)
+            self._remove_files(image_id)
+
+            return True
+
+    def fits(self, size):
+        '''
+        Returns True if image of given size can be added
+        without eviction of other images.
+        '''
+        with self.lock:
+            return not self.size_limit or \
+                self.used_bytes + size <= self.size_limit
+
+    def add(self, image_id, size, logical_size=None):
+        '''
+        Registers freshly downloaded image and evicts other
+        images if limit is exceeded. size is number of bytes
+        allocated on disk.
+        '''
+        with self.lock:
+            self._add_entry(image_id, size, logical_size=logical_size)
+            self._evict(0, keep=image_id)
+
+    def reserve(self, size):
+        '''
+        Makes room for image of given size before it is downloaded.
+        '''
+        with self.lock:
+            self._evict(size)
+
+    def acquire(self, image_id):
+        with self.lock:
+            self.references[image_id] += 1
+
+    def release(self, image_id):
+        with self.lock:
+            self.references[image_id] -= 1
+            if self.references[image_id] <= 0:
+                del self.references[image_id]
+
+    def set_references(self, references):
+        '''
+        Replaces reference counts by counts taken from
+        running instances (mapping image id -> number of instances).
+        '''
+        with self.lock:
+            self.references = Counter(references)
+
+    def _candidates(self):
+        if self.policy == 'lru':
+            return list(self.entries)
+
+        return sorted(
+            self.entries,
+            key=lambda image_id: (
+                self.entries[image_id].hits,
+                self.entries[image_id].last_used
+            )
+        )
+
+    def _evict(self, required, keep=None):
+        '''
+        Removes unreferenced images until there is room
+        for required bytes.
+        '''
+        if not self.size_limit:
+            return
+
+        for image_id in self._candidates():
+            if self.used_bytes + required <= self.size_limit:
+                break
+
+            if image_id == keep or self.references[image_id] > 0:
+                continue
+
+            entry = self._remove_entry(image_id)
+            self._remove_files(image_id)
+
+            self.stats['evictions'] += 1
+            self.stats['evicted_bytes'] += entry.size
+
+    def statistics(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats.update(
+                {
+                    'images': len(self.entries),
+                    'used_bytes': self.used_bytes,
+                    'logical_bytes': self.logical_bytes,
+                    'size_limit': self.size_limit,
+                    'referenced': len(self.references)
+                }
+            )
+            return stats
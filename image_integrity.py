@@ -0,0 +1,335 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides verification of images in local image storage.
+
+sha256 of image is computed while image is downloaded (see
+NovaMimic._download_image) and is kept in hidden checksum file
+.<name of image>.checksum next to image together with size and mtime
+of image file. On boot image is checked cheaply: size and mtime of
+file are compared with checksum file. Content is re-hashed only when
+they differ (or checksum file is absent) and by background scrubber,
+which reads cached images with limited bandwidth.
+
+Images named by sha256 of their content (see src.utils.image_ingest)
+are compared with their names, so even image without checksum file
+is verified.
+
+Image which is booted without overlay is written by its guest, so
+its content is not expected to match any more: such image is marked
+as written in its checksum file and is not verified until it is
+downloaded again.
+'''
+
+import os
+import os.path
+import re
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+
+from src.token_bucket import TokenBucket
+
+LOG = logging.getLogger(__name__)
+
+CHECKSUM_SUFFIX = '.checksum'
+#size of piece of image which is hashed at once
+HASH_BLOCK_SIZE = 1024 * 1024
+
+SHA256_PATTERN = re.compile('^[0-9a-f]{64}$')
+
+
+class ImageIntegrityError(Exception):
+    pass
+
+
+class ScrubCancelled(Exception):
+    pass
+
+
+def checksum_path(path_to_image):
+    storage_dir, image_name = os.path.split(path_to_image)
+    return os.path.join(storage_dir, '.%s%s' % (image_name, CHECKSUM_SUFFIX))
+
+
+def expected_sha256(image_key):
+    '''
+    Returns: sha256 of content if image is named by it, otherwise None
+    '''
+    return image_key if SHA256_PATTERN.match(image_key) else None
+
+
+def write_checksum(path_to_image, sha256, written=False):
+    '''
+    Saves sha256 with current size and mtime of image file,
+    written is True for image which was booted without overlay.
+    Checksum file is replaced atomically.
+    '''
+    stat = os.stat(path_to_image)
+    storage_dir = os.path.dirname(path_to_image)
+
+    fd, path_to_tmp = tempfile.mkstemp(
+        prefix='.checksum.',
+        suffix='.part',
+        dir=storage_dir
+    )
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(
+                {
+                    'sha256': sha256,
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime,
+                    'written': written
+                },
+                f
+            )
+        os.rename(path_to_tmp, checksum_path(path_to_image))
+    except:
+        if os.path.exists(path_to_tmp):
+            os.remove(path_to_tmp)
+        raise
+
+
+def read_checksum(path_to_image):
+    '''
+    Returns: dict with sha256, size and mtime or None if checksum
+    file is absent or broken
+    '''
+    try:
+        with open(checksum_path(path_to_image)) as f:
+            checksum = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if not isinstance(checksum, dict) or \
+            not set(['sha256', 'size', 'mtime']) <= set(checksum):
+        return None
+
+    return checksum
+
+
+def file_sha256(path, bucket=None, cancelled=None,
+                block_size=HASH_BLOCK_SIZE):
+    '''
+    Hashes file block by block, every block is paid by tokens
+    of bucket (if it is given). Hashing is interrupted as soon as
+    cancelled event is set.
+
+    Returns: hex sha256 of content
+    '''
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        while True:
+            if cancelled is not None and cancelled.is_set():
+                raise ScrubCancelled()
+
+            block = f.read(block_size)
+            if not block:
+                break
+
+            digest.update(block)
+            if bucket is not None:
+                bucket.consume(len(block))
+
+    return digest.hexdigest()
+
+
+class ImageVerifier(object):
+    def __init__(self, path_to_image_storage):
+        self.path_to_image_storage = path_to_image_storage
+
+        self.stats = {
+            'verified': 0,
+            'rehashed': 0,
+            'corrupted': 0
+        }
+        #key - image key, value - (inode, size, mtime) of file which
+        #was found corrupted, it is not re-hashed until it is changed
+        self.corrupted = {}
+        self.lock = threading.Lock()
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def mark_written(self, image_key):
+        '''
+        Marks image which is booted without overlay, so it is not
+        verified any more.
+        '''
+        path_to_image = os.path.join(self.path_to_image_storage, image_key)
+        checksum = read_checksum(path_to_image)
+        if checksum is not None and checksum.get('written'):
+            return
+
+        write_checksum(
+            path_to_image,
+            checksum['sha256'] if checksum else expected_sha256(image_key),
+            written=True
+        )
+
+    def is_written(self, image_key):
+        checksum = read_checksum(
+            os.path.join(self.path_to_image_storage, image_key)
+        )
+        return checksum is not None and bool(checksum.get('written'))
+
+    def verify(self, image_key, full=False, bucket=None, cancelled=None):
+        '''
+        Checks image with given name in local image storage.
+
+        Size and mtime of file are compared with checksum file,
+        content is re-hashed only if they differ or full is True.
+        Image which has no known checksum is trusted, its checksum
+        is saved. Image written by guest is not checked.
+
+        Returns: True if image is intact
+        '''
+        path_to_image = os.path.join(self.path_to_image_storage, image_key)
+        checksum = read_checksum(path_to_image)
+        if checksum is not None and checksum.get('written'):
+            return True
+        expected = expected_sha256(image_key)
+        if expected is None and checksum is not None:
+            expected = checksum['sha256']
+
+        stat = os.stat(path_to_image)
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime)
+        if not full and self.corrupted.get(image_key) == signature:
+            return False
+
+        if not full and checksum is not None and \
+                checksum['sha256'] == expected and \
+                checksum['size'] == stat.st_size and \
+                checksum['mtime'] == stat.st_mtime:
+            self._count('verified')
+            return True
+
+        sha256 = file_sha256(path_to_image, bucket, cancelled)
+        self._count('rehashed')
+
+        if expected is not None and sha256 != expected:
+            with self.lock:
+                self.corrupted[image_key] = signature
+            self._count('corrupted')
+            return False
+
+        with self.lock:
+            self.corrupted.pop(image_key, None)
+
+        #file was touched, but content is the same
+        write_checksum(path_to_image, sha256)
+        self._count('verified')
+        return True
+
+
+class ImageScrubber(object):
+    def __init__(self, nova_mimic, interval=86400, bandwidth=0):
+        '''
+        Every interval seconds re-hashes all cached images.
+        bandwidth is limit of reads in bytes per second,
+        0 means that reads are not throttled.
+        '''
+        self.nova_mimic = nova_mimic
+        self.interval = interval
+        self.bucket = TokenBucket(bandwidth)
+
+        self.stats = {
+            'scrubbed': 0,
+            'scrubbed_bytes': 0,
+            'skipped': 0,
+            'corrupted': 0,
+            'removed': 0
+        }
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def scrub(self, image_key):
+        '''
+        Re-hashes image, corrupted image is removed from local image
+        storage unless it is used by running instances.
+
+        Returns: True if image is intact
+        '''
+        nova_mimic = self.nova_mimic
+        image_cache = nova_mimic.image_cache
+
+        #guests write to images they boot from without overlays
+        if not nova_mimic.use_overlays and (
+                image_cache.references[image_key] > 0 or
+                nova_mimic.image_verifier.is_written(image_key)):
+            self.stats['skipped'] += 1
+            return True
+
+        path_to_image = os.path.join(
+            nova_mimic.path_to_image_storage,
+            image_key
+        )
+        size = os.stat(path_to_image).st_size
+
+        #image is not locked while it is hashed,
+        #so boots are not blocked by slow read
+        intact = nova_mimic.image_verifier.verify(
+            image_key,
+            full=True,
+            bucket=self.bucket,
+            cancelled=self.stopped
+        )
+        self.stats['scrubbed'] += 1
+        self.stats['scrubbed_bytes'] += size
+
+        if intact:
+            return True
+
+        self.stats['corrupted'] += 1
+        with nova_mimic.image_downloads.lock(image_key):
+            if image_cache.discard(image_key):
+                self.stats['removed'] += 1
+                LOG.error("Corrupted image %s was removed", image_key)
+            else:
+                LOG.error(
+                    "Corrupted image %s is used by running instances",
+                    image_key
+                )
+
+        return False
+
+    def scrub_once(self):
+        for image_key in self.nova_mimic.image_cache.images():
+            if self.stopped.is_set():
+                break
+
+            try:
+                self.scrub(image_key)
+            except ScrubCancelled:
+                break
+            except (IOError, OSError):
+                #image was evicted meanwhile
+                LOG.exception("Failed to scrub image %s", image_key)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.scrub_once()
+            except Exception:
+                LOG.exception("Failed to scrub images")
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._run,
+            name='image-scrubber'
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides background prefetching of images into local image storage.
+
+Images are ranked by number of instances booted from them during last
+window_hours (instance table keeps time of boot), images pinned in
+config go first. Every interval seconds prefetcher downloads top
+ranked images which are absent in local storage, so boots from popular
+images find them in cache.
+
+Downloads are throttled by token bucket to given bandwidth and never
+evict images from cache: image which does not fit into free part of
+budget of image storage is skipped. Lock of downloads of image is
+taken only to publish downloaded file, so boot which needs image
+meanwhile downloads it at full speed and prefetched copy is dropped.
+'''
+
+import os
+import os.path
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from sqlalchemy import func
+
+from src.database_toolkit import Instance, contexted_session
+from src.token_bucket import TokenBucket
+
+LOG = logging.getLogger(__name__)
+
+
+class PrefetchCancelled(Exception):
+    pass
+
+
+class ThrottledReader(object):
+    '''
+    Wraps gridfs output object, every read chunk is paid by tokens.
+    Reading is interrupted as soon as cancelled event is set.
+    '''
+    def __init__(self, grout, bucket, cancelled=None):
+        self.grout = grout
+        self.bucket = bucket
+        self.cancelled = cancelled
+        self.length = grout.length
+
+    def read(self, size=-1):
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise PrefetchCancelled()
+
+        data = self.grout.read(size)
+        self.bucket.consume(len(data))
+        return data
+
+
+class ImagePrefetcher(object):
+    def __init__(self, nova_mimic, pinned=(), top=10, window_hours=24,
+                 interval=300, bandwidth=0):
+        '''
+        bandwidth is limit of downloads in bytes per second,
+        0 means that downloads are not throttled.
+        '''
+        self.nova_mimic = nova_mimic
+        self.pinned = list(pinned)
+        self.top = top
+        self.window_hours = window_hours
+        self.interval = interval
+        self.bucket = TokenBucket(bandwidth)
+
+        #ids of images of the last ranking
+        self.ranked = []
+        self.stats = {
+            'prefetched': 0,
+            'prefetched_bytes': 0,
+            'skipped': 0,
+            'failed': 0
+        }
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def rank(self):
+        '''
+        Returns: list of ids of images, pinned first and then most
+        popular during last window_hours
+        '''
+        since = datetime.utcnow() - timedelta(hours=self.window_hours)
+        boots = func.count(Instance.id)
+
+        with contexted_session() as s:
+            popular = [
+                image_id for image_id, _ in
+                s.query(Instance.image_id, boots)
+                 .filter(Instance.created_at >= since)
+                 .filter(Instance.image_id != None)
+                 .group_by(Instance.image_id)
+                 .order_by(boots.desc(), Instance.image_id)
+                 .limit(self.top)
+            ]
+
+        return self.pinned + [
+            image_id for image_id in popular if image_id not in self.pinned
+        ]
+
+    def prefetch(self, image_id):
+        '''
+        Downloads image if it is absent in local image storage
+        and fits into free part of its budget.
+
+        Returns: True if image was downloaded
+        '''
+        nova_mimic = self.nova_mimic
+        image_cache = nova_mimic.image_cache
+        #images with the same content share one file
+        image_key = nova_mimic._image_keys([image_id])[image_id]
+
+        if image_cache.contains(image_key):
+            return False
+
+        grout = nova_mimic.grfs.get(ObjectId(image_id))
+        if not image_cache.fits(grout.length):
+            self.stats['skipped'] += 1
+            return False
+
+        path_to_image = os.path.join(
+            nova_mimic.path_to_image_storage,
+            image_key
+        )
+        #image is downloaded without lock of its downloads, so boot
+        #of the same image is not slowed down to bandwidth of
+        #prefetcher, it downloads image itself
+        with nova_mimic.tracer.span('image_prefetch', image=image_id):
+            path_to_tmp, logical_size, allocated_size, sha256 = \
+                nova_mimic._fetch_image(
+                    ThrottledReader(grout, self.bucket, self.stopped),
+                    path_to_image
+                )
+
+        try:
+            with nova_mimic.image_downloads.lock(image_key):
+                #image could be downloaded by boot meanwhile
+                if image_cache.contains(image_key) or \
+                        image_cache.lookup(image_key, record_stats=False):
+                    return False
+
+                nova_mimic._publish_image(path_to_tmp, path_to_image, sha256)
+                image_cache.add(image_key, allocated_size, logical_size)
+        finally:
+            if os.path.exists(path_to_tmp):
+                os.remove(path_to_tmp)
+
+        self.stats['prefetched'] += 1
+        self.stats['prefetched_bytes'] += logical_size
+
+        return True
+
+    def run_once(self):
+        '''
+        Ranks images and prefetches those which are cold.
+        '''
+        self.ranked = self.rank()
+
+        for image_id in self.ranked:
+            if self.stopped.is_set():
+                break
+
+            try:
+                self.prefetch(image_id)
+            except PrefetchCancelled:
+                break
+            except Exception:
+                self.stats['failed'] += 1
+                LOG.exception("Failed to prefetch image %s", image_id)
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                #database is not available, next attempt is made later
+                LOG.exception("Failed to rank images")
+
+            if self.stopped.wait(self.interval):
+                break
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._run,
+            name='image-prefetcher'
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def status(self):
+        '''
+        Returns: dict with lists of ids of ranked images which are
+        present in local image storage (warm) and absent (cold),
+        and counters of prefetcher
+        '''
+        image_cache = self.nova_mimic.image_cache
+        ranked = list(self.ranked)
+        keys = self.nova_mimic._image_keys(ranked) if ranked else {}
+        warm = [
+            image_id for image_id in ranked
+            if image_cache.contains(keys[image_id])
+        ]
+
+        status = dict(self.stats)
+        status.update(
+            {
+                'warm': warm,
+                'cold': [
+                    image_id for image_id in ranked if image_id not in warm
+                ]
+            }
+        )
+        return status
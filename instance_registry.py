@@ -0,0 +1,277 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides in-memory registry of instances managed by NovaMimic.
+
+Every instance is described by InstanceRecord and can be found
+in constant time by uuid of domain, name, mac address or state.
+
+On start registry is rebuilt by one pass: one query to instance
+table (joined with mac_address_pool) and one call of libvirt driver
+per host which returns all domains of host with their states.
+After that it is kept consistent by NovaMimic, which adds, removes
+and updates records on every lifecycle operation.
+'''
+
+import logging
+import threading
+from collections import defaultdict
+
+import libvirt
+
+from src.database_toolkit import Instance, MacAddress
+
+LOG = logging.getLogger(__name__)
+
+
+class InstanceRecord(object):
+    __slots__ = ('id', 'name', 'mac_address', 'state', 'image_id', 'domain',
+                 'host', 'transitions')
+
+    def __init__(self, id, name, mac_address=None, state=None,
+                 image_id=None, domain=None, host=None):
+        self.id = id
+        self.name = name
+        self.mac_address = mac_address
+        #state of domain, one of libvirt VIR_DOMAIN_* constants
+        self.state = state
+        self.image_id = image_id
+        #libvirt domain object, None if there is no such domain
+        self.domain = domain
+        #name of libvirt host of domain (see src.scheduler)
+        self.host = host
+        #number of changes of state and reboots seen since record
+        #was created, operation which does not change state (reboot)
+        #waits until it grows (see StateWaiter)
+        self.transitions = 0
+
+
+class InstanceRegistry(object):
+    def __init__(self):
+        self.by_id = {}
+        self.by_name = {}
+        self.by_mac = {}
+        #key - state, value - set of ids of instances
+        self.by_state = defaultdict(set)
+
+        self.lock = threading.RLock()
+        #notified on every change of registry (see StateWaiter)
+        self.changed = threading.Condition(self.lock)
+
+    def _index(self, record):
+        self.by_id[record.id] = record
+        self.by_name[record.name] = record
+        if record.mac_address:
+            self.by_mac[record.mac_address] = record
+        self.by_state[record.state].add(record.id)
+
+    def _unindex(self, record):
+        del self.by_id[record.id]
+        if self.by_name.get(record.name) is record:
+            del self.by_name[record.name]
+        if record.mac_address and self.by_mac.get(record.mac_address) is record:
+            del self.by_mac[record.mac_address]
+        self.by_state[record.state].discard(record.id)
+
+    def add(self, record):
+        with self.lock:
+            if record.id in self.by_id:
+                self._unindex(self.by_id[record.id])
+            self._index(record)
+            self.changed.notify_all()
+
+    def remove(self, instance_id):
+        '''
+        Returns: removed record or None
+        '''
+        with self.lock:
+            record = self.by_id.get(instance_id)
+            if record is not None:
+                self._unindex(record)
+                self.changed.notify_all()
+            return record
+
+    def update_state(self, instance_id, state):
+        '''
+        Returns: False if there is no such instance
+        '''
+        with self.lock:
+            record = self.by_id.get(instance_id)
+            if record is None:
+                return False
+
+            self.by_state[record.state].discard(instance_id)
+            record.state = state
+            record.transitions += 1
+            self.by_state[state].add(instance_id)
+            self.changed.notify_all()
+            return True
+
+    def mark_rebooted(self, instance_id):
+        '''
+        Registers reboot of guest, which does not change state of domain.
+
+        Returns: False if there is no such instance
+        '''
+        with self.lock:
+            record = self.by_id.get(instance_id)
+            if record is None:
+                return False
+
+            record.transitions += 1
+            self.changed.notify_all()
+            return True
+
+    def get(self, instance_id):
+        return self.by_id.get(instance_id)
+
+    def find_by_name(self, name):
+        return self.by_name.get(name)
+
+    def find_by_mac(self, mac_address):
+        return self.by_mac.get(mac_address)
+
+    def with_state(self, state):
+        with self.lock:
+            return [self.by_id[i] for i in self.by_state.get(state, ())]
+
+    def records(self):
+        with self.lock:
+            return self.by_id.values()
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def attach(self, host, all_stats):
+        '''
+        Links instances of host which have no domains (e.g. host was
+        unreachable when registry was rebuilt) to domains of host.
+        all_stats is result of getAllDomainStats of host, domains
+        which are unknown to registry are registered.
+
+        Returns: list of records which got domains
+        '''
+        attached = []
+        with self.lock:
+            for domain, stats in all_stats:
+                state = stats.get('state.state')
+                record = self.by_id.get(domain.UUIDString())
+                if record is None:
+                    record = InstanceRecord(
+                        domain.UUIDString(),
+                        domain.name(),
+                        state=state,
+                        domain=domain,
+                        host=host
+                    )
+                    self._index(record)
+                elif record.domain is None and record.host in (host, None):
+                    self.by_state[record.state].discard(record.id)
+                    record.domain = domain
+                    record.state = state
+                    record.host = host
+                    self.by_state[state].add(record.id)
+                else:
+                    continue
+
+                attached.append(record)
+
+            if attached:
+                self.changed.notify_all()
+
+        return attached
+
+    def rebuild(self, session, connections):
+        '''
+        Replaces content of registry by instances from database
+        and domains of libvirt connections. Domains which are unknown
+        to database are registered too.
+
+        connections is list of (name of host, connection) or one
+        connection of host without name. Host whose connection is None
+        or whose domains can not be listed is skipped, its instances
+        are registered without domains.
+
+        Returns: list of names of skipped hosts
+        '''
+        if not isinstance(connections, (list, tuple)):
+            connections = [(None, connections)]
+
+        rows = session.query(
+            Instance.id,
+            Instance.domain_name,
+            Instance.image_id,
+            Instance.host,
+            MacAddress.address
+        ).outerjoin(MacAddress, Instance.mac_addr == MacAddress.id)
+
+        #key - uuid, value - list of (host, domain, state) in order
+        #of connections, several hosts can share one driver
+        #(e.g. test:///default)
+        domains = {}
+        hosts = set(host for host, connection in connections)
+        skipped = []
+        for host, connection in connections:
+            if connection is None:
+                skipped.append(host)
+                continue
+
+            try:
+                all_stats = connection.getAllDomainStats(
+                    libvirt.VIR_DOMAIN_STATS_STATE
+                )
+            except libvirt.libvirtError:
+                LOG.exception("Failed to list domains of host %s", host)
+                skipped.append(host)
+                continue
+
+            for domain, stats in all_stats:
+                domains.setdefault(domain.UUIDString(), []).append(
+                    (host, domain, stats.get('state.state'))
+                )
+
+        records = []
+        for instance_id, name, image_id, host, mac_address in rows:
+            found = domains.pop(instance_id, [])
+            #domain is looked up on host instance was placed on (even if
+            #host was skipped), instances placed before hosts were saved
+            #or on hosts which are not configured are found anywhere
+            if host in hosts:
+                found = [item for item in found if item[0] == host]
+            host, domain, state = found[0] if found else (host, None, None)
+            records.append(
+                InstanceRecord(
+                    instance_id,
+                    name,
+                    mac_address,
+                    state,
+                    image_id,
+                    domain,
+                    host
+                )
+            )
+
+        for instance_id, found in domains.items():
+            host, domain, state = found[0]
+            records.append(
+                InstanceRecord(
+                    instance_id,
+                    domain.name(),
+                    state=state,
+                    domain=domain,
+                    host=host
+                )
+            )
+
+        with self.lock:
+            self.by_id.clear()
+            self.by_name.clear()
+            self.by_mac.clear()
+            self.by_state.clear()
+
+            for record in records:
+                self._index(record)
+
+            self.changed.notify_all()
+
+        return skipped
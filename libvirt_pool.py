@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides pool of connections to libvirt driver.
+
+Connections are opened on demand (not more than size at once) and
+are given to callers one per caller, so concurrent lifecycle
+operations do not serialize on single connection. Before connection
+is given out it is checked with isAlive: connection that was dropped
+(e.g. libvirtd was restarted) is closed and replaced by new one.
+
+If keepalive is enabled libvirt default event loop is started in
+background thread (keepalive messages are processed by it), so
+dead connections are detected even if they are idle.
+'''
+
+import threading
+from Queue import LifoQueue, Empty
+from contextlib import contextmanager
+
+import libvirt
+
+_event_loop_lock = threading.Lock()
+_event_loop_thread = None
+
+
+def _run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def start_event_loop():
+    '''
+    Registers libvirt default event loop implementation and runs
+    it in daemon thread. Has effect only for connections which are
+    opened after the call, repeated calls do nothing.
+    '''
+    global _event_loop_thread
+
+    with _event_loop_lock:
+        if _event_loop_thread is not None:
+            return
+
+        libvirt.virEventRegisterDefaultImpl()
+
+        _event_loop_thread = threading.Thread(
+            target=_run_event_loop,
+            name='libvirt-event-loop'
+        )
+        _event_loop_thread.daemon = True
+        _event_loop_thread.start()
+
+
+def is_alive(connection):
+    try:
+        return connection.isAlive() == 1
+    except libvirt.libvirtError:
+        return False
+
+
+def close_quietly(connection):
+    try:
+        connection.close()
+    except libvirt.libvirtError:
+        pass
+
+
+class LibvirtConnectionPool(object):
+    def __init__(self, uri='qemu:///system', size=4,
+                 keepalive_interval=5, keepalive_count=3):
+        '''
+        keepalive_interval is number of seconds between keepalive
+        messages, 0 disables keepalive. Connection is considered dead
+        after keepalive_count messages without answer.
+        '''
+        self.uri = uri
+        self.size = size
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+
+        #idle connections, most recently used is given out first
+        self.idle = LifoQueue()
+        #bounds number of connections which are in use
+        self.slots = threading.BoundedSemaphore(size)
+        self.closed = False
+
+    def _open(self):
+        if self.keepalive_interval:
+            start_event_loop()
+
+        connection = libvirt.open(self.uri)
+
+        if self.keepalive_interval:
+            try:
+                connection.setKeepAlive(
+                    self.keepalive_interval,
+                    self.keepalive_count
+                )
+            except libvirt.libvirtError:
+                #driver does not support keepalive (e.g. test:///default)
+                pass
+
+        return connection
+
+    def _get(self):
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except Empty:
+                return self._open()
+
+            if is_alive(connection):
+                return connection
+
+            close_quietly(connection)
+
+    @contextmanager
+    def connection(self):
+        '''
+        Gives connection for exclusive use inside of with block.
+        Connection which died while being used is not returned to pool.
+        '''
+        if self.closed:
+            raise libvirt.libvirtError("Pool of connections is closed")
+
+        self.slots.acquire()
+        try:
+            connection = self._get()
+            try:
+                yield connection
+            finally:
+                if is_alive(connection) and not self.closed:
+                    self.idle.put(connection)
+                else:
+                    close_quietly(connection)
+        finally:
+            self.slots.release()
+
+    def call(self, method, *args):
+        '''
+        Calls method of connection with given arguments. If call
+        failed because connection was dropped it is repeated once
+        on new connection.
+        '''
+        for attempt in (1, 2):
+            with self.connection() as connection:
+                try:
+                    return getattr(connection, method)(*args)
+                except libvirt.libvirtError:
+                    if attempt == 2 or is_alive(connection):
+                        raise
+
+    def close(self):
+        '''
+        Closes idle connections, connections which are in use
+        are closed when they are given back.
+        '''
+        self.closed = True
+        while True:
+            try:
+                close_quietly(self.idle.get_nowait())
+            except Empty:
+                break
@@ -0,0 +1,331 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides allocation of mac addresses for instances.
+
+Addresses are handed out from configured ranges, so mac_address_pool
+table does not need to be pre-seeded: row for address is created
+when address is reserved for the first time and after that its
+is_free flag is switched on reserve and release.
+
+Which addresses of ranges are used is kept in memory (one flag per
+address) and reconciled with mac_address_pool and instance tables
+on first use. Never used addresses are handed out by moving pointer
+forward, released addresses are kept in stack, so allocation does
+not scan anything.
+
+Existing rows are locked with SELECT ... FOR UPDATE SKIP LOCKED,
+so concurrent transactions (of other processes) do not wait for each
+other on them and never get the same address. Every process hands
+out never used addresses from the start of ranges, so its new row
+can collide with row inserted by concurrent transaction: new rows
+are inserted in savepoint and colliding addresses are skipped. Such
+inserts do wait, since unique index of address is locked (on InnoDB
+insert of duplicate waits until transaction which inserted it first
+is finished). Skipped addresses are given back to allocator after
+reservation and are tried again after all other released addresses
+(transaction which inserted them could be rolled back). Number of
+colliding addresses which are tried one by one is limited per
+batch (COLLISION_LIMIT).
+
+When all addresses of ranges are used allocator falls back to free
+rows of mac_address_pool that are outside of ranges.
+'''
+
+import threading
+from bisect import bisect_right
+from collections import deque
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from src.database_toolkit import MacAddress, Instance
+
+
+class MacAllocatorError(Exception):
+    pass
+
+
+def mac_to_int(address):
+    return int(address.replace(':', ''), 16)
+
+
+def int_to_mac(value):
+    return ':'.join(
+        '%02x' % ((value >> shift) & 0xff) for shift in range(40, -8, -8)
+    )
+
+
+def parse_ranges(ranges):
+    '''
+    Parses comma separated list of ranges like
+    52:54:00:00:00:00-52:54:00:00:ff:ff into list
+    of (first, last) integer pairs.
+    '''
+    result = []
+    for item in ranges.split(','):
+        item = item.strip()
+        if not item:
+            continue
+
+        try:
+            first, last = [mac_to_int(part.strip()) for part in item.split('-')]
+        except ValueError:
+            raise MacAllocatorError("Malformed range of mac addresses: %s" % item)
+
+        if first > last:
+            raise MacAllocatorError("Empty range of mac addresses: %s" % item)
+
+        result.append((first, last))
+
+    return sorted(result)
+
+
+class MacAllocator(object):
+    #after this number of colliding addresses of one batch
+    #the rest of batch is skipped without trying
+    COLLISION_LIMIT = 4
+
+    def __init__(self, ranges):
+        '''
+        ranges is list of (first, last) pairs
+        returned by parse_ranges.
+        '''
+        self.ranges = ranges
+
+        #index of first address of every range in flat numbering
+        #of all addresses of ranges
+        self.offsets = []
+        self.size = 0
+        for first, last in ranges:
+            self.offsets.append(self.size)
+            self.size += last - first + 1
+
+        self.lock = threading.Lock()
+        #held by the only thread which reconciles on first use
+        self.reconcile_lock = threading.Lock()
+        self.reconciled = False
+        self._reset()
+
+    def _reset(self):
+        #one flag per address of ranges, 1 - address is used
+        self.used = bytearray(self.size)
+        #all addresses starting from this index were never used
+        self.next_fresh = 0
+        #indexes of released addresses
+        self.released = deque()
+
+    def _address(self, index):
+        i = bisect_right(self.offsets, index) - 1
+        return int_to_mac(self.ranges[i][0] + index - self.offsets[i])
+
+    def _index(self, address):
+        value = mac_to_int(address)
+        for (first, last), offset in zip(self.ranges, self.offsets):
+            if first <= value <= last:
+                return offset + value - first
+
+    def _take(self, count):
+        taken = []
+        with self.lock:
+            while len(taken) < count:
+                if self.released:
+                    index = self.released.pop()
+                    if self.used[index]:
+                        continue
+                else:
+                    while self.next_fresh < self.size and \
+                            self.used[self.next_fresh]:
+                        self.next_fresh += 1
+
+                    if self.next_fresh == self.size:
+                        break
+
+                    index = self.next_fresh
+                    self.next_fresh += 1
+
+                self.used[index] = 1
+                taken.append(index)
+
+        return taken
+
+    def _give_back(self, indexes, last=False):
+        '''
+        Returns addresses to released ones, if last is True they
+        are handed out after all other released addresses.
+        '''
+        with self.lock:
+            for index in indexes:
+                if self.used[index]:
+                    self.used[index] = 0
+                    if last:
+                        self.released.appendleft(index)
+                    else:
+                        self.released.append(index)
+
+    def reconcile(self, session):
+        '''
+        Rebuilds in-memory flags from database: address is used if its
+        row is not free or it is referenced by some instance.
+        '''
+        used_addresses = session.query(MacAddress.address)\
+            .outerjoin(Instance, Instance.mac_addr == MacAddress.id)\
+            .filter(
+                or_(
+                    MacAddress.is_free == False,
+                    Instance.mac_addr != None
+                )
+            )
+
+        with self.lock:
+            self._reset()
+            for (address,) in used_addresses:
+                index = self._index(address)
+                if index is not None:
+                    self.used[index] = 1
+            self.reconciled = True
+
+    def reserve(self, session, count=1, partial=False):
+        '''
+        Reserves count addresses inside of given session. If partial
+        is True and there is not enough free addresses as many as
+        possible are reserved, otherwise MacAllocatorError is raised.
+
+        Returns: list of MacAddress rows (is_free is already False)
+
+        Rows are not free in database only after session is committed,
+        if it is rolled back discard should be called for returned rows.
+        '''
+        if not self.reconciled:
+            with self.reconcile_lock:
+                if not self.reconciled:
+                    self.reconcile(session)
+
+        rows = []
+        #indexes of addresses inserted by concurrent transactions,
+        #they are kept used until reservation is over
+        contended = []
+        while len(rows) < count:
+            indexes = self._take(count - len(rows))
+            if not indexes:
+                break
+
+            reserved, skipped = self._reserve_rows(session, indexes)
+            rows.extend(reserved)
+            contended.extend(skipped)
+        self._give_back(contended, last=True)
+
+        if len(rows) < count:
+            #ranges are exhausted, free rows outside of ranges are used
+            fallback = session.query(MacAddress)\
+                .filter(MacAddress.is_free == True)\
+                .with_for_update(skip_locked=True)\
+                .limit(count - len(rows))\
+                .all()
+
+            for row in fallback:
+                row.is_free = False
+                index = self._index(row.address)
+                if index is not None:
+                    with self.lock:
+                        self.used[index] = 1
+
+            rows.extend(fallback)
+
+        if len(rows) < count and not partial:
+            self.discard(rows)
+            raise MacAllocatorError("No free mac address")
+
+        session.flush()
+        return rows
+
+    def _reserve_rows(self, session, indexes):
+        '''
+        Gets rows for addresses with given indexes. Address which is
+        used by concurrent transaction (row is locked or not free)
+        stays marked as used and is just skipped.
+
+        Returns: (list of rows, list of indexes of addresses which
+        collided with rows inserted by concurrent transactions)
+        '''
+        addresses = [self._address(index) for index in indexes]
+
+        existing = dict(
+            (row.address, row) for row in
+            session.query(MacAddress)
+                   .filter(MacAddress.address.in_(addresses))
+                   .with_for_update(skip_locked=True)
+        )
+
+        locked = set()
+        missing = [address for address in addresses if address not in existing]
+        if missing:
+            locked = set(
+                address for (address,) in
+                session.query(MacAddress.address)
+                       .filter(MacAddress.address.in_(missing))
+            )
+
+        rows = []
+        new_addresses = []
+        for address in addresses:
+            row = existing.get(address)
+            if row is None and address not in locked:
+                new_addresses.append(address)
+            elif row is not None and row.is_free:
+                row.is_free = False
+                rows.append(row)
+
+        #the same rows can be inserted by concurrent transactions,
+        #usually all rows are inserted at once and only after collision
+        #they are inserted one by one
+        contended = []
+        try:
+            rows.extend(self._insert_rows(session, new_addresses))
+        except IntegrityError:
+            for address in new_addresses:
+                if len(contended) >= self.COLLISION_LIMIT:
+                    contended.append(address)
+                    continue
+
+                try:
+                    rows.extend(self._insert_rows(session, [address]))
+                except IntegrityError:
+                    contended.append(address)
+
+        return rows, [self._index(address) for address in contended]
+
+    def _insert_rows(self, session, addresses):
+        '''
+        Inserts rows for addresses in savepoint, which is rolled back
+        if some of them violates unique index.
+
+        Returns: list of inserted rows
+        '''
+        if not addresses:
+            return []
+
+        rows = [MacAddress(address=address, is_free=False)
+                for address in addresses]
+        with session.begin_nested():
+            session.add_all(rows)
+
+        return rows
+
+    def discard(self, rows):
+        '''
+        Returns addresses of rows to allocator without touching
+        database, is used when session with reservation is rolled back.
+        '''
+        indexes = [self._index(row.address) for row in rows]
+        self._give_back([index for index in indexes if index is not None])
+
+    def release(self, session, rows):
+        '''
+        Marks rows as free inside of given session and
+        returns addresses to allocator.
+        '''
+        for row in rows:
+            row.is_free = True
+
+        self.discard(rows)
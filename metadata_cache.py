@@ -0,0 +1,255 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides in-process read-through cache of flavors and images metadata.
+
+Flavors and images are changed rarely, but are needed for every boot.
+Cache keeps plain tuples (not ORM objects, which are bound to session)
+with values of their columns. Entry expires after ttl seconds, entries
+can be dropped explicitly by invalidate method after flavor or image
+was changed.
+
+Misses of bulk lookups are fetched by one query.
+
+Lists are read page by page with keyset pagination: page is selected
+by primary key greater than last key of previous page (marker), so
+every page costs one index range scan regardless of its position.
+Filters are applied by database, total counts of filtered lists
+are cached for ttl seconds.
+'''
+
+import time
+import threading
+from collections import namedtuple
+
+from sqlalchemy import func
+
+from src.database_toolkit import (
+    Flavor, Image, contexted_session,
+    NoResultFound
+)
+
+FlavorInfo = namedtuple('FlavorInfo', ['id', 'name', 'vcpu', 'memory'])
+ImageInfo = namedtuple('ImageInfo', ['id', 'name', 'fmt', 'size', 'sha256'])
+#next_marker is None on last page, total is None unless it was requested
+Page = namedtuple('Page', ['items', 'next_marker', 'total'])
+
+#key - kind of entity, value - (mapped class, tuple class)
+KINDS = {
+    'flavor': (Flavor, FlavorInfo),
+    'image': (Image, ImageInfo)
+}
+
+#key - name of filter, value - (name of column, function which
+#makes condition of query from column and value of filter)
+FILTERS = {
+    #prefix match can use index on name column, '%' and '_' of value
+    #are matched literally
+    'name': (
+        'name',
+        lambda column, value: column.startswith(value, autoescape=True)
+    ),
+    'fmt': ('fmt', lambda column, value: column == value),
+    #sizes are in bytes (BigInteger), value is bound as long
+    'min_size': ('size', lambda column, value: column >= long(value)),
+    'max_size': ('size', lambda column, value: column <= long(value)),
+    'min_vcpu': ('vcpu', lambda column, value: column >= value),
+    'min_memory': ('memory', lambda column, value: column >= value)
+}
+
+
+class MetadataCache(object):
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+
+        #key - kind, value - dict where key is id of entity
+        #and value is (tuple, time of expiration)
+        self.entries = dict((kind, {}) for kind in KINDS)
+        #key - (kind, filters), value - (count, time of expiration)
+        self.totals = {}
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0
+        }
+
+        self.lock = threading.Lock()
+
+    def _fetch(self, kind, ids=None):
+        '''
+        Fetches entities with given ids (all entities if ids is None)
+        from database and puts them into cache.
+        '''
+        model, info = KINDS[kind]
+        columns = [getattr(model, field) for field in info._fields]
+
+        with contexted_session() as s:
+            query = s.query(*columns)
+            if ids is not None:
+                query = query.filter(model.id.in_(ids))
+
+            fetched = [info(*row) for row in query]
+
+        self.put(kind, fetched)
+
+        return fetched
+
+    def put(self, kind, infos):
+        '''
+        Puts tuples fetched elsewhere (e.g. by listing) into cache.
+        '''
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            entries = self.entries[kind]
+            for item in infos:
+                entries[item.id] = (item, expires_at)
+
+    def get_many(self, kind, ids):
+        '''
+        Returns: dict where key is id and value is tuple of entity,
+        absent entities are not included.
+        '''
+        found = {}
+        missing = []
+        now = time.time()
+
+        with self.lock:
+            entries = self.entries[kind]
+            for entity_id in set(ids):
+                entry = entries.get(entity_id)
+                if entry is not None and entry[1] > now:
+                    found[entity_id] = entry[0]
+                else:
+                    missing.append(entity_id)
+
+            self.stats['hits'] += len(found)
+            self.stats['misses'] += len(missing)
+
+        if missing:
+            for item in self._fetch(kind, missing):
+                found[item.id] = item
+
+        return found
+
+    def get(self, kind, entity_id):
+        '''
+        Raises NoResultFound if there is no such entity.
+        '''
+        found = self.get_many(kind, [entity_id])
+        if entity_id not in found:
+            raise NoResultFound("No %s with id %s" % (kind, entity_id))
+
+        return found[entity_id]
+
+    def flavor(self, flavor_id):
+        return self.get('flavor', flavor_id)
+
+    def image(self, image_id):
+        return self.get('image', image_id)
+
+    def flavors(self, flavor_ids):
+        return self.get_many('flavor', flavor_ids)
+
+    def images(self, image_ids):
+        return self.get_many('image', image_ids)
+
+    def warm_up(self, kinds=None):
+        '''
+        Loads all entities of given kinds (all kinds by default)
+        by one query per kind.
+        '''
+        for kind in kinds or KINDS:
+            self._fetch(kind)
+
+    def _conditions(self, kind, filters):
+        model = KINDS[kind][0]
+
+        conditions = []
+        for name, value in sorted(filters.items()):
+            if value is None:
+                continue
+            column_name, condition = FILTERS.get(name, (None, None))
+            column = getattr(model, column_name or '', None)
+            if column is None:
+                raise ValueError("Unknown filter %s of %s" % (name, kind))
+            conditions.append(condition(column, value))
+
+        return conditions
+
+    def _total(self, kind, conditions, filters):
+        key = (kind, frozenset(filters.items()))
+        with self.lock:
+            entry = self.totals.get(key)
+            if entry is not None and entry[1] > time.time():
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+
+        model = KINDS[kind][0]
+        with contexted_session() as s:
+            total = s.query(func.count(model.id)).filter(*conditions).scalar()
+
+        with self.lock:
+            self.totals[key] = (total, time.time() + self.ttl)
+
+        return total
+
+    def page(self, kind, marker=None, limit=100, with_total=False,
+             **filters):
+        '''
+        Returns: Page with at most limit tuples of entities ordered by id
+        and having id greater than marker (first page if marker is None).
+
+        Only columns of tuple are selected, fetched tuples are put
+        into cache. filters are names from FILTERS, e.g. fmt='qcow2'.
+        '''
+        model, info = KINDS[kind]
+        conditions = self._conditions(kind, filters)
+
+        with contexted_session() as s:
+            query = s.query(
+                *[getattr(model, field) for field in info._fields]
+            ).filter(*conditions)
+            if marker is not None:
+                query = query.filter(model.id > marker)
+
+            #one row more shows whether there is next page
+            rows = query.order_by(model.id).limit(limit + 1).all()
+
+        items = [info(*row) for row in rows[:limit]]
+        self.put(kind, items)
+
+        next_marker = items[-1].id if len(rows) > limit else None
+
+        total = None
+        if with_total:
+            total = self._total(
+                kind,
+                conditions,
+                dict((k, v) for k, v in filters.items() if v is not None)
+            )
+
+        return Page(items, next_marker, total)
+
+    def invalidate(self, kind=None, entity_id=None):
+        '''
+        Drops entity with given id, all entities of kind
+        or whole cache (if kind is not given).
+        '''
+        with self.lock:
+            for name in ([kind] if kind else KINDS):
+                if entity_id is None:
+                    self.entries[name].clear()
+                else:
+                    self.entries[name].pop(entity_id, None)
+
+            for key in self.totals.keys():
+                if kind is None or key[0] == kind:
+                    del self.totals[key]
+
+    def statistics(self):
+        with self.lock:
+            stats = dict(self.stats)
+            for kind, entries in self.entries.items():
+                stats['%ss' % kind] = len(entries)
+            return stats
@@ -3,55 +3,576 @@
 
 import os
 import os.path
+import sys
+import uuid
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
 
 from ConfigParser import ConfigParser
+from contextlib import contextmanager
 
 import libvirt
 import pymongo
 import gridfs
 from bson.objectid import ObjectId
 import xml.etree.ElementTree as ElementTree
+from collections import Counter, OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+from concurrent.futures import ThreadPoolExecutor, Future
 
 from src.database_toolkit import (
-    Flavor, Image, MacAddress,
-    Instance, contexted_session
+    Instance, MacAddress, contexted_session,
+    NoResultFound, verify_schema
 )
 
-from utils.caas import conf
+from src.image_cache import ImageCache
+from src.image_integrity import (
+    ImageVerifier, ImageScrubber, ImageIntegrityError,
+    expected_sha256, write_checksum
+)
+from src.image_prefetcher import ImagePrefetcher
+from src.instance_registry import InstanceRegistry, InstanceRecord
+from src.libvirt_pool import LibvirtConnectionPool, is_alive
+from src.metadata_cache import MetadataCache
+from src.mac_allocator import (
+    MacAllocator, MacAllocatorError, parse_ranges
+)
+from src.scheduler import Scheduler, NoValidHost, parse_hosts
+from src.single_flight import SingleFlight
+from src.state_tracker import StateTracker
+from src.state_waiter import StateWaiter, StateTimeoutError, chain_future
+from src.tracing import (
+    Tracer, LogExporter, PrometheusExporter
+)
+from src.xml_template import DomainTemplate, METADATA_NAMESPACE
+from src.utils.config import get_option
 
 PATH_TO_GLOBAL_CONFIG = './conf.ini'
 
+#name of host of [libvirt] uri if [scheduler] hosts are not given
+DEFAULT_HOST = 'localhost'
+
+LOG = logging.getLogger(__name__)
+
+#boot of one instance after its first phase: row and mac address are
+#reserved, resources of host are claimed and image is referenced
+PendingBoot = namedtuple(
+    'PendingBoot',
+    ['id', 'name', 'image', 'image_key', 'flavor', 'host',
+     'mac_address_id', 'mac_address']
+)
 
-class NovaMimic:
-    #dictionary where key - domain name and value - domain object
-    #main purpose - providing quick access to domain object
-    domains_pool = {}
 
+class NovaMimic:
     #states of domain is mapped on global variables from
     #libvirt module. Following dict is defined for the sake
     #of convinience
     domain_state = {
-        1: "running",
-        3: "suspended",
-        5: "shut off"
+        libvirt.VIR_DOMAIN_NOSTATE: "no state",
+        libvirt.VIR_DOMAIN_RUNNING: "running",
+        libvirt.VIR_DOMAIN_BLOCKED: "blocked",
+        libvirt.VIR_DOMAIN_PAUSED: "suspended",
+        libvirt.VIR_DOMAIN_SHUTDOWN: "shutting down",
+        libvirt.VIR_DOMAIN_SHUTOFF: "shut off",
+        libvirt.VIR_DOMAIN_CRASHED: "crashed",
+        libvirt.VIR_DOMAIN_PMSUSPENDED: "pm suspended"
     }
 
-    #TODO: think about correct way to close connection
-    def __init__(self):
-        self.libvirt_connection = libvirt.open('qemu:///system')
+    #state of instance between reservation and creation of its domain
+    PENDING_STATE = "pending"
+
+    #size of piece of image that is read from key-value storage
+    #and written to local image storage at once
+    IMAGE_CHUNK_SIZE = 4 * 1024 * 1024
+    #blocks of zeros of this size are not written to image files
+    SPARSE_BLOCK_SIZE = 4096
 
+    def __init__(self):
         conf = ConfigParser()
         conf.read(PATH_TO_GLOBAL_CONFIG)
+
+        #database which was created by previous version lacks columns
+        #and constraints which are used here (SchemaMismatchError)
+        verify_schema()
+
+        #stages of boot and lifecycle operations are timed by spans
+        self.tracer = Tracer(
+            get_option(conf, 'tracing', 'enabled', False, bool)
+        )
+        for name in get_option(conf, 'tracing', 'exporters', '').split(','):
+            name = name.strip()
+            if name == 'log':
+                self.tracer.exporters.append(LogExporter())
+            elif name == 'prometheus':
+                self.tracer.exporters.append(
+                    PrometheusExporter(
+                        get_option(conf, 'tracing', 'prometheus_path'),
+                        get_option(
+                            conf, 'tracing', 'prometheus_interval', 10.0, float
+                        )
+                    )
+                )
+
+        #instances are placed on several libvirt hosts,
+        #every host has its own pool of connections
+        hosts = parse_hosts(get_option(conf, 'scheduler', 'hosts', '')) or [
+            (
+                DEFAULT_HOST,
+                get_option(conf, 'libvirt', 'uri', 'qemu:///system')
+            )
+        ]
+
+        #connections to libvirt driver are opened on demand
+        #and closed by close method
+        self.libvirt_pools = OrderedDict(
+            (
+                name,
+                LibvirtConnectionPool(
+                    uri=uri,
+                    size=get_option(conf, 'libvirt', 'pool_size', 4, int),
+                    keepalive_interval=get_option(
+                        conf, 'libvirt', 'keepalive_interval', 5, int
+                    ),
+                    keepalive_count=get_option(
+                        conf, 'libvirt', 'keepalive_count', 3, int
+                    )
+                )
+            )
+            for name, uri in hosts
+        )
+        #pool of the first host
+        self.libvirt_pool = self.libvirt_pools.values()[0]
         self.path_to_xml_config_pattern = conf.get(
             'xml_config',
             'path_to_xml_pattern_conf'
         )
+        #pattern is compiled on first use
+        self.domain_template = DomainTemplate(
+            self.path_to_xml_config_pattern,
+            get_option(conf, 'xml_config', 'check_interval', 1.0, float)
+        )
 
         self.path_to_image_storage = conf.get(
             'image_storage',
             'path_to_image_storage'
         )
 
+        self.image_cache = ImageCache(
+            self.path_to_image_storage,
+            size_limit=get_option(
+                conf, 'image_storage', 'cache_size_limit', 0, int
+            ),
+            policy=get_option(
+                conf, 'image_storage', 'cache_policy', 'lru'
+            )
+        )
+
+        #images are written as sparse files
+        self.sparse_images = get_option(
+            conf, 'image_storage', 'sparse', True, bool
+        )
+
+        #cached images are checked against their checksum files on boot
+        self.image_verifier = None
+        if get_option(conf, 'integrity', 'verify', True, bool):
+            self.image_verifier = ImageVerifier(self.path_to_image_storage)
+
+        #concurrent downloads of the same image are serialized
+        #by lock files in image storage directory
+        self.image_downloads = SingleFlight(self.path_to_image_storage)
+
+        #if overlays are used every instance boots from its own
+        #copy-on-write qcow2 file which refers to cached image as
+        #to backing file, so image itself is never written
+        self.use_overlays = get_option(
+            conf, 'instance_storage', 'use_overlays', False, bool
+        )
+        self.path_to_instance_storage = get_option(
+            conf, 'instance_storage', 'path_to_instance_storage'
+        )
+
+        #client of key-value storage is created once and shared by
+        #all downloads, connection is established on first use
+        self.mongo_client = pymongo.MongoClient(
+            host=get_option(conf, 'gridfs', 'host', 'localhost'),
+            port=get_option(conf, 'gridfs', 'port', 27017, int),
+            maxPoolSize=get_option(conf, 'gridfs', 'max_pool_size', 10, int),
+            connectTimeoutMS=get_option(
+                conf, 'gridfs', 'connect_timeout_ms', 5000, int
+            ),
+            socketTimeoutMS=get_option(
+                conf, 'gridfs', 'socket_timeout_ms', 60000, int
+            ),
+            serverSelectionTimeoutMS=get_option(
+                conf, 'gridfs', 'server_selection_timeout_ms', 10000, int
+            ),
+            connect=False
+        )
+        self.grfs = gridfs.GridFS(
+            self.mongo_client[
+                get_option(conf, 'gridfs', 'database', 'image_storage')
+            ]
+        )
+
+        #flavors and images are read through cache
+        self.metadata_cache = MetadataCache(
+            get_option(conf, 'metadata_cache', 'ttl', 300, int)
+        )
+        if get_option(conf, 'metadata_cache', 'warm_up', False, bool):
+            self.metadata_cache.warm_up()
+
+        #default number of entities in page of image_list and flavor_list
+        self.page_size = get_option(conf, 'metadata_cache', 'page_size', 100, int)
+
+        #mac addresses are allocated from configured ranges
+        self.mac_allocator = MacAllocator(
+            parse_ranges(get_option(conf, 'mac_allocator', 'ranges', ''))
+        )
+
+        #number of domains that instance_boot_many creates in parallel
+        self.max_boot_workers = get_option(
+            conf, 'boot', 'max_boot_workers', 8, int
+        )
+        #seconds after which pending instance is considered to be
+        #left by interrupted boot
+        self.pending_timeout = get_option(
+            conf, 'boot', 'pending_timeout', 3600, float
+        )
+        #ids of instances whose boots are in progress in this process,
+        #they are never recovered
+        self.booting = set()
+        self.booting_lock = threading.Lock()
+
+        #instances are indexed by uuid, name, mac address and state,
+        #registry is rebuilt from database and libvirt driver on start
+        #hosts which are unreachable on start get no instances,
+        #their instances are registered without domains
+        self.unreachable_hosts = set()
+        self.registry = InstanceRegistry()
+        with contexted_session() as s:
+            with self._host_connections() as connections:
+                self.unreachable_hosts.update(
+                    self.registry.rebuild(s, connections)
+                )
+
+        self._recover_pending_boots()
+        self.image_cache.set_references(self._running_image_references())
+
+        #free memory and vcpus of hosts are counted from their
+        #capacity and domains which are running
+        self.scheduler = Scheduler(
+            get_option(conf, 'scheduler', 'strategy', 'spread')
+        )
+        self.memory_ratio = get_option(
+            conf, 'scheduler', 'memory_ratio', 1.0, float
+        )
+        self.cpu_ratio = get_option(conf, 'scheduler', 'cpu_ratio', 1.0, float)
+        self.reserved_memory = get_option(
+            conf, 'scheduler', 'reserved_memory', 0, int
+        )
+        for name, pool in self.libvirt_pools.items():
+            memory, vcpu = 0, 0
+            if name not in self.unreachable_hosts:
+                try:
+                    memory, vcpu = self._host_capacity(pool)
+                except libvirt.libvirtError:
+                    LOG.exception("Failed to read capacity of host %s", name)
+                    self.unreachable_hosts.add(name)
+            #unreachable host is kept with zero capacity until it
+            #answers to probe (see probe_hosts)
+            self.scheduler.add_host(name, memory, vcpu)
+        self._claim_running_instances(self.registry.records())
+
+        #states of instances are updated by libvirt events,
+        #one tracker per host
+        self.state_trackers = []
+        if get_option(conf, 'state_tracker', 'enabled', False, bool):
+            for pool in self.libvirt_pools.values():
+                state_tracker = StateTracker(
+                    self.registry,
+                    self.domain_state,
+                    pool.uri,
+                    get_option(
+                        conf, 'state_tracker', 'flush_interval', 1.0, float
+                    )
+                )
+                state_tracker.start()
+                self.state_trackers.append(state_tracker)
+
+        #reboots, shutdowns and destroys are called by pool of threads,
+        #waits for target states do not occupy threads of pool
+        self.lifecycle_executor = ThreadPoolExecutor(
+            get_option(conf, 'lifecycle', 'max_workers', 16, int)
+        )
+        self.state_waiter = StateWaiter(
+            self.registry,
+            None if self.state_trackers else get_option(
+                conf, 'lifecycle', 'poll_interval', 1.0, float
+            ),
+            self._domain
+        )
+        self.reboot_timeout = get_option(
+            conf, 'lifecycle', 'reboot_timeout', 120, float
+        )
+        self.shutdown_timeout = get_option(
+            conf, 'lifecycle', 'shutdown_timeout', 120, float
+        )
+        self.escalate_shutdown = get_option(
+            conf, 'lifecycle', 'escalate_shutdown', True, bool
+        )
+
+        #popular and pinned images are downloaded before they are booted
+        self.image_prefetcher = None
+        if get_option(conf, 'prefetcher', 'enabled', False, bool):
+            self.image_prefetcher = ImagePrefetcher(
+                self,
+                [
+                    image_id.strip() for image_id in
+                    get_option(conf, 'prefetcher', 'pinned', '').split(',')
+                    if image_id.strip()
+                ],
+                get_option(conf, 'prefetcher', 'top', 10, int),
+                get_option(conf, 'prefetcher', 'window_hours', 24, float),
+                get_option(conf, 'prefetcher', 'interval', 300, float),
+                get_option(conf, 'prefetcher', 'bandwidth', 0, int)
+            )
+            self.image_prefetcher.start()
+
+        #cached images are re-hashed in background
+        self.image_scrubber = None
+        scrub_interval = get_option(
+            conf, 'integrity', 'scrub_interval', 0, float
+        )
+        if self.image_verifier is not None and scrub_interval:
+            self.image_scrubber = ImageScrubber(
+                self,
+                scrub_interval,
+                get_option(conf, 'integrity', 'scrub_bandwidth', 0, int)
+            )
+            self.image_scrubber.start()
+
+        #unreachable hosts are probed and interrupted boots are
+        #recovered by background thread (see _maintain)
+        self.maintenance_interval = get_option(
+            conf, 'maintenance', 'interval', 60, float
+        )
+        self.maintenance_stopped = threading.Event()
+        self.maintenance_thread = None
+        if self.maintenance_interval:
+            self.maintenance_thread = threading.Thread(
+                target=self._run_maintenance,
+                name='nova-mimic-maintenance'
+            )
+            self.maintenance_thread.daemon = True
+            self.maintenance_thread.start()
+
+    def _domain_image_id(self, domain):
+        '''
+        Returns id of image which domain was booted from.
+
+        Image id is kept in metadata of domain xml. Domains
+        that were booted without metadata are recognized by
+        disk source which points to local image storage.
+        '''
+        doc_root = ElementTree.fromstring(domain.XMLDesc(0))
+
+        image = doc_root.find(
+            'metadata/{%s}instance/{%s}image' % (
+                METADATA_NAMESPACE,
+                METADATA_NAMESPACE
+            )
+        )
+        if image is not None:
+            return image.get('id')
+
+        for source in doc_root.findall('devices/disk/source'):
+            path = source.get('file')
+            if path and os.path.dirname(path) == self.path_to_image_storage:
+                return os.path.basename(path)
+
+    def _running_image_references(self, records=None):
+        '''
+        Counts instances with existing domains per image,
+        records are all records of registry by default.
+        '''
+        image_ids = []
+
+        if records is None:
+            records = self.registry.records()
+        for record in records:
+            if record.domain is None:
+                continue
+
+            #domains that were booted before image id was saved
+            #to database are recognized by their xml
+            image_id = record.image_id or self._domain_image_id(record.domain)
+            if image_id:
+                image_ids.append(image_id)
+
+        if not image_ids:
+            return Counter()
+
+        keys = self._image_keys(image_ids)
+        return Counter(keys[image_id] for image_id in image_ids)
+
+    @contextmanager
+    def _host_connections(self):
+        '''
+        Gives connections of hosts as list of (name of host, connection),
+        connection is None for host which can not be connected.
+        '''
+        managers = []
+        connections = []
+        try:
+            for name, pool in self.libvirt_pools.items():
+                manager = pool.connection()
+                try:
+                    connection = manager.__enter__()
+                except libvirt.libvirtError:
+                    LOG.exception("Host %s is unreachable", name)
+                    connections.append((name, None))
+                    continue
+
+                managers.append(manager)
+                connections.append((name, connection))
+
+            yield connections
+        finally:
+            for manager in reversed(managers):
+                manager.__exit__(None, None, None)
+
+    def _host_capacity(self, pool):
+        '''
+        Returns: (memory in KiB, number of vcpus) of host which can be
+        given to instances. Physical memory and cpus of host are
+        multiplied by ratios, reserved_memory (KiB) is kept for host.
+        '''
+        #model, memory in MiB, number of cpus, ...
+        info = pool.call('getInfo')
+
+        return (
+            int(int(info[1]) * 1024 * self.memory_ratio) -
+            self.reserved_memory,
+            int(int(info[2]) * self.cpu_ratio)
+        )
+
+    def _claim_running_instances(self, records):
+        '''
+        Claims resources of domains of records (which exist on start
+        or on host which became reachable). Flavor of instance is not
+        saved, so memory and vcpus are read from domain itself.
+        '''
+        claims = []
+        for record in records:
+            if record.domain is None or \
+                    record.state == libvirt.VIR_DOMAIN_SHUTOFF:
+                continue
+
+            try:
+                #state, max memory, memory, number of vcpus, cpu time
+                info = record.domain.info()
+                image_id = record.image_id or \
+                    self._domain_image_id(record.domain)
+            except libvirt.libvirtError:
+                LOG.exception("Failed to read domain %s", record.id)
+                continue
+
+            claims.append((record, info[1], info[3], image_id))
+
+        image_ids = [image_id for _, _, _, image_id in claims if image_id]
+        keys = self._image_keys(image_ids) if image_ids else {}
+
+        for record, memory, vcpu, image_id in claims:
+            self.scheduler.claim(
+                record.id,
+                memory,
+                vcpu,
+                keys.get(image_id),
+                record.host
+            )
+
+    def probe_hosts(self):
+        '''
+        Connects to hosts which are unreachable. Host which answers
+        gets its capacity in scheduler, its instances are linked to
+        their domains, claim resources of host and reference their
+        images.
+
+        Returns: list of names of hosts which became reachable
+        '''
+        reachable = []
+        for name in sorted(self.unreachable_hosts):
+            pool = self.libvirt_pools[name]
+            try:
+                memory, vcpu = self._host_capacity(pool)
+                all_stats = pool.call(
+                    'getAllDomainStats',
+                    libvirt.VIR_DOMAIN_STATS_STATE
+                )
+            except libvirt.libvirtError as e:
+                LOG.warning("Host %s is still unreachable: %s", name, e)
+                continue
+
+            records = self.registry.attach(name, all_stats)
+            self.scheduler.resize_host(name, memory, vcpu)
+            self._claim_running_instances(records)
+            for image_key, count in \
+                    self._running_image_references(records).items():
+                for i in xrange(count):
+                    self.image_cache.acquire(image_key)
+
+            self.unreachable_hosts.discard(name)
+            reachable.append(name)
+            LOG.info("Host %s is reachable again", name)
+
+        return reachable
+
+    def _maintain(self):
+        '''
+        Periodic work of background thread.
+        '''
+        if self.unreachable_hosts:
+            self.probe_hosts()
+
+        self._recover_pending_boots()
+
+    def _run_maintenance(self):
+        while not self.maintenance_stopped.wait(self.maintenance_interval):
+            try:
+                self._maintain()
+            except Exception:
+                LOG.exception("Failed to maintain hosts and instances")
+
+    @staticmethod
+    def _image_key(image):
+        '''
+        Returns name of file of image in local image storage: sha256
+        of its content, so images with the same content share one file,
+        or id for images which were uploaded without hash.
+        '''
+        return image.sha256 or image.id
+
+    def _image_keys(self, image_ids):
+        '''
+        Returns: dict where key is image id and value is name of file
+        of image in local image storage. Unknown ids (e.g. names of
+        files of old domains) are names of files themselves.
+        '''
+        images = self.metadata_cache.images(image_ids)
+
+        return dict(
+            (
+                image_id,
+                self._image_key(images[image_id])
+                if image_id in images else image_id
+            )
+            for image_id in image_ids
+        )
+
     def instance_boot(self, instance_name, image_id, flavor_id):
         '''
         Function boots instance with given name, image id and flavor id.
@@ -64,125 +585,1200 @@ class NovaMimic:
         Flavor id is used to fetch information about virtual hardware
         (amount of RAM and virtual CPU) that will be provisioned to VM
         instance by building xml configuration file for libvirt.
+        Host which has enough free memory and vcpus for flavor is
+        chosen by scheduler (see src.scheduler), NoValidHost is raised
+        if there is no such host.
+
+        Boot is split into phases so that no database transaction
+        is open during download of image and creation of domain:
+        short transaction reserves mac address and inserts row of
+        instance in pending state, then domain is created and the
+        last short transaction saves its state (or releases
+        reservation if boot failed).
 
         Returns: information about booted instance
-            - id (uuid generated by libvirt driver for instance)
+            - id (uuid of domain of instance)
         '''
-        # get flavor data from database
-        with contexted_session() as s:
-            flavor = s.query(Flavor).filter(Flavor.id == flavor_id).one()
-            image = s.query(Image).filter(Image.id == image_id).one()
-            # first free mac address
-            mac_address = s.query(MacAddress)\
-                           .filter(MacAddress.is_free == True)\
-                           .first()
-
-            xml_config_string = self._xml_processing(
-                instance_name,
-                image.id,
+        with self.tracer.span('instance_boot', instance=instance_name):
+            return self._instance_boot(instance_name, image_id, flavor_id)
+
+    def _instance_boot(self, instance_name, image_id, flavor_id):
+        boot = self._begin_boot(instance_name, image_id, flavor_id)
+
+        #no transaction is open while image is downloaded
+        #and domain is created
+        domain = None
+        try:
+            self._image_processing(boot.image.id, boot.image_key, 1)
+            domain = self._create_domain(boot)
+            self._finish_boot(boot, domain, domain.state(0)[0])
+        except:
+            error = sys.exc_info()
+            self._cancel_boot(
+                boot.id,
+                boot.mac_address_id,
+                boot.image_key,
+                domain
+            )
+            raise error[0], error[1], error[2]
+
+        return boot.id
+
+    def _begin_boot(self, instance_name, image_id, flavor_id):
+        '''
+        The first phase of boot of one instance: flavor and image are
+        looked up, host is chosen, mac address and row of instance
+        are reserved and image is referenced.
+
+        Returns: PendingBoot, which is finished by _finish_boot
+        or undone by _cancel_boot
+        '''
+        # get flavor and image data from cache (or database)
+        with self.tracer.span('metadata_lookup'):
+            flavor = self.metadata_cache.flavor(flavor_id)
+            image = self.metadata_cache.image(image_id)
+
+        #uuid of domain is chosen before domain is created, so row
+        #of instance is inserted before slow download and creation
+        instance_id = str(uuid.uuid4())
+        image_key = self._image_key(image)
+        with self.tracer.span('placement'):
+            host = self.scheduler.claim(
+                instance_id,
                 flavor.memory,
                 flavor.vcpu,
-                mac_address.address
+                image_key
             )
 
-            self._image_processing(image.id)
+        try:
+            mac_address_id, mac_address = self._reserve_boots(
+                [(instance_id, instance_name, image.id, host)]
+            )[0]
+        except:
+            self.scheduler.release(instance_id)
+            raise
 
-            #start domain from xml_configuration_string
-            #and update pool of domains
-            domain = self.libvirt_connection.createXML(
-                xml_config_string,
-                0
+        #image is referenced before download so that it can not
+        #be evicted by concurrent boot
+        self.image_cache.acquire(image_key)
+
+        return PendingBoot(
+            instance_id,
+            instance_name,
+            image,
+            image_key,
+            flavor,
+            host,
+            mac_address_id,
+            mac_address
+        )
+
+    def _create_domain(self, boot):
+        '''
+        Creates domain of pending boot, image should be already
+        present in local image storage.
+
+        Returns: domain object
+        '''
+        return self._domain_processing(
+            boot.name,
+            boot.image,
+            boot.flavor,
+            boot.mac_address,
+            boot.id,
+            boot.host
+        )
+
+    def _finish_boot(self, boot, domain, state):
+        '''
+        The last phase of boot of one instance: state of its domain
+        is saved and instance is registered.
+        '''
+        self._finish_boots([(boot.id, state)], [])
+
+        self.registry.add(
+            InstanceRecord(
+                boot.id,
+                boot.name,
+                boot.mac_address,
+                state,
+                boot.image.id,
+                domain,
+                boot.host
             )
+        )
+
+    def instance_boot_many(self, boot_requests):
+        '''
+        Boots several instances at once.
+
+        boot_requests is list of (instance_name, image_id, flavor_id)
+        tuples. Flavors and images which are not cached and free
+        mac addresses are fetched by one query each, every distinct
+        image is downloaded once,
+        domains are created by pool of max_boot_workers threads and
+        all instance rows are inserted by one statement.
+        Hosts are chosen by scheduler one by one in order of requests.
+
+        Failure of one instance does not abort others.
+
+        Returns: list of dicts (in order of boot_requests) with keys
+            - name (name of instance)
+            - id (uuid of domain, None if boot failed)
+            - error (exception raised during boot, None on success)
+        '''
+        with self.tracer.span('instance_boot_many', count=len(boot_requests)):
+            return self._instance_boot_many(boot_requests)
 
-            self.domains_pool.update(
-                {
-                    instance_name: domain
-                }
+    def _instance_boot_many(self, boot_requests):
+        results = [
+            {'name': instance_name, 'id': None, 'error': None}
+            for instance_name, image_id, flavor_id in boot_requests
+        ]
+
+        if not boot_requests:
+            return results
+
+        with self.tracer.span('metadata_lookup'):
+            flavors = self.metadata_cache.flavors(
+                [request[2] for request in boot_requests]
+            )
+            images = self.metadata_cache.images(
+                [request[1] for request in boot_requests]
             )
 
-            #updating needed tables in data base
-            #save information about instance i.e. domain id,
-            #domain name, state and mac address
-            instance = Instance(
-                domain_id=domain.UUIDString(),
-                name=instance_name,
-                state=domain.state(0)[0],
-                mac_addr=mac_address.id
+        valid = []
+        for i, (instance_name, image_id, flavor_id) in \
+                enumerate(boot_requests):
+            if flavor_id not in flavors:
+                results[i]['error'] = NoResultFound(
+                    "No flavor with id %s" % flavor_id
+                )
+            elif image_id not in images:
+                results[i]['error'] = NoResultFound(
+                    "No image with id %s" % image_id
+                )
+            else:
+                valid.append(i)
+
+        #list of (index of request, instance id, name of host)
+        placed = []
+        with self.tracer.span('placement'):
+            for i in valid:
+                instance_name, image_id, flavor_id = boot_requests[i]
+                instance_id = str(uuid.uuid4())
+                try:
+                    host = self.scheduler.claim(
+                        instance_id,
+                        flavors[flavor_id].memory,
+                        flavors[flavor_id].vcpu,
+                        self._image_key(images[image_id])
+                    )
+                except NoValidHost as e:
+                    results[i]['error'] = e
+                else:
+                    placed.append((i, instance_id, host))
+
+        if not placed:
+            return results
+
+        #mac addresses and rows of all instances are reserved at once
+        try:
+            mac_addresses = self._reserve_boots(
+                [
+                    (instance_id, results[i]['name'], boot_requests[i][1],
+                     host)
+                    for i, instance_id, host in placed
+                ],
+                partial=True
             )
-            s.add(instance)
+        except:
+            for i, instance_id, host in placed:
+                self.scheduler.release(instance_id)
+            raise
 
-            #update mac_address row
-            mac_address.is_free = False
+        for i, instance_id, host in placed[len(mac_addresses):]:
+            results[i]['error'] = MacAllocatorError("No free mac address")
+            self.scheduler.release(instance_id)
 
-    def _xml_processing(self, instance_name, image_id, memory, vcpu, mac_address):
-        # parse pattern xml config and update needed sections in order to make
-        # own config
-        instance_config = ElementTree.parse(self.path_to_xml_config_pattern)
-        doc_root = instance_config.getroot()
+        #list of (index of request, instance id, image, flavor,
+        #(id of mac address, mac address), name of host)
+        pending = []
+        for (i, instance_id, host), mac_address in \
+                zip(placed, mac_addresses):
+            instance_name, image_id, flavor_id = boot_requests[i]
+            pending.append(
+                (i, instance_id, images[image_id], flavors[flavor_id],
+                 mac_address, host)
+            )
+            self.image_cache.acquire(self._image_key(images[image_id]))
 
-        # updating name of instance
-        name = doc_root.find('name')
-        name.text = instance_name
+        #list of (instance id, state) and (instance id, id of mac address)
+        succeeded = []
+        failed = []
+        records = []
+        with ThreadPoolExecutor(self.max_boot_workers) as executor:
+            #every distinct image (images with the same content
+            #are one image) is downloaded once, every pending boot
+            #holds reference of its image
+            references = Counter(
+                self._image_key(item[2]) for item in pending
+            )
+            downloads = dict(
+                (
+                    image_key,
+                    executor.submit(
+                        self._image_processing,
+                        image_id,
+                        image_key,
+                        references[image_key]
+                    )
+                )
+                for image_key, image_id in dict(
+                    (self._image_key(item[2]), item[2].id)
+                    for item in pending
+                ).items()
+            )
 
-        # amount of memory that will be available to instance
-        doc_root.find('memory').text = str(memory)
+            boots = []
+            for i, instance_id, image, flavor, mac_address, host in pending:
+                error = downloads[self._image_key(image)].exception()
+                if error is not None:
+                    results[i]['error'] = error
+                    self.image_cache.release(self._image_key(image))
+                    self.scheduler.release(instance_id)
+                    failed.append((instance_id, mac_address[0]))
+                    continue
 
-        # amount of currentMemory is equal to total memory for this
-        # instance
-        doc_root.find('currentMemory').text = str(memory)
+                boots.append(
+                    (
+                        i,
+                        instance_id,
+                        mac_address,
+                        image,
+                        executor.submit(
+                            self._domain_processing,
+                            results[i]['name'],
+                            image,
+                            flavor,
+                            mac_address[1],
+                            instance_id,
+                            host
+                        ),
+                        host
+                    )
+                )
 
-        # vcpu
-        doc_root.find('vcpu').text = str(vcpu)
+            for i, instance_id, mac_address, image, future, host in boots:
+                error = future.exception()
+                if error is not None:
+                    results[i]['error'] = error
+                    self.image_cache.release(self._image_key(image))
+                    self.scheduler.release(instance_id)
+                    failed.append((instance_id, mac_address[0]))
+                    continue
 
-        # path to image which will be used for booting
-        devices = doc_root.find('devices')
+                domain = future.result()
+                results[i]['id'] = instance_id
 
-        for disk in devices.findall('disk'):
-            if disk.get('type') == 'file':
-                disk.find('source').set(
-                    'file',
-                    os.path.join(
-                        self.path_to_image_storage,
-                        image_id
+                record = InstanceRecord(
+                    instance_id,
+                    results[i]['name'],
+                    mac_address[1],
+                    domain.state(0)[0],
+                    image.id,
+                    domain,
+                    host
+                )
+                records.append((record, mac_address[0]))
+                succeeded.append((instance_id, record.state))
+
+        try:
+            self._finish_boots(succeeded, failed)
+        except:
+            error = sys.exc_info()
+            for record, mac_address_id in records:
+                self._cancel_boot(
+                    record.id,
+                    mac_address_id,
+                    self._image_key(images[record.image_id]),
+                    record.domain
+                )
+            raise error[0], error[1], error[2]
+
+        for record, mac_address_id in records:
+            self.registry.add(record)
+
+        return results
+
+    def _reserve_boots(self, boots, partial=False):
+        '''
+        The first phase of boot: short transaction which reserves
+        mac addresses and inserts pending rows of instances.
+
+        boots is list of (instance id, instance name, image id,
+        name of host).
+
+        Returns: list of (id of mac address, mac address) in order of
+        boots. If partial is True list is shorter than boots when there
+        is not enough free addresses, rows are inserted only for
+        instances which got address.
+        '''
+        with self.tracer.span('db_reserve'):
+            with contexted_session() as s:
+                with self.tracer.span('mac_reserve'):
+                    rows = self.mac_allocator.reserve(
+                        s,
+                        len(boots),
+                        partial=partial
+                    )
+
+                instance_ids = [boot[0] for boot in boots[:len(rows)]]
+                with self.booting_lock:
+                    self.booting.update(instance_ids)
+
+                try:
+                    s.bulk_insert_mappings(
+                        Instance,
+                        [
+                            {
+                                'id': instance_id,
+                                'domain_name': instance_name,
+                                'state': self.PENDING_STATE,
+                                'image_id': image_id,
+                                'host': host,
+                                'mac_addr': row.id
+                            }
+                            for (instance_id, instance_name, image_id,
+                                 host), row
+                            in zip(boots, rows)
+                        ]
+                    )
+
+                    #rows are expired after commit
+                    mac_addresses = [(row.id, row.address) for row in rows]
+                    s.commit()
+                except:
+                    #addresses stay free in database after rollback
+                    self.mac_allocator.discard(rows)
+                    with self.booting_lock:
+                        self.booting.difference_update(instance_ids)
+                    raise
+
+        return mac_addresses
+
+    def _finish_boots(self, succeeded, failed):
+        '''
+        The last phase of boot: short transaction which saves states
+        of created domains and releases reservations of failed boots.
+
+        succeeded is list of (instance id, state of domain),
+        failed is list of (instance id, id of mac address).
+
+        Boots are not in progress after the call, rows which are left
+        pending by failed transaction are recovered later (see
+        _recover_pending_boots).
+        '''
+        try:
+            self._save_boots(succeeded, failed)
+        finally:
+            with self.booting_lock:
+                self.booting.difference_update(
+                    [instance_id for instance_id, _ in succeeded + failed]
+                )
+
+    def _save_boots(self, succeeded, failed):
+        with self.tracer.span('db_commit'):
+            with contexted_session() as s:
+                if succeeded:
+                    s.bulk_update_mappings(
+                        Instance,
+                        [
+                            {
+                                'id': instance_id,
+                                'state': self.domain_state.get(state)
+                            }
+                            for instance_id, state in succeeded
+                        ]
+                    )
+
+                if failed:
+                    instance_ids, mac_address_ids = zip(*failed)
+                    s.query(Instance)\
+                     .filter(Instance.id.in_(instance_ids))\
+                     .delete(synchronize_session=False)
+
+                    self.mac_allocator.release(
+                        s,
+                        s.query(MacAddress)
+                         .filter(MacAddress.id.in_(mac_address_ids))
+                         .all()
+                    )
+
+    def _cancel_boot(self, instance_id, mac_address_id, image_key,
+                     domain=None):
+        '''
+        Undoes boot which failed after the first phase. Cleanup is best
+        effort: pending row which is left in database (e.g. database
+        is not available) is removed later (see _recover_pending_boots).
+        '''
+        if domain is not None:
+            try:
+                domain.destroy()
+            except libvirt.libvirtError:
+                LOG.exception("Failed to destroy domain %s", instance_id)
+
+            if self.use_overlays:
+                self._remove_overlay(instance_id)
+
+        self.image_cache.release(image_key)
+        self.scheduler.release(instance_id)
+
+        try:
+            self._finish_boots([], [(instance_id, mac_address_id)])
+        except Exception:
+            LOG.exception(
+                "Failed to release reservation of instance %s",
+                instance_id
+            )
+
+    def _recover_pending_boots(self):
+        '''
+        Finishes boots which were interrupted (e.g. by crash of process
+        or failure of database) between the first and the last phase
+        at least pending_timeout seconds ago: state of instance whose
+        domain exists is saved, reservation of instance without domain
+        is released. Boots which are in progress in this process are
+        skipped.
+
+        It is called on start and periodically by background thread,
+        so boots interrupted shortly before restart are recovered too.
+        '''
+        since = datetime.utcnow() - timedelta(seconds=self.pending_timeout)
+        with contexted_session() as s:
+            rows = s.query(Instance.id, Instance.mac_addr)\
+                    .filter(Instance.state == self.PENDING_STATE)\
+                    .filter(Instance.created_at < since)\
+                    .all()
+
+        with self.booting_lock:
+            rows = [row for row in rows if row[0] not in self.booting]
+
+        succeeded = []
+        failed = []
+        for instance_id, mac_address_id in rows:
+            record = self.registry.get(instance_id)
+            if record is not None and record.domain is not None:
+                succeeded.append((instance_id, record.state))
+            elif record is not None and \
+                    record.host in self.unreachable_hosts:
+                #domain can exist on host which is not seen now
+                continue
+            else:
+                failed.append((instance_id, mac_address_id))
+                self.registry.remove(instance_id)
+
+        if succeeded or failed:
+            self._finish_boots(succeeded, failed)
+
+    def _domain_processing(self, instance_name, image, flavor, mac_address,
+                           instance_id=None, host=None):
+        '''
+        Creates overlay (if it is needed) and xml config for instance
+        and starts domain. Image should be already present in local
+        image storage. instance_id is uuid of domain (new one is
+        generated if it is not given), overlay is named by it.
+        Domain is started on given host, on the first one by default.
+
+        Returns: domain object
+        '''
+        if instance_id is None:
+            instance_id = str(uuid.uuid4())
+
+        image_key = self._image_key(image)
+        path_to_overlay = None
+        try:
+            if self.use_overlays:
+                with self.tracer.span('overlay_processing'):
+                    path_to_overlay = self._overlay_processing(
+                        instance_id,
+                        image_key,
+                        image.fmt
                     )
+            elif self.image_verifier is not None:
+                #guest writes to image, so it is not verified any more
+                self.image_verifier.mark_written(image_key)
+
+            with self.tracer.span('xml_processing'):
+                xml_config_string = self._xml_processing(
+                    instance_name,
+                    image.id,
+                    flavor.memory,
+                    flavor.vcpu,
+                    mac_address,
+                    path_to_overlay or os.path.join(
+                        self.path_to_image_storage,
+                        image_key
+                    ),
+                    instance_id,
+                    #overlay is always qcow2 whatever format of image is
+                    'qcow2' if path_to_overlay else image.fmt
+                )
+
+            #start domain from xml_configuration_string
+            with self.tracer.span('create_xml', host=host):
+                return self.libvirt_pools.get(host, self.libvirt_pool).call(
+                    'createXML',
+                    xml_config_string,
+                    0
                 )
+        except:
+            if path_to_overlay:
+                self._remove_overlay(instance_id)
+            raise
+
+    def _xml_processing(self, instance_name, image_id, memory, vcpu,
+                        mac_address, path_to_disk=None, instance_id=None,
+                        disk_format=None):
+        '''
+        Builds domain xml config from compiled pattern.
+
+        path_to_disk is source of file disk, if it is not given
+        domain boots right from image in local image storage.
+        disk_format is type of driver of disk, format from pattern
+        is used if it is not given.
+        '''
+        values = {
+            'name': instance_name,
+            'uuid': instance_id,
+            'memory': memory,
+            # amount of currentMemory is equal to total memory for this
+            # instance
+            'current_memory': memory,
+            'vcpu': vcpu,
+            'mac': mac_address,
+            'image_id': image_id
+        }
+
+        if path_to_disk is None:
+            values['disk'] = os.path.join(self.path_to_image_storage, image_id)
+        else:
+            values['disk'] = path_to_disk
+
+        if disk_format:
+            values['disk_format'] = disk_format
+
+        return self.domain_template.render(**values)
+
+    def _overlay_path(self, instance_id):
+        #names of instances are not unique, uuids are
+        return os.path.join(
+            self.path_to_instance_storage,
+            '%s.qcow2' % instance_id
+        )
+
+    def _overlay_processing(self, instance_id, image_key, image_fmt):
+        '''
+        Creates qcow2 overlay for instance with cached image as
+        backing file. Data of image is not copied, so time of
+        creation does not depend on size of image.
+
+        File is created exclusively, OSError is raised if overlay
+        of instance already exists.
+
+        Returns: path to overlay
+        '''
+        path_to_overlay = self._overlay_path(instance_id)
 
-        # mac address for this instance
-        for interface in devices.findall('interface'):
-            if interface.get('type') == 'network':
-                interface.find('mac').set('address', mac_address)
+        #qemu-img overwrites existing file
+        os.close(
+            os.open(path_to_overlay, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                    0o644)
+        )
+        try:
+            subprocess.check_call(
+                [
+                    'qemu-img', 'create', '-q',
+                    '-f', 'qcow2',
+                    '-o', 'backing_file=%s,backing_fmt=%s' % (
+                        os.path.join(self.path_to_image_storage, image_key),
+                        image_fmt
+                    ),
+                    path_to_overlay
+                ]
+            )
+        except:
+            os.remove(path_to_overlay)
+            raise
+
+        return path_to_overlay
 
-        return ElementTree.tostring(doc_root)
+    def _remove_overlay(self, instance_id):
+        path_to_overlay = self._overlay_path(instance_id)
 
-    def _image_processing(self, image_id):
+        if os.path.exists(path_to_overlay):
+            os.remove(path_to_overlay)
+
+    def _image_processing(self, image_id, image_key=None, references=0):
         '''
         Performs serch of image in local image storage directory
-        with image_id param value name. If there exsists
+        with image_key param value name. If there exsists
         such file - do nothing, in other case - download
         image from key-value storage.
+
+        image_key is name of file of image (see _image_key), it is
+        looked up by image_id if it is not given.
+
+        Only one caller (thread or process) downloads given image,
+        others wait for it and reuse downloaded file.
+
+        references is number of references of image held by caller
+        (see ImageCache.acquire), e.g. by boots which are going to use
+        image. Corrupted image which is referenced by nobody else is
+        downloaded again, otherwise ImageIntegrityError is raised.
+        '''
+        if image_key is None:
+            image_key = self._image_keys([image_id])[image_id]
+
+        path_to_image = os.path.join(self.path_to_image_storage, image_key)
+
+        if self.image_cache.lookup(image_key) and \
+                self._image_intact(image_key, references):
+            return
+
+        with self.tracer.span('image_processing', image=image_id):
+            with self.image_downloads.lock(image_key):
+                #image could be downloaded while we were waiting for lock
+                if self.image_cache.lookup(image_key, record_stats=False):
+                    if self._image_intact(image_key, references):
+                        return
+
+                    #corrupted image is removed under lock,
+                    #so nobody boots from it before it is replaced
+                    if not self.image_cache.discard(image_key, references):
+                        raise ImageIntegrityError(
+                            "Corrupted image %s is used by running "
+                            "instances" % image_key
+                        )
+
+                with self.tracer.span('image_download', image=image_id):
+                    grout = self.grfs.get(ObjectId(image_id))
+                    self.image_cache.reserve(grout.length)
+                    logical_size, allocated_size, _ = self._download_image(
+                        grout,
+                        path_to_image
+                    )
+
+                self.image_cache.add(image_key, allocated_size, logical_size)
+
+    def _image_intact(self, image_key, references=0):
+        '''
+        Checks cached image by its checksum file (see
+        src.image_integrity). references is number of references
+        of image held by caller.
+
+        Returns: False if image is corrupted
+        '''
+        if self.image_verifier is None:
+            return True
+
+        #guests write to images they boot from without overlays
+        #(such images are not verified, see ImageVerifier.mark_written),
+        #references of caller itself are allowed
+        if not self.use_overlays and \
+                self.image_cache.references[image_key] > references:
+            return True
+
+        with self.tracer.span('image_verify', image=image_key):
+            return self.image_verifier.verify(image_key)
+
+    def _download_image(self, grout, path_to_image):
+        '''
+        Copies image from gridfs output object to path_to_image
+        chunk by chunk, so at most IMAGE_CHUNK_SIZE bytes of image
+        are kept in memory at once.
+
+        Data is written to hidden temporary file in the same directory
+        and renamed to path_to_image only after it was completely
+        flushed to disk. So crashed download never leaves truncated file
+        under the name that is checked in _image_processing.
+
+        Blocks of zeros are not written (see _write_sparse).
+
+        sha256 of image is computed from the same chunks and saved to
+        checksum file of image. Image which is named by sha256 of its
+        content (see _image_key) is not saved if its sha256 differs,
+        ImageIntegrityError is raised instead.
+
+        Returns: (logical size of image, bytes allocated on disk, sha256)
+        '''
+        path_to_tmp, logical_size, allocated_size, sha256 = \
+            self._fetch_image(grout, path_to_image)
+        self._publish_image(path_to_tmp, path_to_image, sha256)
+
+        return logical_size, allocated_size, sha256
+
+    def _fetch_image(self, grout, path_to_image):
+        '''
+        The first part of _download_image: image is written to hidden
+        temporary file next to path_to_image and checked. File is
+        removed if download fails, otherwise caller should publish it
+        by _publish_image or remove it.
+
+        Returns: (path to temporary file, logical size of image,
+        bytes allocated on disk, sha256)
+        '''
+        storage_dir, image_name = os.path.split(path_to_image)
+        fd, path_to_tmp = tempfile.mkstemp(
+            prefix='.%s.' % image_name,
+            suffix='.part',
+            dir=storage_dir
+        )
+
+        try:
+            logical_size = 0
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = grout.read(self.IMAGE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+
+                    digest.update(chunk)
+                    if self.sparse_images:
+                        self._write_sparse(f, chunk)
+                    else:
+                        f.write(chunk)
+                    logical_size += len(chunk)
+
+                #file which ends with zeros ends with hole,
+                #its size is set explicitly
+                f.truncate(logical_size)
+                f.flush()
+                os.fsync(f.fileno())
+
+                allocated_size = os.fstat(f.fileno()).st_blocks * 512
+
+            sha256 = digest.hexdigest()
+            expected = expected_sha256(image_name)
+            if expected is not None and sha256 != expected:
+                raise ImageIntegrityError(
+                    "Downloaded image %s has sha256 %s" % (image_name, sha256)
+                )
+        except:
+            if os.path.exists(path_to_tmp):
+                os.remove(path_to_tmp)
+            raise
+
+        return path_to_tmp, logical_size, allocated_size, sha256
+
+    def _publish_image(self, path_to_tmp, path_to_image, sha256):
         '''
-        path_to_image = os.path.join(self.path_to_image_storage, image_id)
+        The last part of _download_image: temporary file made by
+        _fetch_image is renamed to path_to_image and its checksum
+        file is written.
+        '''
+        try:
+            #rename is atomic inside of one filesystem
+            os.rename(path_to_tmp, path_to_image)
+        except:
+            if os.path.exists(path_to_tmp):
+                os.remove(path_to_tmp)
+            raise
+
+        #image without checksum file is re-hashed on next boot
+        write_checksum(path_to_image, sha256)
 
-        if not os.path.exists(path_to_image):
-            with pymongo.MongoClient() as client:
-                storage = client.image_storage
-                grfs = gridfs.GridFS(storage)
+    def _write_sparse(self, f, chunk):
+        '''
+        Writes chunk to file, but seeks past blocks of
+        SPARSE_BLOCK_SIZE bytes which consist of zeros only,
+        so they become holes of sparse file and are not
+        allocated on disk.
+        '''
+        block_size = self.SPARSE_BLOCK_SIZE
+        zero_block = '\0' * block_size
 
-                with open(path_to_image, 'wb') as f:
-                    grout = grfs.get(ObjectId(image_id))
-                    f.write(grout.read())
+        #start of data which is not written yet
+        start = 0
+        for offset in xrange(0, len(chunk), block_size):
+            block = chunk[offset:offset + block_size]
+            if block != zero_block[:len(block)]:
+                continue
 
-    def instance_reboot(self, instance_id):
-        pass
+            if start < offset:
+                f.write(chunk[start:offset])
+            f.seek(len(block), os.SEEK_CUR)
+            start = offset + len(block)
 
-    def instance_shutdown(self, instance_id):
-        pass
+        if start < len(chunk):
+            f.write(chunk[start:])
 
-    def instance_destroy(self, instance_id):
-        pass
+    def close(self):
+        '''
+        Closes connections to libvirt driver and external storages.
+        '''
+        self.maintenance_stopped.set()
+        if self.maintenance_thread is not None:
+            self.maintenance_thread.join()
+            self.maintenance_thread = None
 
-    def image_list(self):
-        pass
+        if self.image_scrubber is not None:
+            self.image_scrubber.stop()
 
-    def flavor_list(self):
-        pass
+        if self.image_prefetcher is not None:
+            self.image_prefetcher.stop()
+
+        self.lifecycle_executor.shutdown(wait=True)
+        self.state_waiter.stop()
+
+        for state_tracker in self.state_trackers:
+            state_tracker.stop()
+
+        for pool in self.libvirt_pools.values():
+            pool.close()
+        self.mongo_client.close()
+
+        self.tracer.close()
+
+    def _record(self, instance_id):
+        record = self.registry.get(instance_id)
+        if record is None or record.domain is None:
+            raise NoResultFound("No instance with id %s" % instance_id)
+
+        return record
+
+    def _domain(self, record):
+        '''
+        Domain handle is bound to connection it was got by, if that
+        connection is dead (e.g. libvirtd was restarted) domain is
+        looked up again by uuid on host of instance.
+
+        Returns: domain of record
+        '''
+        domain = record.domain
+        if not is_alive(domain.connect()):
+            pool = self.libvirt_pools.get(record.host, self.libvirt_pool)
+            domain = pool.call('lookupByUUIDString', record.id)
+            record.domain = domain
+
+        return domain
+
+    def _fan_out(self, instance_ids, operation, *args):
+        '''
+        Calls operation for one id or for every id of list.
+        Returns: future or list of futures in order of ids
+        '''
+        if isinstance(instance_ids, basestring):
+            return operation(instance_ids, *args)
+
+        return [operation(instance_id, *args) for instance_id in instance_ids]
+
+    def _lifecycle_operation(self, name, instance_id, call, states, timeout,
+                             on_timeout=None, transition=False):
+        '''
+        Calls call(domain) on lifecycle pool and waits until instance
+        reaches one of states. If wait timed out on_timeout (if given)
+        is called on pool instead of failing. If transition is True
+        state counts only after transition seen after the call (for
+        operations which keep state, e.g. reboot).
+
+        Returns: future resolved by reached state
+        '''
+        result = Future()
+
+        #span lasts until target state is reached
+        span = self.tracer.start(name, instance=instance_id)
+        result.add_done_callback(
+            lambda future: span.finish(future.exception())
+        )
+
+        def do_call():
+            record = self._record(instance_id)
+            #transitions are counted before call, so event which
+            #arrives before call returns is not missed
+            transitions = record.transitions if transition else None
+            with self.tracer.span('%s_call' % name):
+                call(self._domain(record))
+            return transitions
+
+        def waited(future):
+            if on_timeout is not None and \
+                    isinstance(future.exception(), StateTimeoutError):
+                try:
+                    escalated = self.lifecycle_executor.submit(
+                        on_timeout,
+                        instance_id
+                    )
+                except RuntimeError as e:
+                    #pool was shut down by close
+                    result.set_exception(e)
+                else:
+                    chain_future(escalated, result)
+            else:
+                chain_future(future, result)
+
+        def called(future):
+            if future.exception() is not None:
+                chain_future(future, result)
+            else:
+                self.state_waiter.wait(
+                    instance_id,
+                    states,
+                    timeout,
+                    future.result()
+                ).add_done_callback(waited)
+
+        self.lifecycle_executor.submit(do_call).add_done_callback(called)
+
+        return result
+
+    def _reboot(self, instance_id, timeout):
+        return self._lifecycle_operation(
+            'instance_reboot',
+            instance_id,
+            lambda domain: domain.reboot(0),
+            [libvirt.VIR_DOMAIN_RUNNING],
+            timeout,
+            #reboot is seen only by events, polls see running domain
+            transition=bool(self.state_trackers)
+        )
+
+    def _shutdown(self, instance_id, timeout, force):
+        future = self._lifecycle_operation(
+            'instance_shutdown',
+            instance_id,
+            lambda domain: domain.shutdown(),
+            [libvirt.VIR_DOMAIN_SHUTOFF],
+            timeout,
+            self._destroy if force else None
+        )
+
+        def shut_off(future):
+            #domain which is shut off does not use resources of its host
+            if future.exception() is None:
+                self.scheduler.release(instance_id)
+
+        future.add_done_callback(shut_off)
+
+        return future
+
+    def instance_reboot(self, instance_ids, timeout=None):
+        '''
+        Reboots one instance (instance_ids is uuid) or many
+        (instance_ids is list of uuids) in parallel.
+
+        If states are tracked by events future is resolved after reboot
+        event (or change of state) of domain, otherwise states are polled
+        and reboot is only acknowledged by running domain.
+
+        Returns: future (list of futures) resolved when domain is
+        running, failed with StateTimeoutError after timeout seconds
+        '''
+        if timeout is None:
+            timeout = self.reboot_timeout
+
+        return self._fan_out(instance_ids, self._reboot, timeout)
+
+    def instance_shutdown(self, instance_ids, timeout=None, force=None):
+        '''
+        Gracefully shuts down one instance or many in parallel.
+        If domain is not shut off in timeout seconds it is destroyed
+        (unless force is False, then future fails with StateTimeoutError).
+
+        Returns: future (list of futures) resolved when domain is shut off
+        '''
+        if timeout is None:
+            timeout = self.shutdown_timeout
+        if force is None:
+            force = self.escalate_shutdown
+
+        return self._fan_out(instance_ids, self._shutdown, timeout, force)
+
+    def _destroy_domain(self, instance_id):
+        '''
+        Destroys domain with given uuid, domain which is gone already
+        (transient domains disappear when they are shut off) is fine.
+
+        Returns: (record of instance, id of its image)
+        '''
+        record = self._record(instance_id)
+        image_id = record.image_id
+
+        with self.tracer.span('instance_destroy', instance=instance_id):
+            try:
+                domain = self._domain(record)
+
+                #image is known by xml of domain which exists
+                if image_id is None:
+                    try:
+                        image_id = self._domain_image_id(domain)
+                    except libvirt.libvirtError:
+                        pass
+
+                domain.destroy()
+            except libvirt.libvirtError as e:
+                if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                    raise
+
+        return record, image_id
+
+    def _forget(self, destroyed):
+        '''
+        Deletes rows of destroyed instances and frees their mac
+        addresses by one short transaction, then removes instances
+        from registry and releases their images, overlays and
+        resources of hosts.
+
+        destroyed is list of (record, image id) returned by
+        _destroy_domain. If transaction fails records are kept,
+        so destroy can be repeated.
+        '''
+        instance_ids = [record.id for record, image_id in destroyed]
+
+        with self.tracer.span('db_release'):
+            with contexted_session() as s:
+                mac_address_ids = [
+                    mac_address_id for (mac_address_id,) in
+                    s.query(Instance.mac_addr)
+                     .filter(Instance.id.in_(instance_ids))
+                    if mac_address_id is not None
+                ]
+
+                s.query(Instance)\
+                 .filter(Instance.id.in_(instance_ids))\
+                 .delete(synchronize_session=False)
+
+                if mac_address_ids:
+                    self.mac_allocator.release(
+                        s,
+                        s.query(MacAddress)
+                         .filter(MacAddress.id.in_(mac_address_ids))
+                         .all()
+                    )
+
+        image_ids = [image_id for record, image_id in destroyed if image_id]
+        keys = self._image_keys(image_ids) if image_ids else {}
+
+        for record, image_id in destroyed:
+            self.registry.remove(record.id)
+            self.scheduler.release(record.id)
+
+            if image_id:
+                self.image_cache.release(keys[image_id])
+
+            if self.use_overlays:
+                self._remove_overlay(record.id)
+
+    def _destroy(self, instance_id):
+        '''
+        Destroys domain with given uuid and forgets instance.
+        '''
+        self._forget([self._destroy_domain(instance_id)])
+
+        return libvirt.VIR_DOMAIN_SHUTOFF
+
+    def _destroy_many(self, instance_ids):
+        '''
+        Destroys domains in parallel, rows of all destroyed instances
+        are deleted by one transaction after the last domain is
+        destroyed.
+
+        Returns: list of futures in order of ids
+        '''
+        results = [Future() for instance_id in instance_ids]
+        if not instance_ids:
+            return results
+
+        destroys = [
+            self.lifecycle_executor.submit(self._destroy_domain, instance_id)
+            for instance_id in instance_ids
+        ]
+        remaining = [len(destroys)]
+        lock = threading.Lock()
+
+        def forget():
+            destroyed = []
+            for result, future in zip(results, destroys):
+                if future.exception() is not None:
+                    result.set_exception(future.exception())
+                else:
+                    destroyed.append((result, future.result()))
+
+            if not destroyed:
+                return
+
+            try:
+                self._forget([item for result, item in destroyed])
+            except Exception as e:
+                for result, item in destroyed:
+                    result.set_exception(e)
+            else:
+                for result, item in destroyed:
+                    result.set_result(libvirt.VIR_DOMAIN_SHUTOFF)
+
+        def destroyed(future):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+
+            try:
+                self.lifecycle_executor.submit(forget)
+            except RuntimeError as e:
+                #pool was shut down by close
+                for result in results:
+                    result.set_exception(e)
+
+        for future in destroys:
+            future.add_done_callback(destroyed)
+
+        return results
+
+    def instance_destroy(self, instance_ids):
+        '''
+        Destroys one instance or many in parallel. Rows of instances
+        are deleted and their mac addresses are freed.
+
+        Returns: future (list of futures) resolved when domain is destroyed
+        '''
+        if isinstance(instance_ids, basestring):
+            return self.lifecycle_executor.submit(self._destroy, instance_ids)
+
+        return self._destroy_many(instance_ids)
+
+    def image_list(self, marker=None, limit=None, name=None, fmt=None,
+                   min_size=None, max_size=None, with_total=False):
+        '''
+        Returns: Page of images metadata (id, name, fmt, size, sha256) ordered
+        by id and following image with id marker. Next page is
+        requested with marker=page.next_marker.
+
+        name is prefix of name of image, size is in bytes.
+        '''
+        return self.metadata_cache.page(
+            'image',
+            marker,
+            limit or self.page_size,
+            with_total,
+            name=name,
+            fmt=fmt,
+            min_size=min_size,
+            max_size=max_size
+        )
+
+    def flavor_list(self, marker=None, limit=None, name=None,
+                    min_vcpu=None, min_memory=None, with_total=False):
+        '''
+        Returns: Page of flavors (id, name, vcpu, memory),
+        see image_list
+        '''
+        return self.metadata_cache.page(
+            'flavor',
+            marker,
+            limit or self.page_size,
+            with_total,
+            name=name,
+            min_vcpu=min_vcpu,
+            min_memory=min_memory
+        )
@@ -0,0 +1,295 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides placement of instances on several libvirt hosts.
+
+Scheduler keeps in-memory index of capacity of hosts: free memory,
+free vcpus and images which were booted on every host. Index is
+updated incrementally: boot claims memory and vcpus of flavor on
+chosen host (claim is released if boot fails), destroy releases them.
+Hosts are kept in list sorted by free memory and every image is
+mapped to hosts which have it, so usually host is chosen without
+scan of all hosts:
+
+    - spread: host with the most free memory (end of sorted list)
+    - pack: host with the least free memory which fits flavor
+      (found by binary search)
+    - image_locality: the most free of hosts which have image already,
+      spread over all hosts if none of them fits flavor
+
+Strategy is object with select(scheduler, memory, vcpu, image_key)
+method which returns HostState or None (see STRATEGIES), it is called
+under lock of scheduler.
+
+Memory is in KiB (as memory of flavors and domains), images are
+names of files in local image storage (see NovaMimic._image_key).
+'''
+
+import bisect
+import threading
+
+
+class SchedulerError(Exception):
+    pass
+
+
+class NoValidHost(SchedulerError):
+    pass
+
+
+def parse_hosts(value):
+    '''
+    Parses comma separated list of hosts given as name=uri
+    (e.g. "node1=qemu+ssh://node1/system,node2=qemu+ssh://node2/system").
+
+    Returns: list of (name, uri)
+    '''
+    hosts = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+
+        name, separator, uri = item.partition('=')
+        name = name.strip()
+        uri = uri.strip()
+        if not separator or not name or not uri:
+            raise SchedulerError("Invalid host %s, expected name=uri" % item)
+        if name in dict(hosts):
+            raise SchedulerError("Duplicate host %s" % name)
+
+        hosts.append((name, uri))
+
+    return hosts
+
+
+class HostState(object):
+    __slots__ = ('name', 'memory', 'vcpu', 'free_memory', 'free_vcpu',
+                 'images', 'instances')
+
+    def __init__(self, name, memory, vcpu):
+        self.name = name
+        #resources which can be given to instances
+        self.memory = memory
+        self.vcpu = vcpu
+        self.free_memory = memory
+        self.free_vcpu = vcpu
+        #keys of images which were booted on host
+        self.images = set()
+        self.instances = 0
+
+    def fits(self, memory, vcpu):
+        return self.free_memory >= memory and self.free_vcpu >= vcpu
+
+
+class SpreadStrategy(object):
+    '''
+    Chooses host with the most free memory, so instances are
+    spread over hosts evenly.
+    '''
+    def select(self, scheduler, memory, vcpu, image_key=None):
+        by_memory = scheduler.by_memory
+        for i in xrange(len(by_memory) - 1, -1, -1):
+            free_memory, name = by_memory[i]
+            if free_memory < memory:
+                break
+
+            host = scheduler.hosts[name]
+            if host.free_vcpu >= vcpu:
+                return host
+
+        return None
+
+
+class PackStrategy(object):
+    '''
+    Chooses host with the least free memory which fits flavor,
+    so hosts are filled one by one and large flavors still find
+    empty hosts.
+    '''
+    def select(self, scheduler, memory, vcpu, image_key=None):
+        by_memory = scheduler.by_memory
+        #(memory,) is less than any (memory, name)
+        for i in xrange(bisect.bisect_left(by_memory, (memory,)),
+                        len(by_memory)):
+            host = scheduler.hosts[by_memory[i][1]]
+            if host.free_vcpu >= vcpu:
+                return host
+
+        return None
+
+
+class ImageLocalityStrategy(object):
+    '''
+    Chooses the most free of hosts which booted image before,
+    other hosts are chosen by fallback strategy.
+    '''
+    def __init__(self, fallback=None):
+        self.fallback = fallback or SpreadStrategy()
+
+    def select(self, scheduler, memory, vcpu, image_key=None):
+        chosen = None
+        for name in scheduler.by_image.get(image_key, ()):
+            host = scheduler.hosts[name]
+            if host.fits(memory, vcpu) and \
+                    (chosen is None or host.free_memory > chosen.free_memory):
+                chosen = host
+
+        if chosen is not None:
+            return chosen
+
+        return self.fallback.select(scheduler, memory, vcpu, image_key)
+
+
+STRATEGIES = {
+    'spread': SpreadStrategy,
+    'pack': PackStrategy,
+    'image_locality': ImageLocalityStrategy
+}
+
+
+class Scheduler(object):
+    def __init__(self, strategy='spread'):
+        '''
+        strategy is name of one of STRATEGIES or strategy object.
+        '''
+        if isinstance(strategy, basestring):
+            if strategy not in STRATEGIES:
+                raise SchedulerError("Unknown strategy: %s" % strategy)
+            strategy = STRATEGIES[strategy]()
+        self.strategy = strategy
+
+        #key - name of host, value - HostState
+        self.hosts = {}
+        #(free memory, name of host) sorted by free memory
+        self.by_memory = []
+        #key - image key, value - set of names of hosts
+        self.by_image = {}
+        #key - instance id, value - (name of host, memory, vcpu)
+        self.placements = {}
+
+        self.stats = {
+            'placed': 0,
+            'no_valid_host': 0
+        }
+        self.lock = threading.Lock()
+
+    def add_host(self, name, memory, vcpu):
+        with self.lock:
+            if name in self.hosts:
+                raise SchedulerError("Duplicate host %s" % name)
+
+            self.hosts[name] = HostState(name, memory, vcpu)
+            bisect.insort(self.by_memory, (memory, name))
+
+    def resize_host(self, name, memory, vcpu):
+        '''
+        Changes resources of host (e.g. host which was unreachable
+        got known capacity), claims of instances on host are kept.
+        '''
+        with self.lock:
+            if name not in self.hosts:
+                raise SchedulerError("Unknown host %s" % name)
+
+            host = self.hosts[name]
+            self._update(host, memory - host.memory, vcpu - host.vcpu)
+            host.memory = memory
+            host.vcpu = vcpu
+
+    def _update(self, host, memory, vcpu):
+        '''
+        Adds memory and vcpu (negative to take) to free resources
+        of host, sorted list of hosts is kept sorted.
+        '''
+        del self.by_memory[
+            bisect.bisect_left(self.by_memory, (host.free_memory, host.name))
+        ]
+        host.free_memory += memory
+        host.free_vcpu += vcpu
+        bisect.insort(self.by_memory, (host.free_memory, host.name))
+
+    def claim(self, instance_id, memory, vcpu, image_key=None, host=None):
+        '''
+        Chooses host for instance by strategy and takes memory
+        and vcpu from its free resources.
+
+        If host is given (e.g. instance is running already) it is not
+        chosen and not checked, so its free resources can become
+        negative.
+
+        Returns: name of host
+        '''
+        with self.lock:
+            if instance_id in self.placements:
+                raise SchedulerError(
+                    "Instance %s is placed already" % instance_id
+                )
+
+            if host is None:
+                state = self.strategy.select(self, memory, vcpu, image_key)
+                if state is None:
+                    self.stats['no_valid_host'] += 1
+                    raise NoValidHost(
+                        "No host has %s KiB of memory and %s vcpus free" % (
+                            memory,
+                            vcpu
+                        )
+                    )
+            elif host in self.hosts:
+                state = self.hosts[host]
+            else:
+                raise SchedulerError("Unknown host %s" % host)
+
+            self._update(state, -memory, -vcpu)
+            state.instances += 1
+            if image_key is not None and image_key not in state.images:
+                state.images.add(image_key)
+                self.by_image.setdefault(image_key, set()).add(state.name)
+
+            self.placements[instance_id] = (state.name, memory, vcpu)
+            self.stats['placed'] += 1
+
+            return state.name
+
+    def release(self, instance_id):
+        '''
+        Gives resources claimed by instance back to its host.
+        Image stays on host, since its file is not removed by destroy.
+
+        Returns: name of host or None if instance is not placed
+        '''
+        with self.lock:
+            placement = self.placements.pop(instance_id, None)
+            if placement is None:
+                return None
+
+            name, memory, vcpu = placement
+            state = self.hosts[name]
+            self._update(state, memory, vcpu)
+            state.instances -= 1
+
+            return name
+
+    def statistics(self):
+        '''
+        Returns: dict with counters of placements and resources
+        of every host
+        '''
+        with self.lock:
+            statistics = dict(self.stats)
+            statistics['hosts'] = dict(
+                (
+                    name,
+                    {
+                        'memory': host.memory,
+                        'vcpu': host.vcpu,
+                        'free_memory': host.free_memory,
+                        'free_vcpu': host.free_vcpu,
+                        'images': len(host.images),
+                        'instances': host.instances
+                    }
+                )
+                for name, host in self.hosts.items()
+            )
+
+        return statistics
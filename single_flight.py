@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides per key locking that works both between threads
+of one process and between processes of one host.
+
+Main purpose is deduplication of image downloads: only one
+caller downloads image, others wait on the lock and then reuse
+the file that was downloaded.
+
+Threads are serialized by ordinary threading locks (one lock
+per key), processes - by flock on lock file which is kept in
+given directory (one hidden file per key). Lock files are not
+removed after use since removing file that can be locked by
+another process at the same moment is racy.
+'''
+
+import os
+import os.path
+import fcntl
+import threading
+from contextlib import contextmanager
+
+
+class SingleFlight(object):
+    def __init__(self, path_to_lock_dir):
+        self.path_to_lock_dir = path_to_lock_dir
+
+        #key - name of flight, value - [lock, number of users]
+        self.locks = {}
+        self.guard = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.path_to_lock_dir, '.%s.lock' % key)
+
+    def _thread_lock(self, key):
+        with self.guard:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def _release_thread_lock(self, key):
+        with self.guard:
+            entry = self.locks[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+    @contextmanager
+    def lock(self, key):
+        '''
+        Holds exclusive lock for key inside of with block.
+        '''
+        thread_lock = self._thread_lock(key)
+        try:
+            with thread_lock:
+                fd = os.open(self._path(key), os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(fd, fcntl.LOCK_UN)
+                finally:
+                    os.close(fd)
+        finally:
+            self._release_thread_lock(key)
@@ -0,0 +1,197 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides tracking of domains states by libvirt lifecycle events.
+
+Tracker keeps its own connection to libvirt driver with registered
+lifecycle and reboot callbacks (callbacks are called from libvirt default
+event loop, see src.libvirt_pool.start_event_loop). Every event updates
+registry of instances at once and is put into dict of pending changes,
+so several events of one domain are coalesced into the last state.
+
+Pending changes are written to instance table periodically by
+background thread: one UPDATE statement per distinct state.
+
+If connection is lost tracker reconnects and compares states of all
+domains (one call of driver) with registry, since events that
+happened meanwhile are lost.
+'''
+
+import logging
+import threading
+from collections import defaultdict
+
+import libvirt
+
+from src.database_toolkit import Instance, contexted_session
+from src.libvirt_pool import start_event_loop, is_alive, close_quietly
+
+LOG = logging.getLogger(__name__)
+
+#key - lifecycle event, value - state domain is in after event.
+#Events which do not change state (defined, undefined) are absent
+EVENT_STATES = {
+    libvirt.VIR_DOMAIN_EVENT_STARTED: libvirt.VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_SUSPENDED: libvirt.VIR_DOMAIN_PAUSED,
+    libvirt.VIR_DOMAIN_EVENT_RESUMED: libvirt.VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_STOPPED: libvirt.VIR_DOMAIN_SHUTOFF,
+    libvirt.VIR_DOMAIN_EVENT_SHUTDOWN: libvirt.VIR_DOMAIN_SHUTDOWN,
+    libvirt.VIR_DOMAIN_EVENT_PMSUSPENDED: libvirt.VIR_DOMAIN_PMSUSPENDED,
+    libvirt.VIR_DOMAIN_EVENT_CRASHED: libvirt.VIR_DOMAIN_CRASHED
+}
+
+
+class StateTracker(object):
+    def __init__(self, registry, state_names, uri='qemu:///system',
+                 flush_interval=1.0):
+        '''
+        state_names maps libvirt states to values which
+        are written to instance table.
+        '''
+        self.registry = registry
+        self.state_names = state_names
+        self.uri = uri
+        self.flush_interval = flush_interval
+
+        #key - uuid of domain, value - last state
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        self.connection = None
+        self.callback_ids = []
+
+        self.stopped = threading.Event()
+        self.flusher = None
+
+    def _on_lifecycle(self, connection, domain, event, detail, opaque):
+        state = EVENT_STATES.get(event)
+        if state is not None:
+            self.record(domain.UUIDString(), state)
+
+    def _on_reboot(self, connection, domain, opaque):
+        #guest reboot keeps domain running, so only registry is told
+        self.registry.mark_rebooted(domain.UUIDString())
+
+    def record(self, instance_id, state):
+        '''
+        Registers state change of instance.
+        '''
+        self.registry.update_state(instance_id, state)
+        with self.lock:
+            self.pending[instance_id] = state
+
+    def _connect(self):
+        start_event_loop()
+
+        self.connection = libvirt.open(self.uri)
+        self.callback_ids = [
+            self.connection.domainEventRegisterAny(
+                None,
+                event_id,
+                callback,
+                None
+            )
+            for event_id, callback in (
+                (libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_lifecycle),
+                (libvirt.VIR_DOMAIN_EVENT_ID_REBOOT, self._on_reboot)
+            )
+        ]
+
+    def _disconnect(self):
+        if self.connection is None:
+            return
+
+        for callback_id in self.callback_ids:
+            try:
+                self.connection.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError:
+                pass
+        self.callback_ids = []
+
+        close_quietly(self.connection)
+        self.connection = None
+
+    def _resync(self):
+        '''
+        Records states of domains which differ from registry.
+        '''
+        for domain, stats in self.connection.getAllDomainStats(
+            libvirt.VIR_DOMAIN_STATS_STATE
+        ):
+            record = self.registry.get(domain.UUIDString())
+            state = stats.get('state.state')
+            if record is not None and record.state != state:
+                self.record(record.id, state)
+
+    def flush(self):
+        '''
+        Writes pending changes to database.
+        '''
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        if not pending:
+            return
+
+        by_state = defaultdict(list)
+        for instance_id, state in pending.items():
+            by_state[state].append(instance_id)
+
+        try:
+            with contexted_session() as s:
+                for state, instance_ids in by_state.items():
+                    s.query(Instance)\
+                     .filter(Instance.id.in_(instance_ids))\
+                     .update(
+                         {'state': self.state_names.get(state, state)},
+                         synchronize_session=False
+                     )
+        except:
+            #changes are returned back unless newer ones arrived
+            with self.lock:
+                for instance_id, state in pending.items():
+                    self.pending.setdefault(instance_id, state)
+            raise
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                if self.connection is None or not is_alive(self.connection):
+                    self._disconnect()
+                    self._connect()
+                    self._resync()
+
+                self.flush()
+            except Exception:
+                #database or libvirt driver is not available,
+                #next attempt is made on next tick
+                LOG.exception("Failed to synchronize states of instances")
+
+    def start(self):
+        try:
+            self._connect()
+        except libvirt.libvirtError:
+            #host is unreachable, background thread reconnects
+            LOG.exception("Failed to connect to %s", self.uri)
+            self._disconnect()
+
+        self.stopped.clear()
+        self.flusher = threading.Thread(
+            target=self._run,
+            name='state-tracker-flusher'
+        )
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def stop(self):
+        '''
+        Stops background thread, writes last changes
+        and closes connection.
+        '''
+        self.stopped.set()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+
+        self._disconnect()
+        self.flush()
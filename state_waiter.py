@@ -0,0 +1,222 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides waiting for domains to reach given states.
+
+Waiter returns future which is resolved when instance reaches one of
+target states or is failed with StateTimeoutError when timeout expires.
+Wait can require transition seen after given number of transitions of
+record (see InstanceRecord.transitions), e.g. reboot of running domain.
+All waits are served by one background thread, which sleeps on
+condition of instance registry and wakes up on every change of state,
+so thousands of waits do not occupy threads of lifecycle operations.
+
+States in registry are changed by libvirt events (see StateTracker).
+If events are not tracked waiter polls states of waited domains itself
+every poll_interval seconds.
+'''
+
+import time
+import threading
+
+import libvirt
+from concurrent.futures import Future
+
+from src.database_toolkit import NoResultFound
+
+
+class StateTimeoutError(Exception):
+    pass
+
+
+def chain_future(source, target):
+    '''
+    Resolves target future by result or exception of source one.
+    '''
+    def done(future):
+        error = future.exception()
+        if error is not None:
+            target.set_exception(error)
+        else:
+            target.set_result(future.result())
+
+    source.add_done_callback(done)
+
+
+class StateWaiter(object):
+    def __init__(self, registry, poll_interval=None, lookup=None):
+        '''
+        poll_interval is number of seconds between polls of domains,
+        None if states in registry are updated by events.
+        lookup(record) returns domain of record which is polled
+        (e.g. looked up again after reconnect), record.domain is
+        polled if it is not given.
+        '''
+        self.registry = registry
+        self.poll_interval = poll_interval
+        self.lookup = lookup
+
+        #list of (instance id, target states, deadline, transitions,
+        #future)
+        self.waiters = []
+        self.thread = None
+        self.stopped = False
+
+    def wait(self, instance_id, states, timeout=None, transitions=None):
+        '''
+        If transitions is given instance has to make more transitions
+        than that before its state counts.
+
+        Returns: future resolved by state which instance has reached.
+        Instance removed from registry is considered to be shut off.
+        '''
+        future = Future()
+        deadline = time.time() + timeout if timeout is not None else None
+
+        with self.registry.changed:
+            self.waiters.append(
+                (instance_id, frozenset(states), deadline, transitions, future)
+            )
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run,
+                    name='state-waiter'
+                )
+                self.thread.daemon = True
+                self.thread.start()
+            self.registry.changed.notify_all()
+
+        return future
+
+    def _poll(self):
+        '''
+        Reads states of waited domains from libvirt driver.
+        '''
+        with self.registry.changed:
+            instance_ids = set(waiter[0] for waiter in self.waiters)
+
+        for instance_id in instance_ids:
+            record = self.registry.get(instance_id)
+            if record is None or record.domain is None:
+                continue
+
+            try:
+                if self.lookup is not None:
+                    domain = self.lookup(record)
+                else:
+                    domain = record.domain
+                state = domain.state(0)[0]
+            except libvirt.libvirtError as e:
+                #transient domain disappears when it is shut off
+                if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                    continue
+                state = libvirt.VIR_DOMAIN_SHUTOFF
+
+            if state != record.state:
+                self.registry.update_state(instance_id, state)
+
+    def _collect(self):
+        '''
+        Removes finished waits from list of waiters.
+        Returns: list of (future, state, exception)
+        '''
+        now = time.time()
+        finished = []
+        waiting = []
+
+        for waiter in self.waiters:
+            instance_id, states, deadline, transitions, future = waiter
+
+            record = self.registry.get(instance_id)
+            state = record.state if record is not None \
+                else libvirt.VIR_DOMAIN_SHUTOFF
+            changed = transitions is None or record is None or \
+                record.transitions > transitions
+
+            if state in states and changed:
+                finished.append((future, state, None))
+            elif record is None:
+                finished.append((
+                    future,
+                    None,
+                    NoResultFound("No instance with id %s" % instance_id)
+                ))
+            elif self.stopped:
+                finished.append((
+                    future,
+                    None,
+                    RuntimeError("Waiter of states is stopped")
+                ))
+            elif deadline is not None and deadline <= now:
+                finished.append((
+                    future,
+                    None,
+                    StateTimeoutError(
+                        "Instance %s has not reached states %s, "
+                        "it is in state %s%s" % (
+                            instance_id,
+                            sorted(states),
+                            state,
+                            '' if changed else ' without transition'
+                        )
+                    )
+                ))
+            else:
+                waiting.append(waiter)
+
+        self.waiters = waiting
+
+        return finished
+
+    def _sleep_time(self):
+        '''
+        Returns: seconds till next check, None if there is nothing to wait
+        '''
+        if not self.waiters:
+            return None
+
+        times = [
+            deadline - time.time()
+            for _, _, deadline, _, _ in self.waiters
+            if deadline is not None
+        ]
+        if self.poll_interval:
+            times.append(self.poll_interval)
+
+        if not times:
+            return None
+
+        return max(min(times), 0)
+
+    def _run(self):
+        while True:
+            if self.poll_interval:
+                self._poll()
+
+            with self.registry.changed:
+                finished = self._collect()
+                if not finished:
+                    if self.stopped:
+                        self.thread = None
+                        return
+                    self.registry.changed.wait(self._sleep_time())
+
+            #callbacks of futures are called without lock
+            for future, state, error in finished:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(state)
+
+    def stop(self):
+        '''
+        Fails all waits which are in progress (by RuntimeError, so
+        they are not taken for timeouts).
+        '''
+        with self.registry.changed:
+            self.stopped = True
+            self.registry.changed.notify_all()
+            thread = self.thread
+
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,293 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+from collections import defaultdict
+
+import libvirt
+import trollius as asyncio
+from trollius import From
+from concurrent.futures import Future
+from mock import Mock
+
+from src.async_nova_mimic import AsyncNovaMimic
+from src.metadata_cache import FlavorInfo, ImageInfo
+from src.nova_mimic import PendingBoot
+
+
+class TestAsyncNovaMimic(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+        self.nova_mimic = Mock()
+        self.nova_mimic._image_processing.side_effect = \
+            lambda image_id, image_key=None, references=0: time.sleep(0.05)
+        self.nova_mimic._begin_boot.side_effect = self._begin_boot
+        self.nova_mimic._create_domain.side_effect = self._create_domain
+        self.nova_mimic._finish_boot.side_effect = \
+            lambda boot, domain, state: self._called('finish')
+
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+        #key - phase of boot, value - set of threads which ran it
+        self.threads = defaultdict(set)
+
+        self.async_nova_mimic = AsyncNovaMimic(
+            self.nova_mimic,
+            loop=self.loop,
+            libvirt_workers=4,
+            boot_limit=2
+        )
+
+    def tearDown(self):
+        self.async_nova_mimic.close()
+        self.loop.close()
+
+    def _called(self, phase):
+        with self.lock:
+            self.threads[phase].add(threading.current_thread())
+
+    def _begin_boot(self, instance_name, image_id, flavor_id):
+        self._called('begin')
+
+        return PendingBoot(
+            'uuid-%s' % instance_name,
+            instance_name,
+            ImageInfo(image_id, 'ubuntu', 'qcow2', 16, None),
+            image_id,
+            FlavorInfo(flavor_id, 'standart', 1, 524288),
+            'localhost',
+            1,
+            '52:54:00:00:00:01'
+        )
+
+    def _create_domain(self, boot):
+        self._called('create')
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+        time.sleep(0.01)
+
+        with self.lock:
+            self.running -= 1
+
+        domain = Mock()
+        domain.state.return_value = [libvirt.VIR_DOMAIN_RUNNING, 1]
+        return domain
+
+    def _executor_threads(self, stage):
+        return set(self.async_nova_mimic.executors[stage]._threads)
+
+    def test_boot_many(self):
+        boots = [
+            self.async_nova_mimic.instance_boot(
+                'instance%s' % i,
+                '522700a8a063d875c192d818',
+                1
+            )
+            for i in range(20)
+        ]
+
+        results = self.loop.run_until_complete(
+            asyncio.gather(*boots, loop=self.loop)
+        )
+
+        self.assertEqual(
+            results,
+            ['uuid-instance%s' % i for i in range(20)]
+        )
+        #every boot gets image once by its own reference
+        self.assertEqual(
+            self.nova_mimic._image_processing.call_count,
+            20
+        )
+        self.nova_mimic._image_processing.assert_called_with(
+            '522700a8a063d875c192d818',
+            '522700a8a063d875c192d818',
+            1
+        )
+        #limit of boot stage is kept
+        self.assertLessEqual(self.max_running, 2)
+        self.assertEqual(self.async_nova_mimic.downloads, {})
+
+        #transactions do not occupy threads of libvirt calls
+        self.assertLessEqual(
+            self.threads['begin'],
+            self._executor_threads('db')
+        )
+        self.assertLessEqual(
+            self.threads['finish'],
+            self._executor_threads('db')
+        )
+        self.assertLessEqual(
+            self.threads['create'],
+            self._executor_threads('libvirt')
+        )
+        self.assertEqual(self.nova_mimic._finish_boot.call_count, 20)
+
+    def test_failed_create(self):
+        self.nova_mimic._create_domain.side_effect = \
+            libvirt.libvirtError('domain can not be created')
+
+        self.assertRaises(
+            libvirt.libvirtError,
+            self.loop.run_until_complete,
+            self.async_nova_mimic.instance_boot(
+                'instance',
+                '522700a8a063d875c192d818',
+                1
+            )
+        )
+
+        self.nova_mimic._cancel_boot.assert_called_once_with(
+            'uuid-instance',
+            1,
+            '522700a8a063d875c192d818',
+            None
+        )
+        self.assertFalse(self.nova_mimic._finish_boot.called)
+
+    def test_failed_download(self):
+        self.nova_mimic._image_processing.side_effect = IOError()
+
+        self.assertRaises(
+            IOError,
+            self.loop.run_until_complete,
+            self.async_nova_mimic.instance_boot(
+                'instance',
+                '522700a8a063d875c192d818',
+                1
+            )
+        )
+        self.nova_mimic._cancel_boot.assert_called_once_with(
+            'uuid-instance',
+            1,
+            '522700a8a063d875c192d818',
+            None
+        )
+        self.assertFalse(self.nova_mimic._create_domain.called)
+
+    def _cancel_during(self, phase):
+        '''
+        Cancels boot while phase (mock of NovaMimic) is running
+        and waits until boot is undone.
+        '''
+        started = threading.Event()
+        proceed = threading.Event()
+        side_effect = phase.side_effect
+
+        def blocked(*args):
+            started.set()
+            proceed.wait(5)
+            return side_effect(*args)
+        phase.side_effect = blocked
+
+        undone = threading.Event()
+        self.nova_mimic._cancel_boot.side_effect = \
+            lambda *args: undone.set()
+        self.nova_mimic._destroy.side_effect = lambda *args: undone.set()
+
+        task = asyncio.ensure_future(
+            self.async_nova_mimic.instance_boot(
+                'instance',
+                '522700a8a063d875c192d818',
+                1
+            ),
+            loop=self.loop
+        )
+
+        @asyncio.coroutine
+        def cancel():
+            while not started.is_set():
+                yield From(asyncio.sleep(0.01, loop=self.loop))
+            task.cancel()
+            proceed.set()
+            while not undone.is_set():
+                yield From(asyncio.sleep(0.01, loop=self.loop))
+
+        self.loop.run_until_complete(cancel())
+        self.assertTrue(task.cancelled())
+
+    def test_cancel_during_begin(self):
+        self._cancel_during(self.nova_mimic._begin_boot)
+
+        #reservation made by phase which finished after cancel
+        self.nova_mimic._cancel_boot.assert_called_once_with(
+            'uuid-instance',
+            1,
+            '522700a8a063d875c192d818',
+            None
+        )
+        self.assertFalse(self.nova_mimic._create_domain.called)
+
+    def test_cancel_during_create(self):
+        self._cancel_during(self.nova_mimic._create_domain)
+
+        #domain which was created after cancel is destroyed
+        args = self.nova_mimic._cancel_boot.call_args[0]
+        self.assertEqual(args[0], 'uuid-instance')
+        self.assertIsNotNone(args[3])
+        self.assertFalse(self.nova_mimic._finish_boot.called)
+
+    def test_cancel_during_finish(self):
+        self._cancel_during(self.nova_mimic._finish_boot)
+
+        #instance was booted after all
+        self.nova_mimic._destroy.assert_called_once_with('uuid-instance')
+        self.assertFalse(self.nova_mimic._cancel_boot.called)
+
+    def test_failed_state(self):
+        domain = Mock()
+        domain.state.side_effect = libvirt.libvirtError('connection is lost')
+        self.nova_mimic._create_domain.side_effect = lambda boot: domain
+
+        self.assertRaises(
+            libvirt.libvirtError,
+            self.loop.run_until_complete,
+            self.async_nova_mimic.instance_boot(
+                'instance',
+                '522700a8a063d875c192d818',
+                1
+            )
+        )
+
+        self.nova_mimic._cancel_boot.assert_called_once_with(
+            'uuid-instance',
+            1,
+            '522700a8a063d875c192d818',
+            domain
+        )
+
+    def test_lifecycle(self):
+        destroyed = Future()
+        destroyed.set_result(5)
+        self.nova_mimic.instance_destroy.return_value = destroyed
+
+        self.assertEqual(
+            self.loop.run_until_complete(
+                self.async_nova_mimic.instance_destroy('uuid')
+            ),
+            5
+        )
+        self.nova_mimic.instance_destroy.assert_called_once_with('uuid')
+
+    def test_lifecycle_many(self):
+        shut_off = Future()
+        shut_off.set_result(5)
+        failed = Future()
+        failed.set_exception(RuntimeError())
+        self.nova_mimic.instance_shutdown.return_value = [shut_off, failed]
+
+        results = self.loop.run_until_complete(
+            self.async_nova_mimic.instance_shutdown(['uuid-1', 'uuid-2'])
+        )
+        self.assertEqual(results[0], 5)
+        self.assertIsInstance(results[1], RuntimeError)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import unittest
+
+from gridfs.errors import NoFile
+from bson.objectid import ObjectId
+
+from src.benchmarks.boot_pipeline import summarize, compare
+from src.benchmarks.file_gridfs import FileGridFS
+
+
+class TestFileGridFS(unittest.TestCase):
+    def setUp(self):
+        self.path_to_storage = tempfile.mkdtemp()
+        self.grfs = FileGridFS(self.path_to_storage)
+
+    def tearDown(self):
+        shutil.rmtree(self.path_to_storage)
+
+    def test_put_and_get(self):
+        file_id = self.grfs.put('qcow2 image data')
+
+        grout = self.grfs.get(ObjectId(str(file_id)))
+        self.assertEqual(grout.length, 16)
+        self.assertEqual(grout.read(6), 'qcow2 ')
+        self.assertEqual(grout.read(100), 'image data')
+        self.assertEqual(grout.read(100), '')
+
+    def test_absent_file(self):
+        self.assertRaises(NoFile, self.grfs.get, ObjectId())
+
+
+class TestBootPipelineReport(unittest.TestCase):
+    def test_summarize(self):
+        summary = summarize([0.001 * i for i in range(1, 101)], 2.0)
+
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['ops_per_second'], 50.0)
+        self.assertAlmostEqual(summary['p50_ms'], 51.0)
+        self.assertAlmostEqual(summary['p99_ms'], 99.0)
+        self.assertAlmostEqual(summary['max_ms'], 100.0)
+
+    def test_compare(self):
+        baseline = {
+            'results': {
+                'xml_processing': {'ops_per_second': 100.0, 'p99_ms': 2.0}
+            }
+        }
+        report = {
+            'results': {
+                'xml_processing': {'ops_per_second': 150.0, 'p99_ms': 1.0},
+                'instance_boot_c4': {'ops_per_second': 10.0, 'p99_ms': 1.0}
+            }
+        }
+
+        lines = compare(report, baseline)
+        self.assertIn('new', lines[0])
+        self.assertIn('ops_per_second +50.0%', lines[1])
+        self.assertIn('p99_ms -50.0%', lines[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from sqlalchemy import create_engine
+
+from src.database_toolkit import (
+    Base, Instance, MacAddress, verify_schema,
+    SchemaMismatchError
+)
+
+
+class TestVerifySchema(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+
+    def test_schema_matches(self):
+        verify_schema(self.engine)
+
+    def test_absent_table(self):
+        Instance.__table__.drop(self.engine)
+
+        self.assertRaises(SchemaMismatchError, verify_schema, self.engine)
+
+    def test_absent_unique_constraint(self):
+        #table of previous version had no unique constraint
+        MacAddress.__table__.drop(self.engine)
+        self.engine.execute(
+            'CREATE TABLE mac_address_pool '
+            '(id INTEGER PRIMARY KEY, address VARCHAR(50), is_free BOOLEAN)'
+        )
+
+        with self.assertRaises(SchemaMismatchError) as context:
+            verify_schema(self.engine)
+        self.assertIn(
+            'mac_address_pool.address is not unique',
+            str(context.exception)
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from src.image_cache import ImageCache, ImageCacheError
+
+
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        self.path_to_image_storage = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path_to_image_storage)
+
+    def _put_image(self, cache, image_id, size):
+        '''
+        Emulates download of image with given size
+        '''
+        cache.reserve(size)
+        with open(os.path.join(self.path_to_image_storage, image_id), 'wb') as f:
+            f.write('x' * size)
+        cache.add(image_id, size)
+
+    def _present(self):
+        return sorted(os.listdir(self.path_to_image_storage))
+
+    def test_unknown_policy(self):
+        self.assertRaises(
+            ImageCacheError,
+            ImageCache,
+            self.path_to_image_storage,
+            policy='random'
+        )
+
+    def test_lru_eviction(self):
+        cache = ImageCache(self.path_to_image_storage, size_limit=30)
+
+        self._put_image(cache, 'a', 10)
+        self._put_image(cache, 'b', 10)
+        self._put_image(cache, 'c', 10)
+
+        #'a' becomes most recently used
+        self.assertTrue(cache.lookup('a'))
+
+        self._put_image(cache, 'd', 10)
+
+        self.assertEqual(self._present(), ['a', 'c', 'd'])
+        self.assertEqual(cache.statistics()['evictions'], 1)
+        self.assertEqual(cache.statistics()['used_bytes'], 30)
+
+    def test_lfu_eviction(self):
+        cache = ImageCache(
+            self.path_to_image_storage,
+            size_limit=30,
+            policy='lfu'
+        )
+
+        self._put_image(cache, 'a', 10)
+        self._put_image(cache, 'b', 10)
+        self._put_image(cache, 'c', 10)
+
+        cache.lookup('a')
+        cache.lookup('a')
+        cache.lookup('b')
+        cache.lookup('c')
+        cache.lookup('c')
+
+        self._put_image(cache, 'd', 10)
+
+        self.assertEqual(self._present(), ['a', 'c', 'd'])
+
+    def test_referenced_image_is_not_evicted(self):
+        cache = ImageCache(self.path_to_image_storage, size_limit=20)
+
+        self._put_image(cache, 'a', 10)
+        self._put_image(cache, 'b', 10)
+        cache.acquire('a')
+
+        self._put_image(cache, 'c', 10)
+        self.assertEqual(self._present(), ['a', 'c'])
+
+        cache.release('a')
+        self._put_image(cache, 'd', 10)
+        self.assertEqual(self._present(), ['c', 'd'])
+
+    def test_statistics(self):
+        cache = ImageCache(self.path_to_image_storage)
+
+        self.assertFalse(cache.lookup('a'))
+        self._put_image(cache, 'a', 10)
+        self.assertTrue(cache.lookup('a'))
+
+        stats = cache.statistics()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['images'], 1)
+
+    def test_existing_images_are_registered(self):
+        for image_id in ('a', 'b'):
+            with open(os.path.join(self.path_to_image_storage, image_id), 'wb') as f:
+                f.write('x' * 10)
+
+        #temporary file of unfinished download
+        with open(os.path.join(self.path_to_image_storage, '.c.part'), 'wb') as f:
+            f.write('x' * 10)
+
+        cache = ImageCache(self.path_to_image_storage)
+
+        #budget is spent by bytes allocated on disk
+        stats = cache.statistics()
+        self.assertEqual(stats['logical_bytes'], 20)
+        self.assertEqual(
+            stats['used_bytes'],
+            sum(
+                os.stat(
+                    os.path.join(self.path_to_image_storage, image_id)
+                ).st_blocks * 512
+                for image_id in ('a', 'b')
+            )
+        )
+        self.assertTrue(cache.lookup('b'))
+        self.assertFalse(cache.lookup('c'))
+
+    def test_sparse_image(self):
+        cache = ImageCache(self.path_to_image_storage)
+
+        path = os.path.join(self.path_to_image_storage, 'a')
+        with open(path, 'wb') as f:
+            f.truncate(1024 * 1024)
+
+        self.assertTrue(cache.lookup('a'))
+
+        stats = cache.statistics()
+        self.assertEqual(stats['logical_bytes'], 1024 * 1024)
+        self.assertEqual(stats['used_bytes'], os.stat(path).st_blocks * 512)
+        self.assertTrue(stats['used_bytes'] < stats['logical_bytes'])
+
+    def test_discard(self):
+        cache = ImageCache(self.path_to_image_storage)
+        self._put_image(cache, 'a', 10)
+        self._put_image(cache, 'b', 10)
+        #checksum file is removed with image
+        open(os.path.join(self.path_to_image_storage, '.a.checksum'), 'w')\
+            .close()
+        cache.acquire('b')
+
+        self.assertTrue(cache.discard('a'))
+        self.assertFalse(cache.discard('b'))
+        #reference of caller itself does not keep image
+        cache.acquire('b')
+        self.assertFalse(cache.discard('b', 1))
+
+        self.assertEqual(self._present(), ['b'])
+        self.assertEqual(cache.images(), ['b'])
+        self.assertEqual(cache.statistics()['logical_bytes'], 10)
+
+        cache.release('b')
+        self.assertTrue(cache.discard('b', 1))
+        self.assertEqual(self._present(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+from pymongo.errors import DuplicateKeyError
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+from src.database_toolkit import Base, Image, contexted_session
+from src.utils.image_ingest import ImageUploader, ingest_image
+
+DATA = 'qcow2 image data' * 10
+
+
+class CollectionMock(object):
+    '''
+    Keeps inserted documents in list, files with the same
+    sha256 violate unique index
+    '''
+    def __init__(self):
+        self.documents = []
+        self.lock = threading.Lock()
+        self.insert_many_calls = 0
+
+    def insert_many(self, documents, ordered=True):
+        with self.lock:
+            self.insert_many_calls += 1
+            self.documents.extend(documents)
+
+    def insert_one(self, document):
+        with self.lock:
+            if self.find_one({'sha256': document['sha256']}) is not None:
+                raise DuplicateKeyError('duplicate sha256')
+            self.documents.append(document)
+
+    def find_one(self, query, fields=None):
+        for document in self.documents:
+            if all(document.get(key) == value for key, value in query.items()):
+                return document
+
+    def delete_many(self, query):
+        with self.lock:
+            self.documents = [
+                document for document in self.documents
+                if document['files_id'] != query['files_id']
+            ]
+
+
+class TestImageUploader(unittest.TestCase):
+    def setUp(self):
+        self.db = {'fs.files': CollectionMock(), 'fs.chunks': CollectionMock()}
+        self.uploader = ImageUploader(
+            self.db,
+            chunk_size=7,
+            workers=2,
+            batch_size=3
+        )
+
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(DATA)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_upload(self):
+        file_id, sha256, length, uploaded = self.uploader.upload(
+            self.path,
+            filename='image'
+        )
+
+        self.assertTrue(uploaded)
+        self.assertEqual(sha256, hashlib.sha256(DATA).hexdigest())
+        self.assertEqual(length, len(DATA))
+
+        document = self.db['fs.files'].find_one({'_id': file_id})
+        self.assertEqual(document['sha256'], sha256)
+        self.assertEqual(document['length'], len(DATA))
+        self.assertEqual(document['filename'], 'image')
+
+        #chunks are inserted by batches
+        chunks = sorted(
+            self.db['fs.chunks'].documents,
+            key=lambda chunk: chunk['n']
+        )
+        self.assertEqual(
+            self.db['fs.chunks'].insert_many_calls,
+            (len(chunks) + 2) // 3
+        )
+        self.assertEqual(''.join(str(chunk['data']) for chunk in chunks), DATA)
+
+    def test_deduplication(self):
+        file_id = self.uploader.upload(self.path)[0]
+        chunks = len(self.db['fs.chunks'].documents)
+
+        self.assertEqual(
+            self.uploader.upload(self.path),
+            (file_id, hashlib.sha256(DATA).hexdigest(), len(DATA), False)
+        )
+
+        self.assertEqual(len(self.db['fs.files'].documents), 1)
+        self.assertEqual(len(self.db['fs.chunks'].documents), chunks)
+        self.assertEqual(self.uploader.stats['deduplicated'], 1)
+        self.assertEqual(self.uploader.stats['deduplicated_bytes'], len(DATA))
+
+    def test_concurrent_upload(self):
+        '''
+        Checks that chunks of loser of race are removed
+        and file of winner is reused
+        '''
+        self.db['fs.files'].documents.append(
+            {'_id': 'winner', 'sha256': hashlib.sha256(DATA).hexdigest()}
+        )
+
+        with patch.object(self.uploader, 'find', side_effect=[None, 'winner']):
+            file_id, _, _, uploaded = self.uploader.upload(self.path)
+
+        self.assertEqual(file_id, 'winner')
+        self.assertFalse(uploaded)
+        self.assertEqual(self.db['fs.chunks'].documents, [])
+
+
+class TestIngestImage(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine(
+            'sqlite://',
+            connect_args={'check_same_thread': False},
+            poolclass=StaticPool
+        )
+        Base.metadata.create_all(engine)
+
+        self.engine_patch = patch(
+            'src.database_toolkit.get_engine',
+            return_value=engine
+        )
+        self.engine_patch.start()
+
+        self.uploader = ImageUploader(
+            {'fs.files': CollectionMock(), 'fs.chunks': CollectionMock()}
+        )
+
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(DATA)
+
+    def tearDown(self):
+        self.engine_patch.stop()
+        os.remove(self.path)
+
+    def test_ingest_image(self):
+        image_id = ingest_image(self.uploader, self.path, 'ubuntu', 'qcow2')
+
+        #the same content under other name is the same image
+        self.assertEqual(
+            ingest_image(self.uploader, self.path, 'ubuntu-copy', 'qcow2'),
+            image_id
+        )
+
+        with contexted_session() as s:
+            images = s.query(Image.id, Image.name, Image.size, Image.sha256)\
+                      .all()
+
+        self.assertEqual(
+            images,
+            [(image_id, 'ubuntu', len(DATA), hashlib.sha256(DATA).hexdigest())]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
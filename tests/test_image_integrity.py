@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+from src.image_cache import ImageCache
+from src.image_integrity import (
+    ImageVerifier, ImageScrubber, write_checksum, read_checksum,
+    checksum_path
+)
+from src.single_flight import SingleFlight
+
+DATA = 'qcow2 image data'
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+class TestImageVerifier(unittest.TestCase):
+    def setUp(self):
+        self.path_to_image_storage = tempfile.mkdtemp()
+        self.verifier = ImageVerifier(self.path_to_image_storage)
+
+    def tearDown(self):
+        shutil.rmtree(self.path_to_image_storage)
+
+    def _put_image(self, name, data=DATA, checksum=True):
+        path = os.path.join(self.path_to_image_storage, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if checksum:
+            write_checksum(path, hashlib.sha256(data).hexdigest())
+
+        return path
+
+    def test_unchanged_image_is_not_rehashed(self):
+        self._put_image('a')
+
+        with patch('src.image_integrity.file_sha256') as file_sha256:
+            self.assertTrue(self.verifier.verify('a'))
+
+        self.assertFalse(file_sha256.called)
+
+    def test_touched_image(self):
+        '''
+        Checks that image with changed mtime but the same
+        content is re-hashed once
+        '''
+        path = self._put_image('a')
+        os.utime(path, (1, 1))
+
+        self.assertTrue(self.verifier.verify('a'))
+        self.assertEqual(read_checksum(path)['mtime'], 1)
+        self.assertTrue(self.verifier.verify('a'))
+        self.assertEqual(self.verifier.stats['rehashed'], 1)
+
+    def test_corrupted_image(self):
+        path = self._put_image('a')
+        with open(path, 'r+b') as f:
+            f.write('QCOW2')
+        os.utime(path, (1, 1))
+
+        self.assertFalse(self.verifier.verify('a'))
+        self.assertEqual(self.verifier.stats['corrupted'], 1)
+
+    def test_image_named_by_hash(self):
+        #content is known by name even without checksum file
+        self._put_image(SHA256, checksum=False)
+        self._put_image(hashlib.sha256('other').hexdigest(), checksum=False)
+
+        self.assertTrue(self.verifier.verify(SHA256))
+        self.assertFalse(
+            self.verifier.verify(hashlib.sha256('other').hexdigest())
+        )
+
+    def test_written_image(self):
+        path = self._put_image('a')
+        self.verifier.mark_written('a')
+
+        #guest writes to image
+        with open(path, 'r+b') as f:
+            f.write('QCOW2')
+        os.utime(path, (1, 1))
+
+        with patch('src.image_integrity.file_sha256') as file_sha256:
+            self.assertTrue(self.verifier.verify('a'))
+            self.assertTrue(self.verifier.verify('a', full=True))
+        self.assertFalse(file_sha256.called)
+        self.assertTrue(self.verifier.is_written('a'))
+
+        #image downloaded again is verified
+        self._put_image('a')
+        self.assertFalse(self.verifier.is_written('a'))
+
+    def test_image_without_checksum(self):
+        path = self._put_image('a', checksum=False)
+
+        self.assertTrue(self.verifier.verify('a'))
+        self.assertEqual(read_checksum(path)['sha256'], SHA256)
+
+
+class TestImageScrubber(unittest.TestCase):
+    def setUp(self):
+        self.path_to_image_storage = tempfile.mkdtemp()
+
+        for name in ('a', 'b'):
+            path = os.path.join(self.path_to_image_storage, name)
+            with open(path, 'wb') as f:
+                f.write(DATA)
+            #mtime which survives os.utime exactly
+            os.utime(path, (1000, 1000))
+            write_checksum(path, SHA256)
+
+        self.nova_mimic = Mock()
+        self.nova_mimic.use_overlays = False
+        self.nova_mimic.path_to_image_storage = self.path_to_image_storage
+        self.nova_mimic.image_cache = ImageCache(self.path_to_image_storage)
+        self.nova_mimic.image_downloads = SingleFlight(
+            self.path_to_image_storage
+        )
+        self.nova_mimic.image_verifier = ImageVerifier(
+            self.path_to_image_storage
+        )
+
+        self.scrubber = ImageScrubber(self.nova_mimic)
+
+    def tearDown(self):
+        shutil.rmtree(self.path_to_image_storage)
+
+    def _rot(self, name):
+        '''
+        Changes content of image, but keeps its size and mtime
+        '''
+        path = os.path.join(self.path_to_image_storage, name)
+        with open(path, 'r+b') as f:
+            f.write('QCOW2')
+        os.utime(path, (1000, 1000))
+
+    def test_scrub_once(self):
+        self._rot('a')
+
+        #size and mtime are the same, so boot does not notice
+        self.assertTrue(self.nova_mimic.image_verifier.verify('a'))
+
+        self.scrubber.scrub_once()
+
+        self.assertEqual(self.nova_mimic.image_cache.images(), ['b'])
+        self.assertFalse(
+            os.path.exists(
+                checksum_path(os.path.join(self.path_to_image_storage, 'a'))
+            )
+        )
+        self.assertEqual(self.scrubber.stats['scrubbed'], 2)
+        self.assertEqual(self.scrubber.stats['removed'], 1)
+
+    def test_image_used_by_guest_is_skipped(self):
+        self._rot('a')
+        self.nova_mimic.image_cache.acquire('a')
+
+        self.scrubber.scrub_once()
+
+        self.assertEqual(
+            sorted(self.nova_mimic.image_cache.images()),
+            ['a', 'b']
+        )
+        self.assertEqual(self.scrubber.stats['skipped'], 1)
+
+    def test_written_image_is_skipped(self):
+        self.nova_mimic.image_verifier.mark_written('a')
+        self._rot('a')
+
+        self.scrubber.scrub_once()
+
+        self.assertEqual(
+            sorted(self.nova_mimic.image_cache.images()),
+            ['a', 'b']
+        )
+        self.assertEqual(self.scrubber.stats['skipped'], 1)
+        self.assertEqual(self.scrubber.stats['scrubbed'], 1)
+
+    def test_corrupted_image_in_use(self):
+        '''
+        Checks that backing file of running overlays is not removed
+        '''
+        self.nova_mimic.use_overlays = True
+        self._rot('a')
+        self.nova_mimic.image_cache.acquire('a')
+
+        self.assertFalse(self.scrubber.scrub('a'))
+
+        self.assertIn('a', self.nova_mimic.image_cache.images())
+        self.assertEqual(self.scrubber.stats['corrupted'], 1)
+        self.assertEqual(self.scrubber.stats['removed'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+from mock import Mock, patch
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+from src.database_toolkit import Base, Image, Instance, contexted_session
+from src.image_cache import ImageCache
+from src.nova_mimic import NovaMimic
+from src.image_prefetcher import (
+    ImagePrefetcher, ThrottledReader, PrefetchCancelled
+)
+from src.single_flight import SingleFlight
+from src.token_bucket import TokenBucket
+from src.tracing import Tracer
+
+IMAGE_IDS = [
+    '522700a8a063d875c192d818',
+    '522700a8a063d875c192d819',
+    '522700a8a063d875c192d81a'
+]
+#images of whole blocks of disk, so they take on disk as much
+#as their size is
+IMAGE_SIZE = 4096
+
+
+def grout_mock(data):
+    grout = StringIO(data)
+    grout.length = len(data)
+    return grout
+
+
+def download(grout, path_to_image):
+    with open(path_to_image, 'wb') as f:
+        f.write(grout.read(-1))
+
+    return grout.length, os.stat(path_to_image).st_blocks * 512, None
+
+
+def fetch(grout, path_to_image):
+    fd, path_to_tmp = tempfile.mkstemp(
+        prefix='.%s.' % os.path.basename(path_to_image),
+        dir=os.path.dirname(path_to_image)
+    )
+    with os.fdopen(fd, 'wb') as f:
+        f.write(grout.read(-1))
+
+    allocated_size = os.stat(path_to_tmp).st_blocks * 512
+    return path_to_tmp, grout.length, allocated_size, None
+
+
+def publish(path_to_tmp, path_to_image, sha256):
+    os.rename(path_to_tmp, path_to_image)
+
+
+class TestImagePrefetcher(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine(
+            'sqlite://',
+            connect_args={'check_same_thread': False},
+            poolclass=StaticPool
+        )
+        Base.metadata.create_all(engine)
+
+        self.engine_patch = patch(
+            'src.database_toolkit.get_engine',
+            return_value=engine
+        )
+        self.engine_patch.start()
+
+        now = datetime.utcnow()
+        with contexted_session() as s:
+            for image_id in IMAGE_IDS:
+                s.add(Image(id=image_id, name=image_id, fmt='raw', size=4))
+
+            #the second image is the most popular one, the third one
+            #was popular long ago
+            boots = [(IMAGE_IDS[0], now)] + \
+                [(IMAGE_IDS[1], now)] * 2 + \
+                [(IMAGE_IDS[2], now - timedelta(days=2))] * 3
+            for i, (image_id, created_at) in enumerate(boots):
+                s.add(
+                    Instance(
+                        id='uuid-%s' % i,
+                        image_id=image_id,
+                        created_at=created_at
+                    )
+                )
+
+        self.path_to_image_storage = tempfile.mkdtemp()
+
+        self.nova_mimic = Mock()
+        self.nova_mimic.path_to_image_storage = self.path_to_image_storage
+        #budget of storage fits only two images
+        self.nova_mimic.image_cache = ImageCache(
+            self.path_to_image_storage,
+            2 * IMAGE_SIZE + 100
+        )
+        self.nova_mimic.image_downloads = SingleFlight(
+            self.path_to_image_storage
+        )
+        self.nova_mimic.tracer = Tracer()
+        self.nova_mimic.grfs.get.side_effect = \
+            lambda object_id: grout_mock('x' * IMAGE_SIZE)
+        self.nova_mimic._fetch_image.side_effect = fetch
+        self.nova_mimic._publish_image.side_effect = publish
+        self.nova_mimic._download_image.side_effect = download
+        self.nova_mimic._image_keys.side_effect = \
+            lambda image_ids: dict((i, i) for i in image_ids)
+
+        self.prefetcher = ImagePrefetcher(
+            self.nova_mimic,
+            pinned=[IMAGE_IDS[2]],
+            top=5
+        )
+
+    def tearDown(self):
+        self.engine_patch.stop()
+        shutil.rmtree(self.path_to_image_storage)
+
+    def test_rank(self):
+        self.assertEqual(
+            self.prefetcher.rank(),
+            [IMAGE_IDS[2], IMAGE_IDS[1], IMAGE_IDS[0]]
+        )
+
+        self.prefetcher.pinned = []
+        self.prefetcher.top = 1
+        self.assertEqual(self.prefetcher.rank(), [IMAGE_IDS[1]])
+
+    def test_run_once(self):
+        self.prefetcher.run_once()
+
+        status = self.prefetcher.status()
+        self.assertEqual(status['warm'], [IMAGE_IDS[2], IMAGE_IDS[1]])
+        self.assertEqual(status['cold'], [IMAGE_IDS[0]])
+        self.assertEqual(status['prefetched'], 2)
+        self.assertEqual(status['skipped'], 1)
+
+        #prefetched images are not counted as misses of cache
+        self.assertEqual(
+            self.nova_mimic.image_cache.statistics()['misses'],
+            0
+        )
+
+        self.assertFalse(self.prefetcher.prefetch(IMAGE_IDS[1]))
+        self.assertEqual(self.nova_mimic._fetch_image.call_count, 2)
+
+    def _image_files(self):
+        return [
+            name for name in os.listdir(self.path_to_image_storage)
+            if not name.startswith('.')
+        ]
+
+    def test_boot_during_prefetch(self):
+        '''
+        Checks that boot of image which is being prefetched does not
+        wait for throttled download
+        '''
+        started = threading.Event()
+        proceed = threading.Event()
+
+        def throttled_fetch(grout, path_to_image):
+            started.set()
+            proceed.wait(5)
+            return fetch(grout, path_to_image)
+        self.nova_mimic._fetch_image.side_effect = throttled_fetch
+
+        results = []
+        prefetch = threading.Thread(
+            target=lambda: results.append(
+                self.prefetcher.prefetch(IMAGE_IDS[0])
+            )
+        )
+        prefetch.start()
+        self.assertTrue(started.wait(5))
+
+        boot = threading.Thread(
+            target=NovaMimic._image_processing.__func__,
+            args=(self.nova_mimic, IMAGE_IDS[0], IMAGE_IDS[0], 1)
+        )
+        boot.start()
+        boot.join(5)
+        self.assertFalse(boot.is_alive())
+        self.assertTrue(self.nova_mimic.image_cache.contains(IMAGE_IDS[0]))
+
+        proceed.set()
+        prefetch.join(5)
+
+        #copy of prefetcher is dropped
+        self.assertEqual(results, [False])
+        self.assertEqual(self.prefetcher.status()['prefetched'], 0)
+        self.assertEqual(self._image_files(), [IMAGE_IDS[0]])
+        #temporary file is removed, only lock file is left
+        self.assertEqual(
+            [
+                name for name in os.listdir(self.path_to_image_storage)
+                if name.startswith('.') and not name.endswith('.lock')
+            ],
+            []
+        )
+
+    def test_failed_prefetch(self):
+        self.nova_mimic.grfs.get.side_effect = IOError()
+        self.prefetcher.run_once()
+
+        self.assertEqual(self.prefetcher.status()['failed'], 3)
+        #only lock files of downloads are left
+        self.assertEqual(self._image_files(), [])
+
+
+class TestThrottledReader(unittest.TestCase):
+    def test_cancelled_reader(self):
+        cancelled = threading.Event()
+        reader = ThrottledReader(grout_mock('data'), TokenBucket(0), cancelled)
+
+        self.assertEqual(reader.read(2), 'da')
+        cancelled.set()
+        self.assertRaises(PrefetchCancelled, reader.read, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
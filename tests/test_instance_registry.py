@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import libvirt
+from mock import Mock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from src.database_toolkit import Base, Instance, MacAddress
+from src.instance_registry import InstanceRegistry, InstanceRecord
+
+
+def domain_mock(uuid, name):
+    domain = Mock()
+    domain.UUIDString.return_value = uuid
+    domain.name.return_value = name
+    return domain
+
+
+class TestInstanceRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = InstanceRegistry()
+        self.registry.add(
+            InstanceRecord('uuid-1', 'first', '52:54:00:00:00:01', 1, 'image')
+        )
+        self.registry.add(
+            InstanceRecord('uuid-2', 'second', '52:54:00:00:00:02', 5, 'image')
+        )
+
+    def test_lookups(self):
+        self.assertEqual(self.registry.get('uuid-1').name, 'first')
+        self.assertEqual(self.registry.find_by_name('second').id, 'uuid-2')
+        self.assertEqual(
+            self.registry.find_by_mac('52:54:00:00:00:01').id,
+            'uuid-1'
+        )
+        self.assertEqual(
+            [record.id for record in self.registry.with_state(5)],
+            ['uuid-2']
+        )
+
+    def test_update_state(self):
+        self.assertTrue(self.registry.update_state('uuid-2', 1))
+        self.assertFalse(self.registry.update_state('uuid-3', 1))
+
+        self.assertEqual(
+            sorted(record.id for record in self.registry.with_state(1)),
+            ['uuid-1', 'uuid-2']
+        )
+        self.assertEqual(self.registry.with_state(5), [])
+        self.assertEqual(self.registry.get('uuid-2').transitions, 1)
+
+    def test_mark_rebooted(self):
+        self.assertTrue(self.registry.mark_rebooted('uuid-1'))
+        self.assertFalse(self.registry.mark_rebooted('uuid-3'))
+
+        record = self.registry.get('uuid-1')
+        self.assertEqual(record.transitions, 1)
+        self.assertEqual(record.state, 1)
+
+    def test_attach(self):
+        self.registry.add(InstanceRecord('uuid-3', 'third', host='node-1'))
+        self.registry.add(InstanceRecord('uuid-5', 'fifth', host='node-0'))
+        domain = domain_mock('uuid-3', 'third')
+
+        attached = self.registry.attach(
+            'node-1',
+            [
+                (domain, {'state.state': 1}),
+                (domain_mock('uuid-4', 'unknown'), {'state.state': 5}),
+                #instance of another host (hosts share one driver)
+                (domain_mock('uuid-5', 'fifth'), {'state.state': 1})
+            ]
+        )
+
+        self.assertEqual(
+            [record.id for record in attached],
+            ['uuid-3', 'uuid-4']
+        )
+        record = self.registry.get('uuid-3')
+        self.assertIs(record.domain, domain)
+        self.assertEqual(record.state, 1)
+        self.assertIn(record, self.registry.with_state(1))
+        self.assertEqual(self.registry.get('uuid-4').host, 'node-1')
+        self.assertIsNone(self.registry.get('uuid-5').domain)
+
+    def test_remove(self):
+        self.registry.remove('uuid-1')
+
+        self.assertIsNone(self.registry.get('uuid-1'))
+        self.assertIsNone(self.registry.find_by_name('first'))
+        self.assertIsNone(self.registry.find_by_mac('52:54:00:00:00:01'))
+        self.assertEqual(self.registry.with_state(1), [])
+        self.assertEqual(len(self.registry), 1)
+
+    def test_rebuild(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        s = sessionmaker(bind=engine)()
+
+        mac_address = MacAddress(address='52:54:00:00:00:10', is_free=False)
+        s.add(mac_address)
+        s.flush()
+        s.add(
+            Instance(
+                id='uuid-10',
+                domain_name='booted',
+                state='1',
+                mac_addr=mac_address.id
+            )
+        )
+        s.add(Instance(id='uuid-11', domain_name='lost', state='1'))
+        s.commit()
+
+        connection = Mock()
+        connection.getAllDomainStats.return_value = [
+            (domain_mock('uuid-10', 'booted'), {'state.state': 1}),
+            (domain_mock('uuid-12', 'unknown'), {'state.state': 3})
+        ]
+
+        self.registry.rebuild(s, connection)
+
+        self.assertEqual(len(self.registry), 3)
+        self.assertIsNone(self.registry.get('uuid-1'))
+
+        booted = self.registry.find_by_mac('52:54:00:00:00:10')
+        self.assertEqual(booted.id, 'uuid-10')
+        self.assertEqual(booted.state, 1)
+        self.assertIsNotNone(booted.domain)
+
+        self.assertIsNone(self.registry.get('uuid-11').domain)
+        self.assertEqual(self.registry.find_by_name('unknown').state, 3)
+        #one call to libvirt for all domains
+        self.assertEqual(connection.getAllDomainStats.call_count, 1)
+
+    def test_rebuild_many_hosts(self):
+        '''
+        Checks that domain seen by several hosts of one driver
+        is registered on host it was placed on
+        '''
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        s = sessionmaker(bind=engine)()
+
+        s.add(Instance(id='uuid-10', domain_name='placed', host='node-1'))
+        s.add(Instance(id='uuid-11', domain_name='old'))
+        s.commit()
+
+        stats = [
+            (domain_mock('uuid-10', 'placed'), {'state.state': 1}),
+            (domain_mock('uuid-11', 'old'), {'state.state': 1}),
+            (domain_mock('uuid-12', 'unknown'), {'state.state': 1})
+        ]
+        connections = []
+        for host in ('node-0', 'node-1'):
+            connection = Mock()
+            connection.getAllDomainStats.return_value = stats
+            connections.append((host, connection))
+
+        self.registry.rebuild(s, connections)
+
+        self.assertEqual(len(self.registry), 3)
+        self.assertEqual(self.registry.get('uuid-10').host, 'node-1')
+        #instances without saved host are found on the first host
+        self.assertEqual(self.registry.get('uuid-11').host, 'node-0')
+        self.assertEqual(self.registry.get('uuid-12').host, 'node-0')
+
+    def test_rebuild_unreachable_host(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        s = sessionmaker(bind=engine)()
+
+        s.add(Instance(id='uuid-10', domain_name='placed', host='node-1'))
+        s.commit()
+
+        reachable = Mock()
+        reachable.getAllDomainStats.return_value = [
+            (domain_mock('uuid-11', 'other'), {'state.state': 1})
+        ]
+        unreachable = Mock()
+        unreachable.getAllDomainStats.side_effect = \
+            libvirt.libvirtError('connection is closed')
+
+        self.assertEqual(
+            self.registry.rebuild(
+                s,
+                [('node-0', reachable), ('node-1', unreachable)]
+            ),
+            ['node-1']
+        )
+
+        self.assertEqual(len(self.registry), 2)
+        self.assertIsNone(self.registry.get('uuid-10').domain)
+        self.assertEqual(self.registry.get('uuid-10').host, 'node-1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+import libvirt
+
+from src.libvirt_pool import LibvirtConnectionPool
+
+
+class TestLibvirtConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = LibvirtConnectionPool(
+            'test:///default',
+            size=2,
+            keepalive_interval=0
+        )
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_connection_is_reused(self):
+        with self.pool.connection() as connection:
+            first = connection
+
+        with self.pool.connection() as connection:
+            self.assertIs(connection, first)
+
+    def test_concurrent_callers_get_own_connections(self):
+        with self.pool.connection() as first:
+            with self.pool.connection() as second:
+                self.assertIsNot(first, second)
+
+    def test_pool_size_is_bounded(self):
+        taken = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with self.pool.connection():
+                taken.set()
+                release.wait()
+
+        holders = [threading.Thread(target=hold) for i in range(2)]
+        for holder in holders:
+            holder.start()
+        taken.wait()
+
+        #third caller waits until some connection is given back
+        self.assertFalse(self.pool.slots.acquire(False))
+
+        release.set()
+        for holder in holders:
+            holder.join()
+
+        self.assertEqual(self.pool.idle.qsize(), 2)
+
+    def test_reconnect_after_drop(self):
+        with self.pool.connection() as connection:
+            dropped = connection
+
+        #emulates connection that was dropped while idle
+        dropped.close()
+
+        self.assertEqual(self.pool.call('getURI'), 'test:///default')
+
+        with self.pool.connection() as connection:
+            self.assertIsNot(connection, dropped)
+
+    def test_closed_pool(self):
+        self.pool.close()
+
+        self.assertRaises(libvirt.libvirtError, self.pool.call, 'getURI')
+
+
+if __name__ == '__main__':
+    unittest.main()
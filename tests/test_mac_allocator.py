@@ -0,0 +1,227 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import unittest
+
+from mock import patch, Mock
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from src.database_toolkit import Base, MacAddress
+from src.mac_allocator import (
+    MacAllocator, MacAllocatorError,
+    parse_ranges, mac_to_int, int_to_mac
+)
+
+
+class TestMacAllocator(unittest.TestCase):
+    def setUp(self):
+        self.allocator = MacAllocator(
+            parse_ranges(
+                '52:54:00:00:01:00-52:54:00:00:01:01,'
+                '52:54:00:00:00:fe-52:54:00:00:00:ff'
+            )
+        )
+
+    def test_conversion(self):
+        self.assertEqual(mac_to_int('52:54:00:83:df:a1'), 0x52540083dfa1)
+        self.assertEqual(int_to_mac(0x52540083dfa1), '52:54:00:83:df:a1')
+
+    def test_parse_ranges(self):
+        self.assertEqual(
+            self.allocator.ranges,
+            [
+                (0x5254000000fe, 0x5254000000ff),
+                (0x525400000100, 0x525400000101)
+            ]
+        )
+        self.assertEqual(self.allocator.size, 4)
+
+        self.assertRaises(MacAllocatorError, parse_ranges, 'not a range')
+        self.assertRaises(
+            MacAllocatorError,
+            parse_ranges,
+            '52:54:00:00:00:ff-52:54:00:00:00:00'
+        )
+
+    def test_take_all_addresses(self):
+        addresses = [
+            self.allocator._address(index)
+            for index in self.allocator._take(10)
+        ]
+
+        self.assertEqual(
+            addresses,
+            [
+                '52:54:00:00:00:fe',
+                '52:54:00:00:00:ff',
+                '52:54:00:00:01:00',
+                '52:54:00:00:01:01'
+            ]
+        )
+        self.assertEqual(self.allocator._take(1), [])
+
+    def test_released_address_is_reused(self):
+        first, second = self.allocator._take(2)
+        self.allocator._give_back([first])
+
+        self.assertEqual(self.allocator._take(1), [first])
+        self.assertEqual(
+            self.allocator._index('52:54:00:00:01:00'),
+            self.allocator._take(1)[0]
+        )
+
+    def test_used_addresses_are_skipped(self):
+        self.allocator.used[0] = 1
+        self.allocator.used[2] = 1
+
+        self.assertEqual(self.allocator._take(4), [1, 3])
+
+    def test_reconcile_once(self):
+        def reconcile(session):
+            time.sleep(0.05)
+            self.allocator.reconciled = True
+
+        with patch.object(
+            self.allocator,
+            'reconcile',
+            side_effect=reconcile
+        ) as reconcile_mock:
+            threads = [
+                threading.Thread(
+                    target=self.allocator.reserve,
+                    args=(Mock(), 0)
+                )
+                for i in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(reconcile_mock.call_count, 1)
+
+
+class TestMacAllocatorDatabase(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        #pysqlite does not emit BEGIN itself, savepoints need
+        #transaction begun explicitly (recipe from sqlalchemy docs)
+
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, 'begin')
+        def begin(connection):
+            connection.execute('BEGIN')
+
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+
+        self.allocator = MacAllocator(
+            parse_ranges('52:54:00:00:00:fe-52:54:00:00:01:01')
+        )
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_reserve_and_release(self):
+        rows = self.allocator.reserve(self.session, 2)
+        self.session.commit()
+
+        self.assertEqual(
+            [row.address for row in rows],
+            ['52:54:00:00:00:fe', '52:54:00:00:00:ff']
+        )
+
+        self.allocator.release(self.session, rows[:1])
+        self.session.commit()
+
+        self.assertEqual(
+            self.session.query(MacAddress.address)
+                        .filter(MacAddress.is_free == True)
+                        .all(),
+            [('52:54:00:00:00:fe',)]
+        )
+        self.assertEqual(
+            self.allocator.reserve(self.session, 1)[0].address,
+            '52:54:00:00:00:fe'
+        )
+
+    def test_concurrent_insert(self):
+        '''
+        Checks that address inserted by concurrent transaction after
+        rows were selected is skipped instead of failing reservation
+        '''
+        insert_rows = self.allocator._insert_rows
+        inserted = []
+
+        def concurrent_insert(session, addresses):
+            if not inserted:
+                session.execute(
+                    MacAddress.__table__.insert(),
+                    [{'address': '52:54:00:00:00:fe', 'is_free': False}]
+                )
+                inserted.append(1)
+            return insert_rows(session, addresses)
+
+        with patch.object(
+            self.allocator,
+            '_insert_rows',
+            side_effect=concurrent_insert
+        ):
+            rows = self.allocator.reserve(self.session, 2)
+        self.session.commit()
+
+        self.assertEqual(
+            [row.address for row in rows],
+            ['52:54:00:00:00:ff', '52:54:00:00:01:00']
+        )
+        #address of concurrent transaction is tried again
+        #after all other released addresses
+        index = self.allocator._index('52:54:00:00:00:fe')
+        self.assertEqual(self.allocator.used[index], 0)
+        self.assertEqual(list(self.allocator.released), [index])
+        self.assertEqual(self.session.query(MacAddress).count(), 3)
+
+    def test_all_addresses_are_inserted_concurrently(self):
+        with patch.object(
+            self.allocator,
+            '_insert_rows',
+            side_effect=IntegrityError('INSERT', {}, Exception('duplicate'))
+        ):
+            self.assertRaises(
+                MacAllocatorError,
+                self.allocator.reserve,
+                self.session,
+                1
+            )
+
+    def test_collisions_are_limited(self):
+        allocator = MacAllocator(
+            parse_ranges('52:54:00:00:00:00-52:54:00:00:00:0f')
+        )
+
+        with patch.object(
+            allocator,
+            '_insert_rows',
+            side_effect=IntegrityError('INSERT', {}, Exception('duplicate'))
+        ) as insert_rows:
+            self.assertEqual(allocator.reserve(self.session, 16, True), [])
+
+        #one batch and COLLISION_LIMIT addresses one by one
+        self.assertEqual(
+            insert_rows.call_count,
+            1 + MacAllocator.COLLISION_LIMIT
+        )
+        #all addresses can be reserved again
+        self.assertEqual(sum(allocator.used), 0)
+        self.assertEqual(len(allocator.released), 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from mock import patch
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.dialects import postgresql
+
+from src.database_toolkit import (
+    Base, Flavor, Image,
+    contexted_session, NoResultFound
+)
+from src.metadata_cache import MetadataCache
+
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine(
+            'sqlite://',
+            connect_args={'check_same_thread': False},
+            poolclass=StaticPool
+        )
+        Base.metadata.create_all(engine)
+
+        self.engine_patch = patch(
+            'src.database_toolkit.get_engine',
+            return_value=engine
+        )
+        self.engine_patch.start()
+
+        with contexted_session() as s:
+            s.add(Flavor(id=1, name='standart', vcpu=1, memory=524288))
+            s.add(Flavor(id=2, name='vip', vcpu=2, memory=1000000))
+            s.add(
+                Image(
+                    id='522700a8a063d875c192d818',
+                    name='ubuntu12.04server',
+                    fmt='qcow2',
+                    size=1400
+                )
+            )
+
+        self.cache = MetadataCache(ttl=300)
+
+    def tearDown(self):
+        self.engine_patch.stop()
+
+    def _rename_flavor(self, name):
+        with contexted_session() as s:
+            s.query(Flavor).filter(Flavor.id == 1).update({'name': name})
+
+    def test_read_through(self):
+        self.assertEqual(self.cache.flavor(1).memory, 524288)
+        self._rename_flavor('renamed')
+
+        #value is taken from cache
+        self.assertEqual(self.cache.flavor(1).name, 'standart')
+        self.assertEqual(
+            self.cache.image('522700a8a063d875c192d818').fmt,
+            'qcow2'
+        )
+
+        stats = self.cache.statistics()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_absent_entity(self):
+        self.assertRaises(NoResultFound, self.cache.flavor, 100)
+
+    def test_invalidate(self):
+        self.cache.flavor(1)
+        self._rename_flavor('renamed')
+
+        self.cache.invalidate('flavor', 1)
+        self.assertEqual(self.cache.flavor(1).name, 'renamed')
+
+    def test_expiration(self):
+        self.cache.ttl = 0
+        self.cache.flavor(1)
+        self._rename_flavor('renamed')
+
+        self.assertEqual(self.cache.flavor(1).name, 'renamed')
+
+    def test_warm_up(self):
+        self.cache.warm_up()
+        self.cache.flavors([1, 2])
+        self.cache.images(['522700a8a063d875c192d818'])
+
+        self.assertEqual(self.cache.statistics()['misses'], 0)
+
+    def test_page(self):
+        with contexted_session() as s:
+            for i in range(5):
+                s.add(
+                    Image(
+                        id='image-%s' % i,
+                        name='centos-%s' % i,
+                        fmt='raw' if i % 2 else 'qcow2',
+                        size=i * 100
+                    )
+                )
+
+        first = self.cache.page('image', limit=4, with_total=True)
+        self.assertEqual(
+            [image.id for image in first.items],
+            ['522700a8a063d875c192d818', 'image-0', 'image-1', 'image-2']
+        )
+        self.assertEqual(first.next_marker, 'image-2')
+        self.assertEqual(first.total, 6)
+
+        last = self.cache.page('image', first.next_marker, limit=4)
+        self.assertEqual(
+            [image.id for image in last.items],
+            ['image-3', 'image-4']
+        )
+        self.assertIsNone(last.next_marker)
+        self.assertIsNone(last.total)
+
+        #listed entities are cached
+        self.cache.image('image-4')
+        self.assertEqual(self.cache.statistics()['hits'], 1)
+
+    def test_page_filters(self):
+        with contexted_session() as s:
+            for i in range(5):
+                s.add(
+                    Image(
+                        id='image-%s' % i,
+                        name='centos-%s' % i,
+                        fmt='raw' if i % 2 else 'qcow2',
+                        size=i * 100
+                    )
+                )
+
+        page = self.cache.page(
+            'image',
+            name='centos',
+            fmt='qcow2',
+            min_size=100,
+            with_total=True
+        )
+        self.assertEqual(
+            [image.id for image in page.items],
+            ['image-2', 'image-4']
+        )
+        self.assertEqual(page.total, 2)
+
+        self.assertEqual(
+            [
+                flavor.id
+                for flavor in self.cache.page('flavor', min_vcpu=2).items
+            ],
+            [2]
+        )
+        self.assertRaises(
+            ValueError,
+            self.cache.page,
+            'flavor',
+            fmt='qcow2'
+        )
+
+    def test_name_filter_is_escaped(self):
+        with contexted_session() as s:
+            s.add(Image(id='image-0', name='a_1', fmt='raw', size=1))
+            s.add(Image(id='image-1', name='ab', fmt='raw', size=1))
+            s.add(Image(id='image-2', name='a%b', fmt='raw', size=1))
+
+        self.assertEqual(
+            [image.id for image in self.cache.page('image', name='a_').items],
+            ['image-0']
+        )
+        self.assertEqual(
+            [image.id for image in self.cache.page('image', name='a%').items],
+            ['image-2']
+        )
+
+    def test_large_images(self):
+        GiB = 1024 ** 3
+        with contexted_session() as s:
+            for i in range(3):
+                s.add(
+                    Image(
+                        id='image-%s' % i,
+                        name='windows-%s' % i,
+                        fmt='raw',
+                        size=(2 + 2 * i) * GiB
+                    )
+                )
+
+        page = self.cache.page(
+            'image',
+            min_size=3 * GiB,
+            max_size=str(5 * GiB)
+        )
+        self.assertEqual([image.id for image in page.items], ['image-1'])
+        self.assertEqual(page.items[0].size, 4 * GiB)
+
+        self.assertEqual(
+            Image.__table__.c.size.type.compile(dialect=postgresql.dialect()),
+            'BIGINT'
+        )
+
+    def test_cached_total(self):
+        self.assertEqual(self.cache.page('flavor', with_total=True).total, 2)
+
+        with contexted_session() as s:
+            s.add(Flavor(id=3, name='tiny', vcpu=1, memory=262144))
+
+        self.assertEqual(self.cache.page('flavor', with_total=True).total, 2)
+
+        self.cache.invalidate('flavor')
+        self.assertEqual(self.cache.page('flavor', with_total=True).total, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,20 +4,42 @@
 import os
 import os.path
 import shutil
+import time
+import hashlib
+import tempfile
 import unittest
+import threading
+from StringIO import StringIO
+from ConfigParser import ConfigParser
 import xml.etree.ElementTree as ElementTree
 
-from mock import patch, Mock
+from datetime import datetime, timedelta
+
+from mock import patch, Mock, MagicMock
 import libvirt
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.pool import StaticPool
 
 import src.nova_mimic
+from src.image_cache import ImageCache
+from src.image_integrity import (
+    ImageVerifier, ImageIntegrityError, read_checksum
+)
+from src.mac_allocator import MacAllocator, MacAllocatorError, parse_ranges
+from src.metadata_cache import ImageInfo
+from src.scheduler import NoValidHost
+from src.single_flight import SingleFlight
+from src.instance_registry import InstanceRecord
+from src.state_waiter import StateTimeoutError
+from src.xml_template import DomainTemplate
 from src.database_toolkit import (
-    Flavor, Image, MacAddress, Instance,
+    Base, Flavor, Image, MacAddress, Instance,
     contexted_session, NoResultFound,
-    MultipleResultsFound
+    MultipleResultsFound, SchemaMismatchError
 )
 
-#directory where images will be stored
+#directory of tests
 PATH_TO_TEST_PROJECTS_DIR = os.path.abspath(os.path.dirname(__file__))
 #path to config which store global setting for system
 PATH_TO_GLOBAL_CONFIG = os.path.join(
@@ -26,6 +48,12 @@ PATH_TO_GLOBAL_CONFIG = os.path.join(
     )[0],
     'config.ini'
 )
+#pattern of domain for test driver of libvirt
+PATH_TO_DOMAIN_PATTERN = os.path.join(
+    os.path.split(PATH_TO_TEST_PROJECTS_DIR)[0],
+    'benchmarks',
+    'domain_pattern.xml'
+)
 
 
 #just for remembering exception handling
@@ -33,13 +61,45 @@ class MyException(Exception):
     pass
 
 
+def sqlite_engine():
+    '''
+    Returns: engine of in-memory database shared by all threads
+    '''
+    engine = create_engine(
+        'sqlite://',
+        connect_args={'check_same_thread': False},
+        poolclass=StaticPool
+    )
+
+    #pysqlite does not emit BEGIN itself, savepoints (used by
+    #MacAllocator) need transaction begun explicitly
+    #(recipe from sqlalchemy docs)
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute('BEGIN')
+
+    return engine
+
+
+def domain_mock(uuid=None):
+    '''
+    Returns: mock of domain bound to live connection
+    '''
+    domain = Mock()
+    domain.connect.return_value.isAlive.return_value = 1
+    domain.UUIDString.return_value = uuid
+    return domain
+
+
 class TestNovaMimicBootMethod(unittest.TestCase):
     def setUp(self):
-        self.path_to_image_storage = os.path.join(
-            PATH_TO_TEST_PROJECTS_DIR,
-            'image_storage'
-        )
-        os.mkdir(self.path_to_image_storage)
+        self.path_to_image_storage = tempfile.mkdtemp()
+        #directory is removed even if setUp fails
+        self.addCleanup(shutil.rmtree, self.path_to_image_storage)
 
         self.libvirt_conn = libvirt.open("qemu:///system")
 
@@ -49,25 +109,27 @@ class TestNovaMimicBootMethod(unittest.TestCase):
         ):
             self.nova_mimic_instance = src.nova_mimic.NovaMimic()
 
+        self.nova_mimic_instance.image_cache = ImageCache(
+            self.path_to_image_storage
+        )
+        self.nova_mimic_instance.image_downloads = SingleFlight(
+            self.path_to_image_storage
+        )
+
     def tearDown(self):
         '''
         Destroys all domains which were
         started.
 
         Closes connectin to libvirt driver.
-
-        Removes test image storage directory
-        with all contents (i.e. image files)
         '''
 
-        for domain in self.nova_mimic_instance.domains_pool.values():
-            domain.destroy()
+        for record in self.nova_mimic_instance.registry.records():
+            if record.domain is not None:
+                record.domain.destroy()
 
         self.libvirt_conn.close()
-
-        #remove test image storage directory with all content
-        if os.path.exists(self.path_to_image_storage):
-            shutil.rmtree(self.path_to_image_storage)
+        self.nova_mimic_instance.close()
 
     def test_xml_processing(self):
         '''
@@ -172,7 +234,7 @@ class TestNovaMimicBootMethod(unittest.TestCase):
         to proper libvirt driver and performing lookup by
         name.
 
-        Checks presence of domain object in domains pool.
+        Checks presence of instance in registry.
 
         Checks data base (table instance) for row
         that corresponds to booted vm.
@@ -204,9 +266,9 @@ class TestNovaMimicBootMethod(unittest.TestCase):
 
             self.assertIsNotNone(domain)
 
-            #check domains_pool
+            #check registry of instances
             self.assertIsNotNone(
-                self.nova_mimic_instance.domains_pool.get(
+                self.nova_mimic_instance.registry.find_by_name(
                     fixture_data['instance_name']
                 )
             )
@@ -236,5 +298,1216 @@ class TestNovaMimicBootMethod(unittest.TestCase):
                 self.assertFalse(instance_mac_addr.is_free)
 
 
+def grout_mock(data):
+    grout = StringIO(data)
+    grout.length = len(data)
+    return grout
+
+
+class BrokenGridOut(object):
+    '''
+    Gridfs output object that fails after first chunk
+    '''
+    def __init__(self, data):
+        self.data = StringIO(data)
+        self.calls = 0
+
+    def read(self, size=-1):
+        self.calls += 1
+        if self.calls > 1:
+            raise IOError("connection to key-value storage is lost")
+        return self.data.read(size)
+
+
+class TestNovaMimicImageDownload(unittest.TestCase):
+    def setUp(self):
+        self.path_to_image_storage = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path_to_image_storage)
+
+        with patch(
+            'src.nova_mimic.PATH_TO_GLOBAL_CONFIG',
+            PATH_TO_GLOBAL_CONFIG
+        ):
+            with patch('src.nova_mimic.LibvirtConnectionPool'), \
+                    patch('src.nova_mimic.InstanceRegistry'), \
+                    patch('src.nova_mimic.StateTracker'), \
+                    patch('src.nova_mimic.contexted_session'), \
+                    patch('src.nova_mimic.verify_schema'):
+                self.nova_mimic_instance = src.nova_mimic.NovaMimic()
+
+        self.nova_mimic_instance.IMAGE_CHUNK_SIZE = 3
+        self.nova_mimic_instance.path_to_image_storage = \
+            self.path_to_image_storage
+        self.nova_mimic_instance.image_verifier = ImageVerifier(
+            self.path_to_image_storage
+        )
+        self.nova_mimic_instance.image_cache = ImageCache(
+            self.path_to_image_storage
+        )
+        self.nova_mimic_instance.image_downloads = SingleFlight(
+            self.path_to_image_storage
+        )
+        #every download gets its own gridfs output object
+        self.nova_mimic_instance.grfs = Mock()
+        self.nova_mimic_instance.grfs.get.side_effect = \
+            lambda object_id: grout_mock('qcow2 image data')
+        self.path_to_image = os.path.join(
+            self.path_to_image_storage,
+            '522700a8a063d875c192d818'
+        )
+
+    def tearDown(self):
+        self.nova_mimic_instance.close()
+
+    def test_download_image(self):
+        '''
+        Checks that image is copied completely, its checksum is saved
+        and no temporary files are left in image storage
+        '''
+        sha256 = self.nova_mimic_instance._download_image(
+            StringIO('qcow2 image data'),
+            self.path_to_image
+        )[2]
+
+        with open(self.path_to_image, 'rb') as f:
+            self.assertEqual(f.read(), 'qcow2 image data')
+
+        self.assertEqual(
+            sha256,
+            hashlib.sha256('qcow2 image data').hexdigest()
+        )
+        self.assertEqual(read_checksum(self.path_to_image)['sha256'], sha256)
+
+        self.assertEqual(
+            sorted(os.listdir(self.path_to_image_storage)),
+            [
+                '.522700a8a063d875c192d818.checksum',
+                '522700a8a063d875c192d818'
+            ]
+        )
+
+    def test_download_image_checksum_mismatch(self):
+        '''
+        Checks that image which is named by sha256 of other
+        content is not saved
+        '''
+        self.assertRaises(
+            ImageIntegrityError,
+            self.nova_mimic_instance._download_image,
+            StringIO('qcow2 image data'),
+            os.path.join(
+                self.path_to_image_storage,
+                hashlib.sha256('other image data').hexdigest()
+            )
+        )
+
+        self.assertEqual(os.listdir(self.path_to_image_storage), [])
+
+    def test_corrupted_image_is_downloaded_again(self):
+        image_id = '522700a8a063d875c192d818'
+
+        self.nova_mimic_instance._image_processing(image_id, image_id)
+        #cached image is checked by size and mtime only
+        self.nova_mimic_instance._image_processing(image_id, image_id)
+        self.assertEqual(self.nova_mimic_instance.grfs.get.call_count, 1)
+
+        #partially written file
+        with open(self.path_to_image, 'r+b') as f:
+            f.truncate(5)
+        self.nova_mimic_instance._image_processing(image_id, image_id)
+
+        self.assertEqual(self.nova_mimic_instance.grfs.get.call_count, 2)
+        with open(self.path_to_image, 'rb') as f:
+            self.assertEqual(f.read(), 'qcow2 image data')
+        self.assertEqual(
+            self.nova_mimic_instance.image_verifier.stats['corrupted'],
+            1
+        )
+
+    def test_corrupted_image_of_boot(self):
+        '''
+        Checks that corrupted image is downloaded again even if
+        boot which asks for it holds reference of it
+        '''
+        image_id = '522700a8a063d875c192d818'
+
+        for use_overlays in (False, True):
+            self.nova_mimic_instance.use_overlays = use_overlays
+            self.nova_mimic_instance.image_cache.acquire(image_id)
+            self.nova_mimic_instance._image_processing(image_id, image_id, 1)
+
+            with open(self.path_to_image, 'r+b') as f:
+                f.truncate(5)
+            self.nova_mimic_instance._image_processing(image_id, image_id, 1)
+
+            with open(self.path_to_image, 'rb') as f:
+                self.assertEqual(f.read(), 'qcow2 image data')
+            self.nova_mimic_instance.image_cache.release(image_id)
+
+        self.assertEqual(self.nova_mimic_instance.grfs.get.call_count, 3)
+
+    def test_image_written_by_guest(self):
+        '''
+        Checks that image booted without overlay is neither re-hashed
+        nor downloaded again after guest wrote to it
+        '''
+        self.nova_mimic_instance.domain_template = DomainTemplate(
+            PATH_TO_DOMAIN_PATTERN
+        )
+        image = ImageInfo(
+            '522700a8a063d875c192d818', 'ubuntu', 'qcow2', 16, None
+        )
+
+        self.nova_mimic_instance.image_cache.acquire(image.id)
+        self.nova_mimic_instance._image_processing(image.id, image.id, 1)
+        self.nova_mimic_instance._domain_processing(
+            'vm-0',
+            image,
+            Mock(memory=524288, vcpu=1),
+            '52:54:00:00:00:01'
+        )
+
+        #guest writes to image
+        with open(self.path_to_image, 'r+b') as f:
+            f.write('QCOW2 IMAGE')
+        os.utime(self.path_to_image, (1, 1))
+        self.nova_mimic_instance.image_cache.release(image.id)
+
+        self.nova_mimic_instance._image_processing(image.id, image.id, 1)
+
+        self.assertEqual(self.nova_mimic_instance.grfs.get.call_count, 1)
+        self.assertEqual(
+            self.nova_mimic_instance.image_verifier.stats['rehashed'],
+            0
+        )
+
+    def test_corrupted_image_used_by_overlays(self):
+        '''
+        Checks that backing file of running overlays is not replaced
+        and corrupted image is not booted
+        '''
+        self.nova_mimic_instance.use_overlays = True
+        image_id = '522700a8a063d875c192d818'
+
+        self.nova_mimic_instance._image_processing(image_id, image_id)
+        #running instance and boot
+        self.nova_mimic_instance.image_cache.acquire(image_id)
+        self.nova_mimic_instance.image_cache.acquire(image_id)
+        with open(self.path_to_image, 'r+b') as f:
+            f.truncate(5)
+
+        self.assertRaises(
+            ImageIntegrityError,
+            self.nova_mimic_instance._image_processing,
+            image_id,
+            image_id,
+            1
+        )
+        self.assertEqual(os.path.getsize(self.path_to_image), 5)
+        self.assertEqual(self.nova_mimic_instance.grfs.get.call_count, 1)
+
+    def test_sparse_download(self):
+        '''
+        Checks that blocks of zeros become holes of image file
+        and logical and allocated sizes are reported
+        '''
+        self.nova_mimic_instance.IMAGE_CHUNK_SIZE = 64 * 1024
+        block_size = self.nova_mimic_instance.SPARSE_BLOCK_SIZE
+        data = 'qcow2' + '\0' * (1024 * 1024) + 'image data' + \
+            '\0' * (256 * 1024)
+
+        logical_size, allocated_size, _ = \
+            self.nova_mimic_instance._download_image(
+                StringIO(data),
+                self.path_to_image
+            )
+
+        with open(self.path_to_image, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+        self.assertEqual(logical_size, len(data))
+        self.assertEqual(
+            allocated_size,
+            os.stat(self.path_to_image).st_blocks * 512
+        )
+        #only blocks with data are allocated
+        self.assertTrue(allocated_size <= 4 * block_size)
+
+    def test_download_image_failure(self):
+        '''
+        Checks that interrupted download leaves
+        neither image file nor temporary file
+        '''
+        self.assertRaises(
+            IOError,
+            self.nova_mimic_instance._download_image,
+            BrokenGridOut('qcow2 image data'),
+            self.path_to_image
+        )
+
+        self.assertEqual(os.listdir(self.path_to_image_storage), [])
+
+    def test_images_with_the_same_content(self):
+        '''
+        Checks that images with the same sha256 share one file
+        in image storage, which is downloaded once
+        '''
+        sha256 = hashlib.sha256('qcow2 image data').hexdigest()
+        self.nova_mimic_instance.metadata_cache = Mock()
+        self.nova_mimic_instance.metadata_cache.images.side_effect = \
+            lambda image_ids: dict(
+                (image_id, ImageInfo(image_id, 'image', 'raw', 16, sha256))
+                for image_id in image_ids
+            )
+
+        for image_id in ('522700a8a063d875c192d818',
+                         '522700a8a063d875c192d819'):
+            self.nova_mimic_instance._image_processing(image_id)
+
+        self.assertEqual(self.nova_mimic_instance.grfs.get.call_count, 1)
+        self.assertEqual(
+            [
+                name for name in os.listdir(self.path_to_image_storage)
+                if not name.startswith('.')
+            ],
+            [sha256]
+        )
+
+    def test_overlay_processing(self):
+        '''
+        Checks that overlay refers to cached image as
+        to backing file and is removed with instance
+        '''
+        self.nova_mimic_instance.path_to_instance_storage = \
+            self.path_to_image_storage
+
+        with patch('src.nova_mimic.subprocess.check_call') as check_call:
+            path_to_overlay = self.nova_mimic_instance._overlay_processing(
+                'uuid-0',
+                '522700a8a063d875c192d818',
+                'qcow2'
+            )
+
+        self.assertEqual(
+            path_to_overlay,
+            os.path.join(self.path_to_image_storage, 'uuid-0.qcow2')
+        )
+
+        args = check_call.call_args[0][0]
+        self.assertEqual(args[-1], path_to_overlay)
+        self.assertIn(
+            'backing_file=%s,backing_fmt=qcow2' % self.path_to_image,
+            args
+        )
+
+        self.nova_mimic_instance._remove_overlay('uuid-0')
+        self.assertFalse(os.path.exists(path_to_overlay))
+
+    def test_existing_overlay(self):
+        '''
+        Checks that overlay of other instance is never overwritten
+        and failed overlay is not left behind
+        '''
+        self.nova_mimic_instance.path_to_instance_storage = \
+            self.path_to_image_storage
+        path_to_overlay = os.path.join(
+            self.path_to_image_storage,
+            'uuid-0.qcow2'
+        )
+        with open(path_to_overlay, 'wb') as f:
+            f.write('overlay of running instance')
+
+        with patch('src.nova_mimic.subprocess.check_call') as check_call:
+            self.assertRaises(
+                OSError,
+                self.nova_mimic_instance._overlay_processing,
+                'uuid-0',
+                '522700a8a063d875c192d818',
+                'qcow2'
+            )
+            self.assertFalse(check_call.called)
+
+            check_call.side_effect = OSError("qemu-img is not found")
+            self.assertRaises(
+                OSError,
+                self.nova_mimic_instance._overlay_processing,
+                'uuid-1',
+                '522700a8a063d875c192d818',
+                'qcow2'
+            )
+
+        with open(path_to_overlay, 'rb') as f:
+            self.assertEqual(f.read(), 'overlay of running instance')
+        self.assertFalse(
+            os.path.exists(
+                os.path.join(self.path_to_image_storage, 'uuid-1.qcow2')
+            )
+        )
+
+
+class TestNovaMimicLifecycle(unittest.TestCase):
+    def setUp(self):
+        with patch(
+            'src.nova_mimic.PATH_TO_GLOBAL_CONFIG',
+            PATH_TO_GLOBAL_CONFIG
+        ):
+            with patch('src.nova_mimic.LibvirtConnectionPool'), \
+                    patch('src.nova_mimic.StateTracker'), \
+                    patch('src.nova_mimic.contexted_session'), \
+                    patch('src.nova_mimic.verify_schema'):
+                self.nova_mimic_instance = src.nova_mimic.NovaMimic()
+
+        #rows of destroyed instances are deleted by own transaction
+        session_patcher = patch('src.nova_mimic.contexted_session')
+        self.contexted_session = session_patcher.start()
+        self.addCleanup(session_patcher.stop)
+
+        self.nova_mimic_instance.image_cache = Mock()
+        #images are uploaded without hash
+        self.nova_mimic_instance.metadata_cache = Mock()
+        self.nova_mimic_instance.metadata_cache.images.return_value = {}
+        self.registry = self.nova_mimic_instance.registry
+
+        self.domains = {}
+        for i in range(3):
+            instance_id = 'uuid-%s' % i
+            self.domains[instance_id] = domain_mock(instance_id)
+            self.registry.add(
+                InstanceRecord(
+                    instance_id,
+                    'vm-%s' % i,
+                    state=libvirt.VIR_DOMAIN_RUNNING,
+                    image_id='522700a8a063d875c192d818',
+                    domain=self.domains[instance_id]
+                )
+            )
+
+    def tearDown(self):
+        self.nova_mimic_instance.close()
+
+    def test_shutdown_many(self):
+        #guests shut down in parallel, event of each one
+        #resolves its future
+        self.domains['uuid-0'].shutdown.side_effect = \
+            lambda: self.registry.update_state(
+                'uuid-0',
+                libvirt.VIR_DOMAIN_SHUTOFF
+            )
+        futures = self.nova_mimic_instance.instance_shutdown(
+            ['uuid-0', 'uuid-1'],
+            timeout=5
+        )
+
+        self.assertEqual(futures[0].result(5), libvirt.VIR_DOMAIN_SHUTOFF)
+        self.assertFalse(futures[1].done())
+
+        self.registry.update_state('uuid-1', libvirt.VIR_DOMAIN_SHUTOFF)
+        self.assertEqual(futures[1].result(5), libvirt.VIR_DOMAIN_SHUTOFF)
+
+        for instance_id in ('uuid-0', 'uuid-1'):
+            self.assertTrue(self.domains[instance_id].shutdown.called)
+            self.assertFalse(self.domains[instance_id].destroy.called)
+
+    def test_shutdown_escalation(self):
+        future = self.nova_mimic_instance.instance_shutdown(
+            'uuid-0',
+            timeout=0.1
+        )
+        self.assertEqual(future.result(5), libvirt.VIR_DOMAIN_SHUTOFF)
+
+        self.assertTrue(self.domains['uuid-0'].destroy.called)
+        self.assertIsNone(self.registry.get('uuid-0'))
+        self.nova_mimic_instance.image_cache.release.assert_called_once_with(
+            '522700a8a063d875c192d818'
+        )
+
+    def test_shutdown_timeout(self):
+        future = self.nova_mimic_instance.instance_shutdown(
+            'uuid-0',
+            timeout=0.1,
+            force=False
+        )
+        self.assertRaises(StateTimeoutError, future.result, 5)
+        self.assertFalse(self.domains['uuid-0'].destroy.called)
+
+    def test_reboot(self):
+        called = threading.Event()
+        self.domains['uuid-2'].reboot.side_effect = \
+            lambda flags: called.set()
+
+        future = self.nova_mimic_instance.instance_reboot('uuid-2')
+        self.assertTrue(called.wait(5))
+        #running domain does not resolve future until reboot event
+        time.sleep(0.05)
+        self.assertFalse(future.done())
+
+        self.registry.mark_rebooted('uuid-2')
+        self.assertEqual(future.result(5), libvirt.VIR_DOMAIN_RUNNING)
+        self.domains['uuid-2'].reboot.assert_called_once_with(0)
+
+    def test_reboot_timeout(self):
+        future = self.nova_mimic_instance.instance_reboot(
+            'uuid-2',
+            timeout=0.1
+        )
+        self.assertRaises(StateTimeoutError, future.result, 5)
+
+    def test_destroy_many(self):
+        futures = self.nova_mimic_instance.instance_destroy(
+            ['uuid-0', 'uuid-1', 'unknown']
+        )
+
+        self.assertEqual(futures[0].result(5), libvirt.VIR_DOMAIN_SHUTOFF)
+        self.assertEqual(futures[1].result(5), libvirt.VIR_DOMAIN_SHUTOFF)
+        self.assertRaises(NoResultFound, futures[2].result, 5)
+        self.assertEqual(len(self.registry), 1)
+        #rows of both instances are deleted by one transaction
+        self.assertEqual(self.contexted_session.call_count, 1)
+
+    def test_reconnect(self):
+        #libvirtd was restarted, handle of domain is bound
+        #to dead connection
+        self.domains['uuid-0'].connect.return_value.isAlive.return_value = 0
+        domain = domain_mock('uuid-0')
+        pool = self.nova_mimic_instance.libvirt_pool
+        pool.call.return_value = domain
+
+        futures = self.nova_mimic_instance.instance_destroy(['uuid-0'])
+
+        self.assertEqual(futures[0].result(5), libvirt.VIR_DOMAIN_SHUTOFF)
+        pool.call.assert_called_with('lookupByUUIDString', 'uuid-0')
+        self.assertTrue(domain.destroy.called)
+        self.assertFalse(self.domains['uuid-0'].destroy.called)
+
+    def test_destroy_failed_transaction(self):
+        self.contexted_session.side_effect = OperationalError(
+            'DELETE', {}, Exception('database is locked')
+        )
+
+        futures = self.nova_mimic_instance.instance_destroy(['uuid-0'])
+
+        self.assertRaises(OperationalError, futures[0].result, 5)
+        #record is kept, so destroy can be repeated
+        self.assertIsNotNone(self.registry.get('uuid-0'))
+        self.assertFalse(self.nova_mimic_instance.image_cache.release.called)
+
+    def test_tracing(self):
+        self.nova_mimic_instance.tracer.enabled = True
+
+        self.nova_mimic_instance.instance_shutdown(
+            'uuid-0',
+            timeout=0.1
+        ).result(5)
+
+        #span of operation is finished by callback of its future,
+        #which can be called right after result is returned
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            statistics = self.nova_mimic_instance.tracer.statistics()
+            if 'instance_shutdown' in statistics:
+                break
+            time.sleep(0.01)
+
+        for name in ('instance_shutdown', 'instance_shutdown_call',
+                     'instance_destroy'):
+            self.assertEqual(statistics[name]['count'], 1)
+
+
+class TestNovaMimicTwoPhaseBoot(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlite_engine()
+        Base.metadata.create_all(self.engine)
+
+        self.engine_patch = patch(
+            'src.database_toolkit.get_engine',
+            return_value=self.engine
+        )
+        self.engine_patch.start()
+
+        with contexted_session() as s:
+            s.add(Flavor(id=1, name='standart', vcpu=1, memory=524288))
+            s.add(
+                Image(
+                    id='522700a8a063d875c192d818',
+                    name='ubuntu',
+                    fmt='raw',
+                    size=16
+                )
+            )
+
+        #connections which are checked out of pool at the moment
+        self.checked_out = []
+        event.listen(
+            self.engine,
+            'checkout',
+            lambda *args: self.checked_out.append(1)
+        )
+        event.listen(
+            self.engine,
+            'checkin',
+            lambda *args: self.checked_out.pop()
+        )
+
+        self.nova_mimic_instance = self._nova_mimic()
+
+    def tearDown(self):
+        self.nova_mimic_instance.close()
+        self.engine_patch.stop()
+
+    def _nova_mimic(self):
+        with patch(
+            'src.nova_mimic.PATH_TO_GLOBAL_CONFIG',
+            PATH_TO_GLOBAL_CONFIG
+        ):
+            with patch('src.nova_mimic.LibvirtConnectionPool') as pool, \
+                    patch('src.nova_mimic.StateTracker'):
+                #model, memory in MiB, number of cpus
+                pool.return_value.call.return_value = ['x86_64', 4096, 4]
+                nova_mimic = src.nova_mimic.NovaMimic()
+
+        nova_mimic.domain_template = DomainTemplate(PATH_TO_DOMAIN_PATTERN)
+        nova_mimic.image_cache = Mock()
+        #images are not present in image storage
+        nova_mimic.image_verifier = None
+        nova_mimic._image_processing = Mock()
+        nova_mimic.libvirt_pool.call.side_effect = self._create_xml
+
+        return nova_mimic
+
+    def _create_xml(self, method, xml_config_string, flags):
+        doc_root = ElementTree.fromstring(xml_config_string)
+        domain = domain_mock(doc_root.find('uuid').text)
+        domain.state.return_value = [libvirt.VIR_DOMAIN_RUNNING, 1]
+        return domain
+
+    def _fail_creation(self, instance_name):
+        '''
+        Makes creation of domain of instance with given name fail
+        '''
+        def create_xml(method, xml_config_string, flags):
+            if '<name>%s</name>' % instance_name in xml_config_string:
+                raise libvirt.libvirtError('domain can not be created')
+            return self._create_xml(method, xml_config_string, flags)
+
+        self.nova_mimic_instance.libvirt_pool.call.side_effect = create_xml
+
+    def _instances(self):
+        with contexted_session() as s:
+            return s.query(Instance.id, Instance.state, MacAddress.is_free)\
+                    .join(MacAddress, Instance.mac_addr == MacAddress.id)\
+                    .all()
+
+    def test_outdated_schema(self):
+        #table of instances was created before column of host was added
+        Instance.__table__.drop(self.engine)
+        self.engine.execute(
+            'CREATE TABLE instance (id VARCHAR(50) PRIMARY KEY, '
+            'domain_name VARCHAR(50), state VARCHAR(50), '
+            'image_id VARCHAR(50), mac_addr INTEGER, '
+            'created_at DATETIME)'
+        )
+
+        with self.assertRaises(SchemaMismatchError) as context:
+            self._nova_mimic()
+        self.assertIn('instance.host is absent', str(context.exception))
+
+    def test_boot(self):
+        def image_processing(image_id, image_key, references):
+            #row of instance is committed before download and
+            #no connection is held during it
+            self.assertEqual(self.checked_out, [])
+            self.assertEqual(
+                [state for _, state, _ in self._instances()],
+                ['pending']
+            )
+
+        self.nova_mimic_instance._image_processing.side_effect = \
+            image_processing
+
+        instance_id = self.nova_mimic_instance.instance_boot(
+            'test_instance',
+            '522700a8a063d875c192d818',
+            1
+        )
+
+        self.assertTrue(self.nova_mimic_instance._image_processing.called)
+        #uuid is chosen by NovaMimic and given to libvirt in xml
+        self.assertEqual(
+            self.nova_mimic_instance.registry.get(instance_id)
+                .domain.UUIDString(),
+            instance_id
+        )
+        self.assertEqual(self._instances(), [(instance_id, 'running', False)])
+
+    def test_disk_format(self):
+        nova_mimic = self.nova_mimic_instance
+        with contexted_session() as s:
+            s.query(Image).update({'fmt': 'qcow2'})
+
+        def disk_format():
+            xml_config_string = nova_mimic.libvirt_pool.call.call_args[0][1]
+            return ElementTree.fromstring(xml_config_string)\
+                .find('devices/disk/driver').get('type')
+
+        #domain boots right from image of its format
+        nova_mimic.instance_boot('vm-0', '522700a8a063d875c192d818', 1)
+        self.assertEqual(disk_format(), 'qcow2')
+
+        #overlay is qcow2 whatever its name and format of image are
+        nova_mimic.metadata_cache.invalidate()
+        with contexted_session() as s:
+            s.query(Image).update({'fmt': 'raw'})
+            s.add(MacAddress(address='52:54:00:83:df:a2', is_free=True))
+        nova_mimic.use_overlays = True
+        nova_mimic._overlay_processing = Mock(return_value='/instances/vm-1')
+        nova_mimic.instance_boot('vm-1', '522700a8a063d875c192d818', 1)
+        self.assertEqual(disk_format(), 'qcow2')
+
+    def test_failed_boot(self):
+        self.nova_mimic_instance._image_processing.side_effect = \
+            IOError("connection to key-value storage is lost")
+
+        self.assertRaises(
+            IOError,
+            self.nova_mimic_instance.instance_boot,
+            'test_instance',
+            '522700a8a063d875c192d818',
+            1
+        )
+
+        #row is removed and mac address is free again
+        self.assertEqual(self._instances(), [])
+        with contexted_session() as s:
+            self.assertEqual(
+                s.query(MacAddress.is_free).all(),
+                [(True,)]
+            )
+        self.nova_mimic_instance.image_cache.release.assert_called_once_with(
+            '522700a8a063d875c192d818'
+        )
+        self.assertEqual(len(self.nova_mimic_instance.registry), 0)
+
+    def test_boot_many(self):
+        self._fail_creation('vm-1')
+
+        results = self.nova_mimic_instance.instance_boot_many(
+            [
+                ('vm-0', '522700a8a063d875c192d818', 1),
+                ('vm-1', '522700a8a063d875c192d818', 1),
+                ('vm-2', '522700a8a063d875c192d818', 2)
+            ]
+        )
+
+        self.assertIsNotNone(results[0]['id'])
+        self.assertIsInstance(results[1]['error'], libvirt.libvirtError)
+        self.assertIsInstance(results[2]['error'], NoResultFound)
+        self.assertEqual(
+            self._instances(),
+            [(results[0]['id'], 'running', False)]
+        )
+
+    def test_failed_reserve(self):
+        with contexted_session() as s:
+            s.add(Instance(id='uuid-0', domain_name='vm-0'))
+
+        #row of instance with the same id makes transaction fail
+        self.assertRaises(
+            IntegrityError,
+            self.nova_mimic_instance._reserve_boots,
+            [('uuid-0', 'vm-0', '522700a8a063d875c192d818', None)]
+        )
+
+        #address is given back to allocator, since its row is free
+        mac_allocator = self.nova_mimic_instance.mac_allocator
+        self.assertEqual(sum(mac_allocator.used), 0)
+        with contexted_session() as s:
+            self.assertEqual(s.query(MacAddress).count(), 0)
+
+    def test_destroy(self):
+        results = self.nova_mimic_instance.instance_boot_many(
+            [
+                ('vm-0', '522700a8a063d875c192d818', 1),
+                ('vm-1', '522700a8a063d875c192d818', 1)
+            ]
+        )
+        instance_ids = [result['id'] for result in results]
+
+        futures = self.nova_mimic_instance.instance_destroy(instance_ids)
+        for future in futures:
+            self.assertEqual(future.result(5), libvirt.VIR_DOMAIN_SHUTOFF)
+
+        #rows are deleted and mac addresses can be reserved again
+        self.assertEqual(self._instances(), [])
+        with contexted_session() as s:
+            self.assertEqual(
+                s.query(MacAddress.is_free).all(),
+                [(True,), (True,)]
+            )
+        self.assertEqual(len(self.nova_mimic_instance.registry), 0)
+        self.assertEqual(
+            len(self.nova_mimic_instance.mac_allocator.released),
+            2
+        )
+
+    def test_boot_many_mixed_failures(self):
+        '''
+        Checks that every kind of failure of one batch is reported
+        for its request and leaves nothing reserved
+        '''
+        #two addresses for three instances which get so far
+        self.nova_mimic_instance.mac_allocator = MacAllocator(
+            parse_ranges('52:54:00:00:00:01-52:54:00:00:00:02')
+        )
+
+        self._fail_creation('vm-2')
+
+        results = self.nova_mimic_instance.instance_boot_many(
+            [
+                ('vm-0', '522700a8a063d875c192d818', 99),
+                ('vm-1', 'missing', 1),
+                ('vm-2', '522700a8a063d875c192d818', 1),
+                ('vm-3', '522700a8a063d875c192d818', 1),
+                ('vm-4', '522700a8a063d875c192d818', 1)
+            ]
+        )
+
+        self.assertEqual(
+            [result['name'] for result in results],
+            ['vm-0', 'vm-1', 'vm-2', 'vm-3', 'vm-4']
+        )
+        self.assertIsInstance(results[0]['error'], NoResultFound)
+        self.assertIn('flavor', str(results[0]['error']))
+        self.assertIsInstance(results[1]['error'], NoResultFound)
+        self.assertIn('image', str(results[1]['error']))
+        self.assertIsInstance(results[2]['error'], libvirt.libvirtError)
+        self.assertIsNone(results[3]['error'])
+        self.assertIsInstance(results[4]['error'], MacAllocatorError)
+        self.assertEqual(
+            [result['id'] is None for result in results],
+            [True, True, True, False, True]
+        )
+
+        #only booted instance keeps its row, mac address, resources
+        #of host and reference of image
+        instance_id = results[3]['id']
+        self.assertEqual(self._instances(), [(instance_id, 'running', False)])
+        with contexted_session() as s:
+            self.assertEqual(
+                sorted(s.query(MacAddress.is_free).all()),
+                [(False,), (True,)]
+            )
+        self.assertEqual(
+            self.nova_mimic_instance.scheduler.placements.keys(),
+            [instance_id]
+        )
+        image_cache = self.nova_mimic_instance.image_cache
+        self.assertEqual(image_cache.acquire.call_count, 2)
+        self.assertEqual(image_cache.release.call_count, 1)
+        self.assertEqual(
+            [record.id for record in
+             self.nova_mimic_instance.registry.records()],
+            [instance_id]
+        )
+
+    def test_recover_pending_boots(self):
+        '''
+        Checks that instances left by interrupted boots are
+        cleaned up on start
+        '''
+        self.nova_mimic_instance.close()
+
+        with contexted_session() as s:
+            mac_address = MacAddress(
+                address='52:54:00:00:00:01',
+                is_free=False
+            )
+            s.add(mac_address)
+            s.flush()
+            created_at = datetime.utcnow() - timedelta(days=1)
+            s.add(
+                Instance(
+                    id='uuid-0',
+                    state='pending',
+                    mac_addr=mac_address.id,
+                    created_at=created_at
+                )
+            )
+            #boot which is still in progress
+            s.add(
+                Instance(
+                    id='uuid-1',
+                    state='pending',
+                    mac_addr=mac_address.id
+                )
+            )
+
+        self.nova_mimic_instance = self._nova_mimic()
+
+        self.assertEqual(
+            [instance_id for instance_id, _, _ in self._instances()],
+            ['uuid-1']
+        )
+        with contexted_session() as s:
+            self.assertTrue(s.query(MacAddress.is_free).scalar())
+
+    def test_recover_pending_boots_periodically(self):
+        '''
+        Checks that boots interrupted after start are recovered by
+        background thread and boots in progress are not
+        '''
+        nova_mimic = self.nova_mimic_instance
+        nova_mimic.pending_timeout = 0
+
+        def image_processing(image_id, image_key, references):
+            nova_mimic._maintain()
+        nova_mimic._image_processing.side_effect = image_processing
+
+        instance_id = nova_mimic.instance_boot(
+            'test_instance',
+            '522700a8a063d875c192d818',
+            1
+        )
+        self.assertEqual(self._instances(), [(instance_id, 'running', False)])
+        self.assertEqual(nova_mimic.booting, set())
+
+        #boot whose last transaction failed leaves pending row
+        nova_mimic.libvirt_pool.call.side_effect = \
+            libvirt.libvirtError('domain can not be created')
+        with patch.object(
+            nova_mimic,
+            '_save_boots',
+            side_effect=OperationalError('UPDATE', {}, None)
+        ):
+            self.assertRaises(
+                libvirt.libvirtError,
+                nova_mimic.instance_boot,
+                'failed_instance',
+                '522700a8a063d875c192d818',
+                1
+            )
+        self.assertEqual(len(self._instances()), 2)
+
+        nova_mimic._maintain()
+
+        self.assertEqual(self._instances(), [(instance_id, 'running', False)])
+        with contexted_session() as s:
+            self.assertEqual(
+                sorted(s.query(MacAddress.is_free).all()),
+                [(False,), (True,)]
+            )
+
+
+class TestNovaMimicPlacement(unittest.TestCase):
+    '''
+    Instances are placed on two hosts which share one libvirt
+    test driver (as test:///default connections do)
+    '''
+    def setUp(self):
+        engine = sqlite_engine()
+        Base.metadata.create_all(engine)
+
+        self.engine_patch = patch(
+            'src.database_toolkit.get_engine',
+            return_value=engine
+        )
+        self.engine_patch.start()
+
+        with contexted_session() as s:
+            s.add(Flavor(id=1, name='standart', vcpu=1, memory=524288))
+            s.add(Flavor(id=2, name='huge', vcpu=1, memory=67108864))
+            s.add(
+                Image(
+                    id='522700a8a063d875c192d818',
+                    name='ubuntu',
+                    fmt='raw',
+                    size=16
+                )
+            )
+
+        conf = ConfigParser()
+        conf.read(PATH_TO_GLOBAL_CONFIG)
+        conf.set(
+            'scheduler',
+            'hosts',
+            'node-0=test:///default,node-1=test:///default'
+        )
+        conf.set('scheduler', 'strategy', 'spread')
+        conf.set('scheduler', 'memory_ratio', '1.0')
+        conf.set('scheduler', 'cpu_ratio', '4.0')
+        conf.set('scheduler', 'reserved_memory', '0')
+        fd, self.path_to_config = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            conf.write(f)
+
+        #domains of driver, they are seen by connections of both hosts
+        self.domains = []
+        #numbers of pools (in order of hosts) which can not connect
+        self.unreachable = set()
+        self.nova_mimic_instance = self._nova_mimic()
+
+    def tearDown(self):
+        self.nova_mimic_instance.close()
+        self.engine_patch.stop()
+        os.remove(self.path_to_config)
+
+    def _nova_mimic(self):
+        self.pools = []
+        with patch(
+            'src.nova_mimic.PATH_TO_GLOBAL_CONFIG',
+            self.path_to_config
+        ):
+            with patch(
+                'src.nova_mimic.LibvirtConnectionPool',
+                side_effect=self._pool
+            ), patch('src.nova_mimic.StateTracker'):
+                nova_mimic = src.nova_mimic.NovaMimic()
+
+        nova_mimic.domain_template = DomainTemplate(PATH_TO_DOMAIN_PATTERN)
+        nova_mimic.image_cache = Mock()
+        #images are not present in image storage
+        nova_mimic.image_verifier = None
+        nova_mimic._image_processing = Mock()
+
+        return nova_mimic
+
+    def _pool(self, uri, **kwargs):
+        pool = MagicMock()
+        pool.uri = uri
+        index = len(self.pools)
+        self.pools.append(pool)
+
+        def reachable(function):
+            def call(*args):
+                if index in self.unreachable:
+                    raise libvirt.libvirtError('unable to connect to %s' % uri)
+                return function(*args)
+            return call
+
+        pool.call.side_effect = reachable(self._call)
+        pool.connection.return_value.__enter__.side_effect = \
+            reachable(lambda: connection)
+
+        connection = Mock()
+        connection.getAllDomainStats.side_effect = self._all_domain_stats
+
+        return pool
+
+    def _all_domain_stats(self, stats):
+        return [
+            (domain, {'state.state': libvirt.VIR_DOMAIN_RUNNING})
+            for domain in self.domains
+        ]
+
+    def _call(self, method, *args):
+        if method == 'getInfo':
+            #model, memory in MiB, number of cpus
+            return ['x86_64', 2048, 2]
+        if method == 'getAllDomainStats':
+            return self._all_domain_stats(*args)
+
+        doc_root = ElementTree.fromstring(args[0])
+        memory = int(doc_root.find('memory').text)
+        vcpu = int(doc_root.find('vcpu').text)
+
+        domain = domain_mock(doc_root.find('uuid').text)
+        domain.name.return_value = doc_root.find('name').text
+        domain.state.return_value = [libvirt.VIR_DOMAIN_RUNNING, 1]
+        domain.info.return_value = [
+            libvirt.VIR_DOMAIN_RUNNING, memory, memory, vcpu, 0
+        ]
+        self.domains.append(domain)
+
+        return domain
+
+    def _free_memory(self):
+        return dict(
+            (name, host['free_memory'])
+            for name, host in
+            self.nova_mimic_instance.scheduler.statistics()['hosts'].items()
+        )
+
+    def test_spread(self):
+        instance_ids = [
+            self.nova_mimic_instance.instance_boot(
+                'vm-%s' % i,
+                '522700a8a063d875c192d818',
+                1
+            )
+            for i in range(2)
+        ]
+
+        hosts = [
+            self.nova_mimic_instance.registry.get(instance_id).host
+            for instance_id in instance_ids
+        ]
+        self.assertEqual(sorted(hosts), ['node-0', 'node-1'])
+        self.assertEqual(
+            self._free_memory(),
+            {'node-0': 1572864, 'node-1': 1572864}
+        )
+
+        with contexted_session() as s:
+            self.assertEqual(
+                dict(s.query(Instance.id, Instance.host).all()),
+                dict(zip(instance_ids, hosts))
+            )
+
+    def test_no_valid_host(self):
+        self.assertRaises(
+            NoValidHost,
+            self.nova_mimic_instance.instance_boot,
+            'vm-0',
+            '522700a8a063d875c192d818',
+            2
+        )
+
+        #nothing is reserved for instance which does not fit
+        with contexted_session() as s:
+            self.assertEqual(s.query(Instance).count(), 0)
+            self.assertEqual(s.query(MacAddress).count(), 0)
+        self.assertFalse(self.nova_mimic_instance.image_cache.acquire.called)
+
+    def test_boot_many_over_capacity(self):
+        #8 vcpus of every host, but memory for 4 instances only
+        results = self.nova_mimic_instance.instance_boot_many(
+            [
+                ('vm-%s' % i, '522700a8a063d875c192d818', 1)
+                for i in range(9)
+            ]
+        )
+
+        self.assertEqual(
+            [result['error'] is None for result in results],
+            [True] * 8 + [False]
+        )
+        self.assertIsInstance(results[8]['error'], NoValidHost)
+        self.assertEqual(self._free_memory(), {'node-0': 0, 'node-1': 0})
+
+    def test_destroy(self):
+        instance_id = self.nova_mimic_instance.instance_boot(
+            'vm-0',
+            '522700a8a063d875c192d818',
+            1
+        )
+        self.nova_mimic_instance.instance_destroy(instance_id).result(5)
+
+        self.assertEqual(
+            self._free_memory(),
+            {'node-0': 2097152, 'node-1': 2097152}
+        )
+
+    def test_failed_boot(self):
+        self.nova_mimic_instance._image_processing.side_effect = \
+            IOError("connection to key-value storage is lost")
+
+        self.assertRaises(
+            IOError,
+            self.nova_mimic_instance.instance_boot,
+            'vm-0',
+            '522700a8a063d875c192d818',
+            1
+        )
+
+        self.assertEqual(
+            self._free_memory(),
+            {'node-0': 2097152, 'node-1': 2097152}
+        )
+
+    def test_restart(self):
+        '''
+        Checks that hosts of running instances and their resources
+        are restored on start
+        '''
+        placements = {}
+        for i in range(3):
+            instance_id = self.nova_mimic_instance.instance_boot(
+                'vm-%s' % i,
+                '522700a8a063d875c192d818',
+                1
+            )
+            placements[instance_id] = \
+                self.nova_mimic_instance.registry.get(instance_id).host
+        free_memory = self._free_memory()
+        self.nova_mimic_instance.close()
+
+        self.nova_mimic_instance = self._nova_mimic()
+
+        for instance_id, host in placements.items():
+            self.assertEqual(
+                self.nova_mimic_instance.registry.get(instance_id).host,
+                host
+            )
+        self.assertEqual(self._free_memory(), free_memory)
+
+    def test_unreachable_host(self):
+        instance_ids = [
+            self.nova_mimic_instance.instance_boot(
+                'vm-%s' % i,
+                '522700a8a063d875c192d818',
+                1
+            )
+            for i in range(2)
+        ]
+        on_node_1 = [
+            instance_id for instance_id in instance_ids
+            if self.nova_mimic_instance.registry.get(instance_id).host ==
+            'node-1'
+        ]
+        self.nova_mimic_instance.close()
+
+        self.unreachable = set([1])
+        self.nova_mimic_instance = self._nova_mimic()
+
+        self.assertEqual(
+            self.nova_mimic_instance.unreachable_hosts,
+            set(['node-1'])
+        )
+        self.assertEqual(self._free_memory()['node-1'], 0)
+        #instance of unreachable host is kept without domain
+        record = self.nova_mimic_instance.registry.get(on_node_1[0])
+        self.assertIsNone(record.domain)
+        self.assertEqual(record.host, 'node-1')
+
+        instance_id = self.nova_mimic_instance.instance_boot(
+            'vm-2',
+            '522700a8a063d875c192d818',
+            1
+        )
+        self.assertEqual(
+            self.nova_mimic_instance.registry.get(instance_id).host,
+            'node-0'
+        )
+
+        return on_node_1
+
+    def test_host_comes_back(self):
+        on_node_1 = self.test_unreachable_host()
+        self.assertEqual(self.nova_mimic_instance.probe_hosts(), [])
+
+        self.unreachable.clear()
+        self.assertEqual(self.nova_mimic_instance.probe_hosts(), ['node-1'])
+
+        self.assertEqual(self.nova_mimic_instance.unreachable_hosts, set())
+        record = self.nova_mimic_instance.registry.get(on_node_1[0])
+        self.assertIsNotNone(record.domain)
+        self.assertEqual(record.state, libvirt.VIR_DOMAIN_RUNNING)
+        #instance of host claims its resources and references its image
+        self.assertEqual(self._free_memory()['node-1'], 1572864)
+        self.nova_mimic_instance.image_cache.acquire.assert_called_with(
+            '522700a8a063d875c192d818'
+        )
+
+        #new instances are placed on host again
+        instance_id = self.nova_mimic_instance.instance_boot(
+            'vm-3',
+            '522700a8a063d875c192d818',
+            1
+        )
+        self.assertEqual(
+            self.nova_mimic_instance.registry.get(instance_id).host,
+            'node-1'
+        )
+
+
 if __name__ == '__file__':
     unittest.main()
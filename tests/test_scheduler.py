@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import random
+import unittest
+
+from src.scheduler import (
+    Scheduler, SchedulerError, NoValidHost, ImageLocalityStrategy,
+    PackStrategy, parse_hosts
+)
+
+GiB = 1024 * 1024
+
+
+class TestParseHosts(unittest.TestCase):
+    def test_parse_hosts(self):
+        self.assertEqual(
+            parse_hosts(
+                'node-0=qemu+ssh://node-0/system, '
+                'node-1=test:///default?name=node-1,'
+            ),
+            [
+                ('node-0', 'qemu+ssh://node-0/system'),
+                ('node-1', 'test:///default?name=node-1')
+            ]
+        )
+        self.assertEqual(parse_hosts(''), [])
+
+    def test_invalid_hosts(self):
+        self.assertRaises(SchedulerError, parse_hosts, 'qemu:///system')
+        self.assertRaises(
+            SchedulerError,
+            parse_hosts,
+            'node=test:///default,node=test:///default'
+        )
+
+
+class TestScheduler(unittest.TestCase):
+    def _scheduler(self, strategy):
+        scheduler = Scheduler(strategy)
+        scheduler.add_host('small', 4 * GiB, 4)
+        scheduler.add_host('large', 16 * GiB, 4)
+        scheduler.add_host('medium', 8 * GiB, 4)
+
+        return scheduler
+
+    def test_spread(self):
+        scheduler = self._scheduler('spread')
+
+        self.assertEqual(scheduler.claim('uuid-0', 10 * GiB, 1), 'large')
+        #large has 6 GiB free now
+        self.assertEqual(scheduler.claim('uuid-1', 1 * GiB, 1), 'medium')
+        self.assertEqual(scheduler.claim('uuid-2', 1 * GiB, 1), 'medium')
+
+    def test_pack(self):
+        scheduler = self._scheduler('pack')
+
+        self.assertEqual(scheduler.claim('uuid-0', 2 * GiB, 1), 'small')
+        self.assertEqual(scheduler.claim('uuid-1', 2 * GiB, 1), 'small')
+        self.assertEqual(scheduler.claim('uuid-2', 2 * GiB, 1), 'medium')
+        self.assertEqual(scheduler.claim('uuid-3', 12 * GiB, 1), 'large')
+
+    def test_vcpu(self):
+        scheduler = self._scheduler('spread')
+
+        self.assertEqual(scheduler.claim('uuid-0', 1 * GiB, 4), 'large')
+        #large has the most free memory, but no free vcpus
+        self.assertEqual(scheduler.claim('uuid-1', 1 * GiB, 1), 'medium')
+
+    def test_image_locality(self):
+        scheduler = self._scheduler('image_locality')
+        claim = scheduler.claim
+
+        self.assertEqual(
+            claim('uuid-0', 1 * GiB, 1, 'ubuntu', host='small'),
+            'small'
+        )
+        self.assertEqual(claim('uuid-1', 1 * GiB, 1, 'ubuntu'), 'small')
+        #image is not available on host which does not fit
+        self.assertEqual(claim('uuid-2', 4 * GiB, 1, 'ubuntu'), 'large')
+        self.assertEqual(claim('uuid-3', 1 * GiB, 1, 'centos'), 'large')
+
+    def test_custom_strategy(self):
+        scheduler = self._scheduler(ImageLocalityStrategy(PackStrategy()))
+        claim = scheduler.claim
+
+        self.assertEqual(claim('uuid-0', 1 * GiB, 1, 'ubuntu'), 'small')
+        self.assertEqual(claim('uuid-1', 6 * GiB, 1, 'centos'), 'medium')
+        self.assertEqual(claim('uuid-2', 1 * GiB, 1, 'centos'), 'medium')
+
+    def test_no_valid_host(self):
+        scheduler = self._scheduler('pack')
+
+        self.assertRaises(NoValidHost, scheduler.claim, 'uuid-0', 32 * GiB, 1)
+        self.assertRaises(NoValidHost, scheduler.claim, 'uuid-1', 1 * GiB, 8)
+        self.assertEqual(scheduler.stats['no_valid_host'], 2)
+        self.assertEqual(scheduler.placements, {})
+
+    def test_release(self):
+        scheduler = self._scheduler('spread')
+
+        scheduler.claim('uuid-0', 10 * GiB, 2, 'ubuntu')
+        self.assertEqual(scheduler.release('uuid-0'), 'large')
+        self.assertIsNone(scheduler.release('uuid-0'))
+
+        host = scheduler.statistics()['hosts']['large']
+        self.assertEqual(host['free_memory'], 16 * GiB)
+        self.assertEqual(host['free_vcpu'], 4)
+        self.assertEqual(host['instances'], 0)
+        #file of image is still there
+        self.assertEqual(host['images'], 1)
+
+    def test_resize_host(self):
+        scheduler = self._scheduler('spread')
+        scheduler.claim('uuid-0', 1 * GiB, 1, host='small')
+
+        scheduler.resize_host('small', 32 * GiB, 8)
+
+        host = scheduler.statistics()['hosts']['small']
+        self.assertEqual(host['free_memory'], 31 * GiB)
+        self.assertEqual(host['free_vcpu'], 7)
+        self.assertEqual(scheduler.claim('uuid-1', 1 * GiB, 1), 'small')
+        self.assertRaises(
+            SchedulerError,
+            scheduler.resize_host,
+            'unknown', 1, 1
+        )
+
+    def test_claim_twice(self):
+        scheduler = self._scheduler('spread')
+
+        scheduler.claim('uuid-0', 1 * GiB, 1)
+        self.assertRaises(SchedulerError, scheduler.claim, 'uuid-0', 1, 1)
+        self.assertRaises(
+            SchedulerError,
+            scheduler.claim,
+            'uuid-1', 1, 1, host='unknown'
+        )
+
+    def test_index(self):
+        '''
+        Checks that list of hosts stays sorted by free memory
+        after random claims and releases
+        '''
+        scheduler = Scheduler('pack')
+        for i in range(50):
+            scheduler.add_host('host-%s' % i, 64 * GiB, 32)
+
+        generator = random.Random(0)
+        placed = []
+        for i in range(1000):
+            if placed and generator.random() < 0.4:
+                scheduler.release(placed.pop(generator.randrange(len(placed))))
+                continue
+
+            try:
+                scheduler.claim(
+                    'uuid-%s' % i,
+                    generator.choice([1, 2, 4]) * GiB,
+                    generator.choice([1, 2])
+                )
+            except NoValidHost:
+                continue
+            placed.append('uuid-%s' % i)
+
+        self.assertEqual(
+            scheduler.by_memory,
+            sorted(
+                (host.free_memory, name)
+                for name, host in scheduler.hosts.items()
+            )
+        )
+        for host in scheduler.hosts.values():
+            self.assertGreaterEqual(host.free_memory, 0)
+            self.assertGreaterEqual(host.free_vcpu, 0)
+
+    def test_unknown_strategy(self):
+        self.assertRaises(SchedulerError, Scheduler, 'random')
+
+
+if __name__ == '__main__':
+    unittest.main()
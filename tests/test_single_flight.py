@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from src.single_flight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.path_to_lock_dir = tempfile.mkdtemp()
+        self.path_to_image = os.path.join(self.path_to_lock_dir, 'image')
+
+    def tearDown(self):
+        shutil.rmtree(self.path_to_lock_dir)
+
+    def _fetch(self, single_flight, downloads):
+        '''
+        Mimics _image_processing: download under lock
+        only if image is still absent
+        '''
+        with single_flight.lock('image'):
+            if os.path.exists(self.path_to_image):
+                return
+
+            time.sleep(0.05)
+            with open(self.path_to_image, 'wb') as f:
+                f.write('image')
+            downloads.append(1)
+
+    def test_threads(self):
+        single_flight = SingleFlight(self.path_to_lock_dir)
+        downloads = []
+
+        threads = [
+            threading.Thread(target=self._fetch, args=(single_flight, downloads))
+            for i in range(50)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(downloads), 1)
+        #locks of finished flights are not kept in memory
+        self.assertEqual(single_flight.locks, {})
+
+    def test_processes(self):
+        pids = []
+        for i in range(5):
+            pid = os.fork()
+            if not pid:
+                downloads = []
+                self._fetch(SingleFlight(self.path_to_lock_dir), downloads)
+                os._exit(len(downloads))
+            pids.append(pid)
+
+        downloads = sum(
+            os.WEXITSTATUS(os.waitpid(pid, 0)[1]) for pid in pids
+        )
+        self.assertEqual(downloads, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
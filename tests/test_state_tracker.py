@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import libvirt
+from mock import Mock, patch
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+from src.database_toolkit import Base, Instance, contexted_session
+from src.instance_registry import InstanceRegistry, InstanceRecord
+from src.nova_mimic import NovaMimic
+from src.state_tracker import StateTracker
+
+
+def domain_mock(uuid):
+    domain = Mock()
+    domain.UUIDString.return_value = uuid
+    return domain
+
+
+class TestStateTracker(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine(
+            'sqlite://',
+            connect_args={'check_same_thread': False},
+            poolclass=StaticPool
+        )
+        Base.metadata.create_all(engine)
+
+        self.engine_patch = patch(
+            'src.database_toolkit.get_engine',
+            return_value=engine
+        )
+        self.engine_patch.start()
+
+        self.registry = InstanceRegistry()
+        with contexted_session() as s:
+            for i in range(3):
+                instance_id = 'uuid-%s' % i
+                s.add(
+                    Instance(
+                        id=instance_id,
+                        domain_name='vm-%s' % i,
+                        state='running'
+                    )
+                )
+                self.registry.add(
+                    InstanceRecord(
+                        instance_id,
+                        'vm-%s' % i,
+                        state=libvirt.VIR_DOMAIN_RUNNING
+                    )
+                )
+
+        self.tracker = StateTracker(self.registry, NovaMimic.domain_state)
+
+    def tearDown(self):
+        self.engine_patch.stop()
+
+    def _states(self):
+        with contexted_session() as s:
+            return dict(s.query(Instance.id, Instance.state))
+
+    def _event(self, uuid, event):
+        self.tracker._on_lifecycle(None, domain_mock(uuid), event, 0, None)
+
+    def test_events_are_coalesced(self):
+        self._event('uuid-0', libvirt.VIR_DOMAIN_EVENT_SUSPENDED)
+        self._event('uuid-0', libvirt.VIR_DOMAIN_EVENT_RESUMED)
+        self._event('uuid-0', libvirt.VIR_DOMAIN_EVENT_STOPPED)
+        #event which does not change state is ignored
+        self._event('uuid-1', libvirt.VIR_DOMAIN_EVENT_DEFINED)
+
+        self.assertEqual(
+            self.tracker.pending,
+            {'uuid-0': libvirt.VIR_DOMAIN_SHUTOFF}
+        )
+        self.assertEqual(
+            self.registry.get('uuid-0').state,
+            libvirt.VIR_DOMAIN_SHUTOFF
+        )
+        #database is not touched until flush
+        self.assertEqual(self._states()['uuid-0'], 'running')
+
+    def test_flush(self):
+        self._event('uuid-0', libvirt.VIR_DOMAIN_EVENT_STOPPED)
+        self._event('uuid-1', libvirt.VIR_DOMAIN_EVENT_STOPPED)
+        self._event('uuid-2', libvirt.VIR_DOMAIN_EVENT_CRASHED)
+
+        with patch.object(
+            self.tracker,
+            'state_names',
+            wraps=NovaMimic.domain_state
+        ) as names:
+            self.tracker.flush()
+            #one update per distinct state
+            self.assertEqual(names.get.call_count, 2)
+
+        self.assertEqual(
+            self._states(),
+            {
+                'uuid-0': 'shut off',
+                'uuid-1': 'shut off',
+                'uuid-2': 'crashed'
+            }
+        )
+        self.assertEqual(self.tracker.pending, {})
+
+    def test_failed_flush_keeps_changes(self):
+        self._event('uuid-0', libvirt.VIR_DOMAIN_EVENT_STOPPED)
+
+        with patch(
+            'src.state_tracker.contexted_session',
+            side_effect=RuntimeError
+        ):
+            self.assertRaises(RuntimeError, self.tracker.flush)
+
+        self.assertEqual(
+            self.tracker.pending,
+            {'uuid-0': libvirt.VIR_DOMAIN_SHUTOFF}
+        )
+
+        self.tracker.flush()
+        self.assertEqual(self._states()['uuid-0'], 'shut off')
+
+    def test_reboot_event(self):
+        self.tracker._on_reboot(None, domain_mock('uuid-1'), None)
+
+        self.assertEqual(self.registry.get('uuid-1').transitions, 1)
+        #state is not changed, nothing is written
+        self.assertEqual(self.tracker.pending, {})
+
+    def test_resync(self):
+        connection = Mock()
+        connection.getAllDomainStats.return_value = [
+            (domain_mock('uuid-0'), {'state.state': libvirt.VIR_DOMAIN_RUNNING}),
+            (domain_mock('uuid-1'), {'state.state': libvirt.VIR_DOMAIN_PAUSED}),
+            (domain_mock('unknown'), {'state.state': libvirt.VIR_DOMAIN_PAUSED})
+        ]
+        self.tracker.connection = connection
+
+        self.tracker._resync()
+
+        self.assertEqual(
+            self.tracker.pending,
+            {'uuid-1': libvirt.VIR_DOMAIN_PAUSED}
+        )
+
+    def test_start_and_stop(self):
+        connection = Mock()
+        connection.isAlive.return_value = 1
+
+        with patch('src.state_tracker.start_event_loop'), \
+                patch(
+                    'src.state_tracker.libvirt.open',
+                    return_value=connection
+                ):
+            self.tracker.start()
+            self._event('uuid-2', libvirt.VIR_DOMAIN_EVENT_SUSPENDED)
+            self.tracker.stop()
+
+        self.assertEqual(
+            [
+                call[0][1]
+                for call in connection.domainEventRegisterAny.call_args_list
+            ],
+            [
+                libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                libvirt.VIR_DOMAIN_EVENT_ID_REBOOT
+            ]
+        )
+        self.assertEqual(connection.domainEventDeregisterAny.call_count, 2)
+        self.assertTrue(connection.close.called)
+        #changes are written on stop
+        self.assertEqual(self._states()['uuid-2'], 'suspended')
+
+    def test_start_unreachable(self):
+        with patch('src.state_tracker.start_event_loop'), \
+                patch(
+                    'src.state_tracker.libvirt.open',
+                    side_effect=libvirt.libvirtError('unable to connect')
+                ):
+            #connection is made again by background thread
+            self.tracker.start()
+            self.assertIsNone(self.tracker.connection)
+            self.tracker.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import libvirt
+from mock import Mock
+
+from src.database_toolkit import NoResultFound
+from src.instance_registry import InstanceRegistry, InstanceRecord
+from src.state_waiter import StateWaiter, StateTimeoutError
+
+
+class TestStateWaiter(unittest.TestCase):
+    def setUp(self):
+        self.registry = InstanceRegistry()
+        self.domain = Mock()
+        self.registry.add(
+            InstanceRecord(
+                'uuid-1',
+                'vm-1',
+                state=libvirt.VIR_DOMAIN_RUNNING,
+                domain=self.domain
+            )
+        )
+
+        self.waiter = StateWaiter(self.registry)
+
+    def tearDown(self):
+        self.waiter.stop()
+
+    def test_wait(self):
+        future = self.waiter.wait('uuid-1', [libvirt.VIR_DOMAIN_PAUSED], 5)
+        self.assertFalse(future.done())
+
+        self.registry.update_state('uuid-1', libvirt.VIR_DOMAIN_PAUSED)
+        self.assertEqual(future.result(5), libvirt.VIR_DOMAIN_PAUSED)
+
+    def test_reached_state(self):
+        future = self.waiter.wait('uuid-1', [libvirt.VIR_DOMAIN_RUNNING])
+        self.assertEqual(future.result(5), libvirt.VIR_DOMAIN_RUNNING)
+
+    def test_transition(self):
+        record = self.registry.get('uuid-1')
+        future = self.waiter.wait(
+            'uuid-1',
+            [libvirt.VIR_DOMAIN_RUNNING],
+            5,
+            record.transitions
+        )
+        self.assertFalse(future.done())
+
+        #reboot keeps domain running
+        self.registry.mark_rebooted('uuid-1')
+        self.assertEqual(future.result(5), libvirt.VIR_DOMAIN_RUNNING)
+
+    def test_timeout(self):
+        future = self.waiter.wait('uuid-1', [libvirt.VIR_DOMAIN_SHUTOFF], 0.1)
+        self.assertRaises(StateTimeoutError, future.result, 5)
+
+    def test_removed_instance(self):
+        shut_off = self.waiter.wait('uuid-1', [libvirt.VIR_DOMAIN_SHUTOFF])
+        running = self.waiter.wait('uuid-1', [libvirt.VIR_DOMAIN_PAUSED])
+
+        self.registry.remove('uuid-1')
+
+        self.assertEqual(shut_off.result(5), libvirt.VIR_DOMAIN_SHUTOFF)
+        self.assertRaises(NoResultFound, running.result, 5)
+
+    def test_poll(self):
+        self.waiter.poll_interval = 0.01
+        error = libvirt.libvirtError('Domain not found')
+        error.get_error_code = Mock(return_value=libvirt.VIR_ERR_NO_DOMAIN)
+        self.domain.state.side_effect = [
+            [libvirt.VIR_DOMAIN_SHUTDOWN, 0],
+            error
+        ]
+
+        future = self.waiter.wait('uuid-1', [libvirt.VIR_DOMAIN_SHUTOFF], 5)
+
+        self.assertEqual(future.result(5), libvirt.VIR_DOMAIN_SHUTOFF)
+        self.assertEqual(
+            self.registry.get('uuid-1').state,
+            libvirt.VIR_DOMAIN_SHUTOFF
+        )
+
+    def test_poll_lookup(self):
+        #domain is looked up again, e.g. after reconnect
+        domain = Mock()
+        domain.state.return_value = [libvirt.VIR_DOMAIN_PAUSED, 0]
+        self.waiter.poll_interval = 0.01
+        self.waiter.lookup = Mock(return_value=domain)
+
+        future = self.waiter.wait('uuid-1', [libvirt.VIR_DOMAIN_PAUSED], 5)
+
+        self.assertEqual(future.result(5), libvirt.VIR_DOMAIN_PAUSED)
+        self.assertFalse(self.domain.state.called)
+
+    def test_stop(self):
+        future = self.waiter.wait('uuid-1', [libvirt.VIR_DOMAIN_SHUTOFF])
+        self.waiter.stop()
+        self.assertRaises(RuntimeError, future.result, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from mock import patch
+
+from src.token_bucket import TokenBucket
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_unlimited(self):
+        bucket = TokenBucket(0)
+        with patch('src.token_bucket.time.sleep') as sleep:
+            bucket.consume(10 ** 9)
+        self.assertFalse(sleep.called)
+
+    def test_throttling(self):
+        bucket = TokenBucket(100)
+        with patch('src.token_bucket.time.sleep') as sleep:
+            bucket.consume(100)
+            self.assertFalse(sleep.called)
+
+            bucket.consume(50)
+            delay = sleep.call_args[0][0]
+            self.assertTrue(0.4 < delay <= 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
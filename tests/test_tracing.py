@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from src.tracing import (
+    Tracer, Histogram, NULL_SPAN,
+    CallbackExporter, PrometheusExporter
+)
+
+
+class TestHistogram(unittest.TestCase):
+    def test_observe(self):
+        histogram = Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+
+        self.assertEqual(
+            histogram.cumulative(),
+            [(0.1, 2), (1.0, 3), (float('inf'), 4)]
+        )
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.99), float('inf'))
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.spans = []
+        self.tracer = Tracer(True, [CallbackExporter(self.spans.append)])
+
+    def test_disabled(self):
+        tracer = Tracer(False, [CallbackExporter(self.spans.append)])
+
+        with tracer.span('instance_boot') as span:
+            self.assertIs(span, NULL_SPAN)
+        tracer.start('db_commit').finish()
+
+        self.assertEqual(self.spans, [])
+        self.assertEqual(tracer.statistics(), {})
+
+    def test_nested_spans(self):
+        with self.tracer.span('instance_boot', instance='vm'):
+            with self.tracer.span('create_xml'):
+                pass
+            commit = self.tracer.start('db_commit')
+        commit.finish()
+
+        self.assertEqual(
+            [(span.name, span.parent) for span in self.spans],
+            [
+                ('create_xml', 'instance_boot'),
+                ('instance_boot', None),
+                ('db_commit', 'instance_boot')
+            ]
+        )
+        self.assertEqual(self.spans[1].tags, {'instance': 'vm'})
+        self.assertEqual(self.tracer.statistics()['create_xml']['count'], 1)
+
+    def test_error(self):
+        def boot():
+            with self.tracer.span('instance_boot'):
+                raise ValueError()
+
+        self.assertRaises(ValueError, boot)
+        self.assertEqual(self.spans[0].error, 'ValueError')
+
+    def test_failed_exporter(self):
+        def broken(span):
+            raise RuntimeError()
+
+        self.tracer.exporters.insert(0, CallbackExporter(broken))
+        with self.tracer.span('instance_boot'):
+            pass
+
+        self.assertEqual(len(self.spans), 1)
+
+    def test_prometheus(self):
+        path_to_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path_to_dir)
+        path = os.path.join(path_to_dir, 'vms_manager.prom')
+
+        self.tracer.exporters.append(PrometheusExporter(path, interval=0))
+        with self.tracer.span('create_xml'):
+            pass
+
+        with open(path) as f:
+            text = f.read()
+
+        self.assertIn('# TYPE vms_manager_stage_duration_seconds histogram', text)
+        self.assertIn(
+            'vms_manager_stage_duration_seconds_bucket'
+            '{stage="create_xml",le="+Inf"} 1',
+            text
+        )
+        self.assertIn(
+            'vms_manager_stage_duration_seconds_count{stage="create_xml"} 1',
+            text
+        )
+        self.assertEqual(os.listdir(path_to_dir), ['vms_manager.prom'])
+
+    def _prometheus(self, interval):
+        path_to_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path_to_dir)
+        path = os.path.join(path_to_dir, 'vms_manager.prom')
+
+        exporter = PrometheusExporter(path, interval)
+        self.tracer.exporters.append(exporter)
+        return exporter
+
+    def _count(self, path):
+        with open(path) as f:
+            for line in f:
+                if line.startswith('vms_manager_stage_duration_seconds_count'):
+                    return int(line.split()[-1])
+
+    def test_prometheus_flush(self):
+        exporter = self._prometheus(60)
+        for i in range(3):
+            with self.tracer.span('create_xml'):
+                pass
+
+        #the first span is written at once, others wait for interval
+        self.assertEqual(self._count(exporter.path), 1)
+
+        self.tracer.close()
+        self.assertEqual(self._count(exporter.path), 3)
+        self.assertIsNone(exporter.timer)
+
+    def test_prometheus_flush_by_timer(self):
+        exporter = self._prometheus(0.1)
+        for i in range(3):
+            with self.tracer.span('create_xml'):
+                pass
+        self.assertEqual(self._count(exporter.path), 1)
+
+        time.sleep(0.3)
+        self.assertEqual(self._count(exporter.path), 3)
+
+    def test_prometheus_failed_write(self):
+        exporter = self._prometheus(0)
+
+        with patch('src.tracing.os.rename', side_effect=OSError("no space")):
+            self.assertRaises(OSError, exporter.write, self.tracer)
+
+        #temporary file is removed
+        self.assertEqual(os.listdir(os.path.dirname(exporter.path)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
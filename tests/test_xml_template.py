@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+from src.xml_template import DomainTemplate, METADATA_NAMESPACE
+
+PATTERN = '''<domain type='kvm'>
+  <name>pattern</name>
+  <memory>1024</memory>
+  <currentMemory>1024</currentMemory>
+  <vcpu>%s</vcpu>
+  <devices>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='raw'/>
+      <source file='/tmp/pattern.img'/>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+    <interface type='network'>
+      <mac address='00:00:00:00:00:00'/>
+      <source network='default'/>
+    </interface>
+  </devices>
+</domain>
+'''
+
+
+class TestDomainTemplate(unittest.TestCase):
+    def setUp(self):
+        self.path_to_dir = tempfile.mkdtemp()
+        self.path_to_pattern = os.path.join(self.path_to_dir, 'pattern.xml')
+        self._write_pattern(1)
+
+        self.values = {
+            'name': 'test_instance',
+            'memory': 524288,
+            'current_memory': 524288,
+            'vcpu': 2,
+            'disk': '/var/lib/images/522700a8a063d875c192d818',
+            'mac': '52:54:00:83:df:a1',
+            'image_id': '522700a8a063d875c192d818'
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.path_to_dir)
+
+    def _write_pattern(self, vcpu):
+        with open(self.path_to_pattern, 'w') as f:
+            f.write(PATTERN % vcpu)
+
+    def test_render(self):
+        template = DomainTemplate(self.path_to_pattern)
+        doc_root = ElementTree.fromstring(template.render(**self.values))
+
+        self.assertEqual(doc_root.find('name').text, 'test_instance')
+        self.assertEqual(doc_root.find('memory').text, '524288')
+        self.assertEqual(doc_root.find('currentMemory').text, '524288')
+        self.assertEqual(doc_root.find('vcpu').text, '2')
+
+        disk = doc_root.find('devices/disk')
+        self.assertEqual(disk.find('source').get('file'), self.values['disk'])
+        # format of disk is taken from pattern if it is not given
+        self.assertEqual(disk.find('driver').get('type'), 'raw')
+
+        self.assertEqual(
+            doc_root.find('devices/interface/mac').get('address'),
+            self.values['mac']
+        )
+
+        image = doc_root.find(
+            'metadata/{%s}instance/{%s}image' % (
+                METADATA_NAMESPACE,
+                METADATA_NAMESPACE
+            )
+        )
+        self.assertEqual(image.get('id'), self.values['image_id'])
+
+    def test_disk_format(self):
+        template = DomainTemplate(self.path_to_pattern)
+
+        self.values['disk_format'] = 'qcow2'
+        doc_root = ElementTree.fromstring(template.render(**self.values))
+        self.assertEqual(
+            doc_root.find('devices/disk/driver').get('type'),
+            'qcow2'
+        )
+
+    def test_pattern_without_driver(self):
+        with open(self.path_to_pattern, 'w') as f:
+            f.write(
+                (PATTERN % 1).replace("<driver name='qemu' type='raw'/>", '')
+            )
+        template = DomainTemplate(self.path_to_pattern)
+
+        #driver is added to disk, raw is taken by default
+        driver = ElementTree.fromstring(
+            template.render(**self.values)
+        ).find('devices/disk/driver')
+        self.assertEqual(driver.get('type'), 'raw')
+
+        self.values['disk_format'] = 'qcow2'
+        driver = ElementTree.fromstring(
+            template.render(**self.values)
+        ).find('devices/disk/driver')
+        self.assertEqual(driver.get('name'), 'qemu')
+        self.assertEqual(driver.get('type'), 'qcow2')
+
+    def test_uuid(self):
+        template = DomainTemplate(self.path_to_pattern)
+
+        self.values['uuid'] = '4b9d2e6c-6e35-4a4b-9a2d-2f3c1e0e5b7a'
+        doc_root = ElementTree.fromstring(template.render(**self.values))
+        self.assertEqual(doc_root.find('uuid').text, self.values['uuid'])
+        #uuid follows name as in configs written by libvirt
+        self.assertEqual(list(doc_root)[1].tag, 'uuid')
+
+        #every domain gets its own random uuid if it is not given
+        del self.values['uuid']
+        uuids = set(
+            ElementTree.fromstring(
+                template.render(**self.values)
+            ).find('uuid').text
+            for i in range(2)
+        )
+        self.assertEqual(len(uuids), 2)
+
+    def test_escaping(self):
+        template = DomainTemplate(self.path_to_pattern)
+        self.values['name'] = u'<test & "instance">ж'
+        self.values['disk'] = '/var/lib/"images"/<a>'
+
+        doc_root = ElementTree.fromstring(template.render(**self.values))
+
+        self.assertEqual(doc_root.find('name').text, self.values['name'])
+        self.assertEqual(
+            doc_root.find('devices/disk/source').get('file'),
+            self.values['disk']
+        )
+
+    def test_reload_on_change(self):
+        template = DomainTemplate(self.path_to_pattern, check_interval=0)
+
+        doc_root = ElementTree.fromstring(template.render(**self.values))
+        self.assertEqual(doc_root.find('devices/disk/target').get('bus'), 'virtio')
+
+        with open(self.path_to_pattern, 'w') as f:
+            f.write((PATTERN % 1).replace('virtio', 'ide'))
+
+        doc_root = ElementTree.fromstring(template.render(**self.values))
+        self.assertEqual(doc_root.find('devices/disk/target').get('bus'), 'ide')
+        self.assertEqual(doc_root.find('name').text, 'test_instance')
+
+
+if __name__ == '__main__':
+    unittest.main()
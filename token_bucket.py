@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides token bucket which limits rate of background work
+(e.g. prefetch downloads and scrub reads of images) in bytes
+per second.
+'''
+
+import time
+import threading
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        '''
+        rate is number of tokens (bytes) per second, 0 means that
+        rate is not limited. burst is maximum number of tokens which
+        are accumulated while bucket is not used (rate by default).
+        '''
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        '''
+        Takes amount of tokens, sleeps while bucket is in debt.
+        '''
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst,
+                self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / float(self.rate) if self.tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
@@ -0,0 +1,352 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides timing of stages of boot and lifecycle operations.
+
+Every stage is wrapped into span:
+
+    with self.tracer.span('create_xml', instance=instance_name):
+        ...
+
+Duration of finished span is put into latency histogram of its name
+and span is given to exporters: LogExporter writes one log line per
+span, PrometheusExporter periodically dumps histograms in text format
+of Prometheus (e.g. for textfile collector of node_exporter),
+CallbackExporter calls given function.
+
+Disabled tracer gives out one shared dummy span, so instrumented code
+pays only for a method call.
+'''
+
+import os
+import time
+import logging
+import tempfile
+import threading
+from bisect import bisect_left
+
+LOG = logging.getLogger(__name__)
+
+#upper bounds of buckets of histograms in seconds
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0
+)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        #the last counter is for values above all buckets
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def cumulative(self):
+        '''
+        Returns: list of (upper bound, number of values not greater
+        than it), the last bound is float('inf')
+        '''
+        with self.lock:
+            counts = list(self.counts)
+
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            result.append((bound, total))
+
+        return result
+
+    def quantile(self, fraction):
+        '''
+        Returns: upper bound of bucket where given quantile lies
+        '''
+        cumulative = self.cumulative()
+        if not self.count:
+            return None
+
+        rank = fraction * cumulative[-1][1]
+        for bound, total in cumulative:
+            if total >= rank:
+                return bound
+
+
+class Span(object):
+    __slots__ = ('tracer', 'name', 'tags', 'parent', 'started_at',
+                 'duration', 'error')
+
+    def __init__(self, tracer, name, tags, parent=None):
+        self.tracer = tracer
+        self.name = name
+        self.tags = tags
+        #name of enclosing span of the same thread
+        self.parent = parent
+        self.started_at = time.time()
+        self.duration = None
+        self.error = None
+
+    def finish(self, error=None):
+        if self.duration is not None:
+            return
+
+        self.duration = time.time() - self.started_at
+        if error is not None:
+            self.error = error.__class__.__name__
+        self.tracer._finished(self)
+
+    def __enter__(self):
+        self.tracer._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer._pop()
+        self.finish(exc_value)
+
+
+class NullSpan(object):
+    '''
+    Span of disabled tracer, does nothing.
+    '''
+    def finish(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+    def __init__(self, enabled=False, exporters=None, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.exporters = list(exporters or [])
+        self.buckets = buckets
+
+        #key - name of span, value - Histogram
+        self.histograms = {}
+        self.lock = threading.Lock()
+        #stack of entered spans of current thread
+        self.local = threading.local()
+
+    def _push(self, span):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(span)
+
+    def _pop(self):
+        self.local.stack.pop()
+
+    def _parent(self):
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1].name if stack else None
+
+    def span(self, name, **tags):
+        '''
+        Returns: span which is measured inside of with block
+        '''
+        if not self.enabled:
+            return NULL_SPAN
+
+        return Span(self, name, tags, self._parent())
+
+    def start(self, name, **tags):
+        '''
+        Returns: span which is measured until its finish method is
+        called (e.g. by other thread or after end of with block)
+        '''
+        return self.span(name, **tags)
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(
+                    name,
+                    Histogram(self.buckets)
+                )
+
+        return histogram
+
+    def _finished(self, span):
+        self.histogram(span.name).observe(span.duration)
+
+        for exporter in self.exporters:
+            try:
+                exporter.export(self, span)
+            except Exception:
+                #tracing never breaks traced operation
+                LOG.exception("Exporter %r failed", exporter)
+
+    def close(self):
+        '''
+        Closes exporters which keep spans (e.g. PrometheusExporter
+        writes spans which are not written yet).
+        '''
+        for exporter in self.exporters:
+            close = getattr(exporter, 'close', None)
+            if close is not None:
+                close()
+
+    def statistics(self):
+        '''
+        Returns: dict where key is name of span and value is dict
+        with count, sum and quantiles (bounds of buckets) of durations
+        '''
+        with self.lock:
+            histograms = dict(self.histograms)
+
+        return dict(
+            (
+                name,
+                {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'p50': histogram.quantile(0.5),
+                    'p99': histogram.quantile(0.99)
+                }
+            )
+            for name, histogram in histograms.items()
+        )
+
+    def prometheus_text(self, metric='vms_manager_stage_duration_seconds'):
+        '''
+        Returns: histograms in text exposition format of Prometheus
+        '''
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+
+        lines = [
+            '# HELP %s Duration of stages of NovaMimic operations.' % metric,
+            '# TYPE %s histogram' % metric
+        ]
+        for name, histogram in histograms:
+            for bound, total in histogram.cumulative():
+                lines.append(
+                    '%s_bucket{stage="%s",le="%s"} %d' % (
+                        metric,
+                        name,
+                        '+Inf' if bound == float('inf') else repr(bound),
+                        total
+                    )
+                )
+            lines.append(
+                '%s_sum{stage="%s"} %r' % (metric, name, histogram.sum)
+            )
+            lines.append(
+                '%s_count{stage="%s"} %d' % (metric, name, histogram.count)
+            )
+
+        return '\n'.join(lines) + '\n'
+
+
+class LogExporter(object):
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or LOG
+        self.level = level
+
+    def export(self, tracer, span):
+        self.logger.log(
+            self.level,
+            "span=%s parent=%s duration_ms=%.3f error=%s %s",
+            span.name,
+            span.parent,
+            span.duration * 1000,
+            span.error,
+            ' '.join('%s=%s' % item for item in sorted(span.tags.items()))
+        )
+
+
+class PrometheusExporter(object):
+    def __init__(self, path, interval=10.0):
+        '''
+        Histograms are written to file not more often than
+        once per interval seconds. Spans which are finished before
+        interval is over are written by timer at its end, so the
+        last spans of burst are not left unwritten.
+        '''
+        self.path = path
+        self.interval = interval
+        self.written_at = 0
+        #tracer whose spans are not written yet and timer
+        #which writes them
+        self.pending = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def export(self, tracer, span):
+        #span is already put into histogram, so scheduled write
+        #covers it
+        if self.timer is not None:
+            return
+
+        with self.lock:
+            if self.timer is not None:
+                return
+
+            delay = self.written_at + self.interval - time.time()
+            if delay > 0:
+                self.pending = tracer
+                self.timer = threading.Timer(delay, self._flush_by_timer)
+                self.timer.daemon = True
+                self.timer.start()
+                return
+
+            self.written_at = time.time()
+            self.write(tracer)
+
+    def _flush_by_timer(self):
+        try:
+            self.flush()
+        except Exception:
+            LOG.exception("Failed to write histograms to %s", self.path)
+
+    def flush(self):
+        '''
+        Writes spans which are not written yet (if any).
+        '''
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            tracer, self.pending = self.pending, None
+            if tracer is not None:
+                self.written_at = time.time()
+                self.write(tracer)
+
+    def close(self):
+        self.flush()
+
+    def write(self, tracer):
+        #file is replaced atomically, so collector never reads half of it
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, path_to_tmp = tempfile.mkstemp(prefix='.tracing.', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(tracer.prometheus_text())
+            os.rename(path_to_tmp, self.path)
+        except:
+            os.remove(path_to_tmp)
+            raise
+
+
+class CallbackExporter(object):
+    def __init__(self, callback):
+        self.callback = callback
+
+    def export(self, tracer, span):
+        self.callback(span)
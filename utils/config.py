@@ -0,0 +1,31 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Helpers for reading optional settings from global config file.
+
+ConfigParser raises exception for absent option, but most of
+settings of system have reasonable default values, so following
+function returns default in that case.
+'''
+
+
+def get_option(conf, section, option, default=None, cast=None):
+    '''
+    Returns value of option from section of conf (ConfigParser object)
+    converted by cast callable. If there is no such option default
+    is returned as is.
+
+    bool cast is treated specially since bool('false') is True.
+    '''
+    if not conf.has_option(section, option):
+        return default
+
+    if cast is bool:
+        return conf.getboolean(section, option)
+
+    value = conf.get(section, option)
+
+    if cast is not None:
+        return cast(value)
+
+    return value
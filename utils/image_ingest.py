@@ -0,0 +1,332 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides content-addressed upload of images to GridFS.
+
+File of image is read twice: first pass computes sha256 of its
+content, if file with the same hash is already present in GridFS
+upload is skipped and existing file is reused. Otherwise second pass
+uploads chunks of file by pool of threads (batch of chunks per insert).
+Document of file (fs.files) is inserted after all of its chunks, so
+GridFS never shows partially uploaded file. Unique index on sha256
+of files makes concurrent uploads of the same content end with
+one file.
+
+Row of images table keeps hash of content, so images with the same
+content share one copy in local image storage of NovaMimic as well.
+Rows of images which were uploaded before can be hashed by --backfill.
+
+    cd .. && python -m src.utils.image_ingest path/to/image.img \
+        --name ubuntu12.04server --fmt qcow2
+'''
+
+import os
+import os.path
+import sys
+import hashlib
+import argparse
+from datetime import datetime
+from collections import deque
+from ConfigParser import ConfigParser
+
+import gridfs
+import pymongo
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from gridfs.grid_file import DEFAULT_CHUNK_SIZE
+from pymongo.errors import DuplicateKeyError
+from sqlalchemy import or_
+
+from concurrent.futures import ThreadPoolExecutor
+
+from src.database_toolkit import Image, contexted_session
+from src.utils.config import get_option
+
+PATH_TO_GLOBAL_CONFIG = os.path.join(
+    os.path.split(os.path.dirname(os.path.abspath(__file__)))[0],
+    'config.ini'
+)
+
+#size of piece of file which is hashed at once
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class ImageIngestError(Exception):
+    pass
+
+
+def content_sha256(f, block_size=HASH_BLOCK_SIZE):
+    '''
+    Reads file object till the end.
+    Returns: (hex sha256 of content, length of content)
+    '''
+    digest = hashlib.sha256()
+    length = 0
+
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+
+        digest.update(block)
+        length += len(block)
+
+    return digest.hexdigest(), length
+
+
+class ImageUploader(object):
+    def __init__(self, db, collection='fs', chunk_size=DEFAULT_CHUNK_SIZE,
+                 workers=4, batch_size=16):
+        '''
+        db is pymongo database of GridFS, collection is its prefix.
+        Every insert carries batch_size chunks, at most 2 * workers
+        batches are kept in memory.
+        '''
+        self.files = db['%s.files' % collection]
+        self.chunks = db['%s.chunks' % collection]
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.batch_size = batch_size
+
+        self.stats = {
+            'uploaded': 0,
+            'uploaded_bytes': 0,
+            'deduplicated': 0,
+            'deduplicated_bytes': 0
+        }
+
+    def ensure_indexes(self):
+        #files uploaded by gridfs itself have no hash
+        self.files.create_index('sha256', unique=True, sparse=True)
+        self.chunks.create_index(
+            [('files_id', pymongo.ASCENDING), ('n', pymongo.ASCENDING)],
+            unique=True
+        )
+
+    def find(self, sha256):
+        '''
+        Returns: id of file with given hash of content or None
+        '''
+        document = self.files.find_one({'sha256': sha256}, ['_id'])
+        return document['_id'] if document is not None else None
+
+    def upload(self, path, **fields):
+        '''
+        Uploads file unless file with the same content is already
+        present. fields are saved in document of new file
+        (e.g. filename).
+
+        Returns: (id of file in GridFS, sha256, length, True if file
+        was uploaded and False if existing file is reused)
+        '''
+        with open(path, 'rb') as f:
+            sha256, length = content_sha256(f)
+
+            file_id = self.find(sha256)
+            if file_id is not None:
+                self.stats['deduplicated'] += 1
+                self.stats['deduplicated_bytes'] += length
+                return file_id, sha256, length, False
+
+            f.seek(0)
+            file_id = ObjectId()
+            try:
+                uploaded_sha256, uploaded_length = \
+                    self._upload_chunks(f, file_id)
+                if uploaded_sha256 != sha256:
+                    raise ImageIngestError(
+                        "File %s was changed during upload" % path
+                    )
+
+                document = dict(fields)
+                document.update(
+                    {
+                        '_id': file_id,
+                        'length': uploaded_length,
+                        'chunkSize': self.chunk_size,
+                        'uploadDate': datetime.utcnow(),
+                        'sha256': sha256
+                    }
+                )
+                self.files.insert_one(document)
+            except DuplicateKeyError:
+                #the same content was uploaded concurrently
+                self.chunks.delete_many({'files_id': file_id})
+                self.stats['deduplicated'] += 1
+                self.stats['deduplicated_bytes'] += length
+                return self.find(sha256), sha256, length, False
+            except:
+                self.chunks.delete_many({'files_id': file_id})
+                raise
+
+        self.stats['uploaded'] += 1
+        self.stats['uploaded_bytes'] += length
+
+        return file_id, sha256, length, True
+
+    def _upload_chunks(self, f, file_id):
+        '''
+        Inserts chunks of file by pool of threads.
+        Returns: (hex sha256, length) of uploaded content
+        '''
+        digest = hashlib.sha256()
+        length = 0
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            in_flight = deque()
+            batch = []
+            n = 0
+            while True:
+                data = f.read(self.chunk_size)
+                if data:
+                    digest.update(data)
+                    length += len(data)
+                    batch.append(
+                        {'files_id': file_id, 'n': n, 'data': Binary(data)}
+                    )
+                    n += 1
+
+                if batch and (len(batch) == self.batch_size or not data):
+                    in_flight.append(
+                        executor.submit(
+                            self.chunks.insert_many,
+                            batch,
+                            ordered=False
+                        )
+                    )
+                    batch = []
+
+                    if len(in_flight) > 2 * self.workers:
+                        in_flight.popleft().result()
+
+                if not data:
+                    break
+
+            for future in in_flight:
+                future.result()
+
+        return digest.hexdigest(), length
+
+
+def ingest_image(uploader, path, name, fmt):
+    '''
+    Uploads image (if its content is not uploaded yet) and adds row
+    of images table. Row of image with the same content is reused.
+
+    Returns: id of image
+    '''
+    file_id, sha256, length, uploaded = uploader.upload(path, filename=name)
+
+    with contexted_session() as s:
+        image = s.query(Image)\
+                 .filter(
+                     or_(Image.sha256 == sha256, Image.id == str(file_id))
+                 )\
+                 .first()
+
+        if image is None:
+            image = Image(
+                id=str(file_id),
+                name=name,
+                fmt=fmt,
+                size=length,
+                sha256=sha256
+            )
+            s.add(image)
+        elif image.sha256 is None:
+            image.sha256 = sha256
+
+        image_id = image.id
+
+    return image_id
+
+
+def backfill(grfs, uploader):
+    '''
+    Hashes content of images which were uploaded without hash.
+
+    Returns: number of hashed images
+    '''
+    with contexted_session() as s:
+        image_ids = [
+            image_id for image_id, in
+            s.query(Image.id).filter(Image.sha256 == None)
+        ]
+
+    for image_id in image_ids:
+        sha256, _ = content_sha256(grfs.get(ObjectId(image_id)))
+
+        #duplicate of other file keeps no hash in GridFS, but its
+        #row refers to the same file in local image storage
+        try:
+            uploader.files.update_one(
+                {'_id': ObjectId(image_id)},
+                {'$set': {'sha256': sha256}}
+            )
+        except DuplicateKeyError:
+            pass
+
+        with contexted_session() as s:
+            s.query(Image)\
+             .filter(Image.id == image_id)\
+             .update({'sha256': sha256}, synchronize_session=False)
+
+    return len(image_ids)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('paths', nargs='*', help='files of images')
+    parser.add_argument(
+        '--name',
+        help='name of image (name of file by default)'
+    )
+    parser.add_argument('--fmt', default='qcow2', help='format of image')
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='number of threads which upload chunks'
+    )
+    parser.add_argument(
+        '--backfill', action='store_true',
+        help='hash images which were uploaded without hash'
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+
+    conf = ConfigParser()
+    conf.read(PATH_TO_GLOBAL_CONFIG)
+
+    client = pymongo.MongoClient(
+        host=get_option(conf, 'gridfs', 'host', 'localhost'),
+        port=get_option(conf, 'gridfs', 'port', 27017, int)
+    )
+    try:
+        db = client[get_option(conf, 'gridfs', 'database', 'image_storage')]
+        uploader = ImageUploader(db, workers=options.workers)
+        uploader.ensure_indexes()
+
+        if options.backfill:
+            print 'hashed %d images' % backfill(gridfs.GridFS(db), uploader)
+
+        for path in options.paths:
+            image_id = ingest_image(
+                uploader,
+                path,
+                options.name or os.path.basename(path),
+                options.fmt
+            )
+            print '%s %s' % (image_id, path)
+
+        print 'uploaded %(uploaded)d (%(uploaded_bytes)d bytes), ' \
+            'deduplicated %(deduplicated)d ' \
+            '(%(deduplicated_bytes)d bytes)' % uploader.stats
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Provides compiled pattern of domain xml config.
+
+Pattern file is parsed only once: values of elements and attributes
+that differ from instance to instance (slots) are replaced with
+markers, document is serialized and split by markers into list of
+constant pieces and slot names. Rendering of config for instance is
+just joining of that list with escaped values.
+
+uuid of domain is a slot too, so caller can choose it before domain
+is created (random uuid is used if it is not given).
+
+Pattern file is recompiled as soon as its modification time or size
+is changed. File is checked not more often than once per
+check_interval seconds.
+'''
+
+import os
+import re
+import time
+import uuid
+import threading
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape
+
+#namespace of custom metadata which is stored in domain xml
+METADATA_NAMESPACE = 'http://github.com/aateem/vms_manager/instance'
+
+ElementTree.register_namespace('nova_mimic', METADATA_NAMESPACE)
+
+SLOT_MARKER = '@@vms_manager_slot:%s@@'
+SLOT_PATTERN = re.compile(SLOT_MARKER % r'(\w+)')
+
+#slots which are placed into text of elements, others are
+#placed into attribute values
+TEXT_SLOTS = ('name', 'uuid', 'memory', 'current_memory', 'vcpu')
+
+
+class DomainTemplate(object):
+    def __init__(self, path_to_pattern, check_interval=1.0):
+        self.path_to_pattern = path_to_pattern
+        self.check_interval = check_interval
+
+        #pair of list where even items are constant pieces of xml
+        #and odd ones are names of slots and dict of default values
+        #of slots which are taken from pattern. Pair is replaced as a
+        #whole, so rendering threads never see half updated template
+        self.compiled = None
+        self.signature = None
+        self.checked_at = 0
+
+        self.lock = threading.Lock()
+
+    def _signature(self):
+        stat = os.stat(self.path_to_pattern)
+        return (stat.st_mtime, stat.st_size)
+
+    def _compile(self):
+        signature = self._signature()
+        doc_root = ElementTree.parse(self.path_to_pattern).getroot()
+        defaults = {}
+
+        doc_root.find('name').text = SLOT_MARKER % 'name'
+
+        domain_uuid = doc_root.find('uuid')
+        if domain_uuid is None:
+            domain_uuid = ElementTree.Element('uuid')
+            domain_uuid.tail = doc_root.find('name').tail
+            doc_root.insert(
+                list(doc_root).index(doc_root.find('name')) + 1,
+                domain_uuid
+            )
+        domain_uuid.text = SLOT_MARKER % 'uuid'
+        doc_root.find('memory').text = SLOT_MARKER % 'memory'
+        doc_root.find('currentMemory').text = SLOT_MARKER % 'current_memory'
+        doc_root.find('vcpu').text = SLOT_MARKER % 'vcpu'
+
+        devices = doc_root.find('devices')
+
+        for disk in devices.findall('disk'):
+            if disk.get('type') == 'file':
+                disk.find('source').set('file', SLOT_MARKER % 'disk')
+
+                #format of disk is always set, since libvirt does
+                #not probe it and takes raw otherwise
+                driver = disk.find('driver')
+                if driver is None:
+                    driver = ElementTree.Element('driver', name='qemu')
+                    driver.tail = disk.find('source').tail
+                    disk.insert(0, driver)
+                defaults.setdefault('disk_format', driver.get('type', 'raw'))
+                driver.set('type', SLOT_MARKER % 'disk_format')
+
+        for interface in devices.findall('interface'):
+            if interface.get('type') == 'network':
+                interface.find('mac').set('address', SLOT_MARKER % 'mac')
+
+        # id of image is saved in domain metadata
+        metadata = doc_root.find('metadata')
+        if metadata is None:
+            metadata = ElementTree.SubElement(doc_root, 'metadata')
+
+        instance_metadata = ElementTree.SubElement(
+            metadata,
+            '{%s}instance' % METADATA_NAMESPACE
+        )
+        ElementTree.SubElement(
+            instance_metadata,
+            '{%s}image' % METADATA_NAMESPACE,
+            id=SLOT_MARKER % 'image_id'
+        )
+
+        self.compiled = (
+            SLOT_PATTERN.split(ElementTree.tostring(doc_root)),
+            defaults
+        )
+        self.signature = signature
+
+    def _refresh(self):
+        now = time.time()
+        if self.compiled is not None and \
+                now - self.checked_at < self.check_interval:
+            return
+
+        with self.lock:
+            if self.compiled is None or self._signature() != self.signature:
+                self._compile()
+            self.checked_at = now
+
+    def render(self, **values):
+        '''
+        Returns xml config with slots filled by values.
+        Slots: name, uuid, memory, current_memory, vcpu, disk,
+        disk_format, mac, image_id.
+        '''
+        self._refresh()
+
+        if not values.get('uuid'):
+            values['uuid'] = str(uuid.uuid4())
+
+        parts, defaults = self.compiled
+        parts = list(parts)
+        for i in range(1, len(parts), 2):
+            slot = parts[i]
+            value = values.get(slot, defaults.get(slot, ''))
+            if not isinstance(value, basestring):
+                value = str(value)
+
+            if slot in TEXT_SLOTS:
+                value = escape(value)
+            else:
+                value = escape(value, {'"': '&quot;'})
+
+            # pattern is serialized in us-ascii as ElementTree does
+            if isinstance(value, unicode):
+                value = value.encode('ascii', 'xmlcharrefreplace')
+
+            parts[i] = value
+
+        return ''.join(parts)